@@ -1,14 +1,10 @@
 #!/bin/bash
-# find all csv files in datasets folder except ones containing '.rg' pattern
-files=`ls datasets -l | grep -v '\.rq' | grep 'csv' | awk '{print $9}'`
+# find all source csv files in datasets folder (derived files have more dots, e.g. '.rq2.csv')
+files=`ls datasets | grep -E '^[^.]+\.csv$'`
 for file_base in $files
 do
   echo $file_base
-  dataset_file_path="datasets/$file_base"
-
-  # Subset with purchases only
-  sub_dataset_with_columns_file_path="datasets/$file_base.rq7.csv"
-  # Grab only the columns we need
-  # head -n 50 $dataset_file_path | cut -f2,7,8 -d , > $sub_dataset_with_columns_file_path
-  cat $dataset_file_path | cut -f2,7,8 -d , > $sub_dataset_with_columns_file_path
-done
\ No newline at end of file
+  # Columns we need (event_type, price, user_id) are served by shared.read_projection('rq7', ...)
+  # from the columnar cache: the file is parsed once for all RQs and skipped if the cache is newer than the file
+  python shared.py preprocess -l ${file_base%.csv}
+done
@@ -0,0 +1,508 @@
+from shared import *
+import re
+import ast
+import uuid
+import platform
+import subprocess
+
+
+# Benchmarks run every command of the rq_i.py files on synthetic months generated for each scale (rows per month),
+# each scale lives in its own folder (<bench_path>/<scale>/datasets) so real datasets are never touched
+default_scales = ['1M']
+default_bench_path = 'benchmarks'
+default_seed = 2019
+default_block_rows = 1_000_000
+default_threshold = 0.1  # relative increase of wall time or peak RSS reported as a regression
+repo_path = os.path.dirname(os.path.abspath(__file__))
+bench_modules = ['rq1', 'rq2', 'rq3', 'rq4', 'rq5', 'rq6', 'rq7']
+# answers given to the interactive commands
+bench_inputs = {
+    'rq2.get_most_sold_products_per_category': 'electronics\n',
+    'rq3.get_brands_avg_prices_per_category': 'electronics\n',
+    'rq3.get_brand_with_highest_prices_per_category': 'electronics\n',
+    'rq4.get_brand_monthly_profit': 'samsung\n'
+}
+
+# Catalogue of the synthetic shop
+bench_category_codes = [
+    'electronics.smartphone', 'electronics.audio.headphone', 'electronics.video.tv', 'electronics.clocks',
+    'appliances.kitchen.washer', 'appliances.kitchen.refrigerators', 'appliances.environment.vacuum',
+    'computers.notebook', 'computers.desktop', 'computers.peripherals.printer', 'apparel.shoes',
+    'apparel.shoes.keds', 'furniture.living_room.sofa', 'furniture.bedroom.bed', 'auto.accessories.player',
+    'construction.tools.drill', 'kids.toys', 'sport.bicycle', 'accessories.bag'
+]
+bench_brands = ['samsung', 'apple', 'xiaomi', 'huawei', 'lucente', 'bosch', 'lg', 'sony', 'acer', 'lenovo', 'oppo']
+bench_event_types = np.array(['view', 'cart', 'purchase'], dtype=object)
+# visits (product pages) per session: 1 + Poisson(2), views per visit: Geometric(0.5),
+# a visit ends in the cart with 12% probability and half of those are purchased
+rows_per_session = 3 * (2 + 0.12 + 0.06)
+
+
+def parse_rows(value) -> int:
+    """
+    Function parsing a number of rows given as a plain number or with a suffix (e.g. '500k', '10M')
+    """
+    multipliers = {'k': 10 ** 3, 'm': 10 ** 6, 'b': 10 ** 9}
+    value = str(value).strip().lower()
+    if value[-1:] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(float(value))
+
+
+@contextlib.contextmanager
+def working_directory(path: str):
+    """
+    Context manager running the code of the repository (which uses paths relative to datasets/) in another folder
+    """
+    cwd = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+
+
+def get_catalogue(n_rows: int, seed: int = default_seed) -> dict:
+    """
+    Function drawing the products and users of the synthetic shop, the same for every month of a scale
+    so that brands and buyers recur across months
+    """
+    rng = np.random.default_rng(seed)
+    n_products = max(100, n_rows // 250)
+    n_categories = max(2 * len(bench_category_codes), n_products // 100)
+    n_brands = max(len(bench_brands), n_products // 50)
+    n_users = max(100, n_rows // 15)
+    # every category code is used at least once, about 30% of category ids have no code
+    category_codes = np.array(
+        bench_category_codes + list(rng.choice(bench_category_codes, n_categories - len(bench_category_codes))),
+        dtype=object
+    )
+    category_codes[len(bench_category_codes):][rng.random(n_categories - len(bench_category_codes)) < 0.3] = ''
+    category_codes = category_codes[rng.permutation(n_categories)]
+    category_ids = 2053013552226107603 + np.sort(rng.choice(10 ** 9, n_categories, replace=False)).astype(np.int64)
+    brands = np.array(bench_brands + [f"brand{i:05d}" for i in range(n_brands - len(bench_brands))], dtype=object)
+    # a few brands and products get most of the traffic
+    brand_weights = 1 / np.arange(1, n_brands + 1)
+    product_brands = brands[rng.choice(n_brands, n_products, p=brand_weights / brand_weights.sum())]
+    product_brands[rng.random(n_products) < 0.15] = ''
+    popularity = 1 / np.arange(1, n_products + 1)
+    activity = rng.pareto(1.5, n_users) + 1
+    return {
+        'product_ids': 1_000_000 + np.sort(rng.choice(10 ** 8, n_products, replace=False)).astype(np.uint32),
+        'product_categories': rng.integers(0, n_categories, n_products),
+        'product_brands': product_brands,
+        'product_prices': np.maximum(0.77, np.round(rng.lognormal(4.5, 1.2, n_products), 2)),
+        'product_weights': rng.permutation(popularity / popularity.sum()),
+        'category_ids': category_ids,
+        'category_codes': category_codes,
+        'user_ids': 512_000_000 + np.sort(rng.choice(10 ** 8, n_users, replace=False)).astype(np.uint32),
+        'user_weights': activity / activity.sum()
+    }
+
+
+def generate_sessions(
+    rng: np.random.Generator,
+    catalogue: dict,
+    session_starts: np.ndarray,
+    n_rows: int,
+    month_end: int
+) -> pd.DataFrame:
+    """
+    Function generating events of sessions starting at session_starts (epoch seconds): a session visits
+    a few products, each visit is a few views possibly followed by an addition to the cart and a purchase
+    About n_rows events are expected, exactly n_rows are kept at random (fewer if less have been generated)
+    """
+    n_sessions = len(session_starts)
+    session_of_visit = np.repeat(np.arange(n_sessions), 1 + rng.poisson(2, n_sessions))
+    n_visits = len(session_of_visit)
+    n_views = rng.geometric(0.5, n_visits)
+    cart = rng.random(n_visits) < 0.12
+    purchase = cart & (rng.random(n_visits) < 0.5)
+    rows_per_visit = n_views + cart + purchase
+    visit_of_row = np.repeat(np.arange(n_visits), rows_per_visit)
+    # views come first, then the addition to the cart (1) and the purchase (2)
+    position = np.arange(len(visit_of_row)) - np.repeat(np.cumsum(rows_per_visit) - rows_per_visit, rows_per_visit)
+    event_types = np.maximum(0, position - n_views[visit_of_row] + 1)
+    # events of a session are apart by exponentially distributed gaps
+    session_of_row = session_of_visit[visit_of_row]
+    elapsed = np.cumsum(rng.exponential(45, len(visit_of_row)).astype(np.int64))
+    first_rows = np.searchsorted(session_of_row, np.arange(n_sessions))
+    event_times = np.minimum(
+        session_starts[session_of_row] + elapsed - elapsed[first_rows][session_of_row], month_end - 1
+    )
+    products = rng.choice(len(catalogue['product_ids']), n_visits, p=catalogue['product_weights'])
+    users = rng.choice(len(catalogue['user_ids']), n_sessions, p=catalogue['user_weights'])
+    raw = rng.bytes(16 * n_sessions)
+    sessions = np.array([str(uuid.UUID(bytes=raw[i:i + 16], version=4)) for i in range(0, 16 * n_sessions, 16)])
+    events = pd.DataFrame({
+        'event_time': event_times,
+        'event_type': event_types,
+        'product': products[visit_of_row],
+        'user': users[session_of_row],
+        'user_session': sessions[session_of_row]
+    })
+    if len(events) > n_rows:
+        events = events.iloc[np.sort(rng.choice(len(events), n_rows, replace=False))]
+    return events
+
+
+def format_events(events: pd.DataFrame, catalogue: dict) -> pd.DataFrame:
+    """
+    Function turning generated events into the columns of the real files
+    """
+    # format every distinct second once
+    times, rows_times = np.unique(events['event_time'].values, return_inverse=True)
+    times = pd.Series(np.datetime_as_string(times.astype('datetime64[s]'))).str.replace('T', ' ', regex=False)
+    products = events['product'].values
+    categories = catalogue['product_categories'][products]
+    return pd.DataFrame({
+        'event_time': (times + ' UTC').values[rows_times],
+        'event_type': bench_event_types[events['event_type'].values],
+        'product_id': catalogue['product_ids'][products],
+        'category_id': catalogue['category_ids'][categories],
+        'category_code': catalogue['category_codes'][categories],
+        'brand': catalogue['product_brands'][products],
+        'price': catalogue['product_prices'][products],
+        'user_id': catalogue['user_ids'][events['user'].values],
+        'user_session': events['user_session'].values
+    })
+
+
+def generate_events(
+    df_label: str = default_file_label,
+    n_rows: int = 1_000_000,
+    seed: int = default_seed,
+    block_rows: int = default_block_rows,
+    catalogue: dict = None
+) -> int:
+    """
+    Function writing datasets/<df_label>.csv with n_rows synthetic events in the schema of the real files
+    sorted by event_time, the file is written by blocks of about block_rows, returns the number of rows
+    """
+    catalogue = catalogue or get_catalogue(n_rows=n_rows, seed=seed)
+    month = pd.Period(df_label, 'M')
+    rng = np.random.default_rng([seed, month.ordinal])
+    month_start, month_end = int(month.start_time.timestamp()), int((month + 1).start_time.timestamp())
+    # sessions of the whole month sorted by start, every block takes a contiguous range of them
+    n_sessions = int(n_rows / rows_per_session * 1.1) + 10
+    session_starts = np.sort(rng.integers(month_start, month_end - 3 * 3600, n_sessions))
+    n_blocks = max(1, int(np.ceil(n_rows / block_rows)))
+    sessions_bounds = np.linspace(0, n_sessions, n_blocks + 1).astype(int)
+    rows_bounds = np.linspace(0, n_rows, n_blocks + 1).astype(int)
+    os.makedirs(os.path.dirname(get_file_path(df_label=df_label)), exist_ok=True)
+    pending, n_written = None, 0
+    with open(get_file_path(df_label=df_label), 'w') as f:
+        for i in range(n_blocks):
+            events = generate_sessions(
+                rng,
+                catalogue,
+                session_starts[sessions_bounds[i]:sessions_bounds[i + 1]],
+                n_rows=rows_bounds[i + 1] - rows_bounds[i],
+                month_end=month_end
+            )
+            events = pd.concat([pending, events], ignore_index=True) if pending is not None else events
+            events = events.sort_values(by='event_time', kind='mergesort')
+            # events later than the first session of the next block wait for it to keep the file sorted
+            if i + 1 < n_blocks:
+                ready = events['event_time'].values < session_starts[sessions_bounds[i + 1]]
+                events, pending = events[ready], events[~ready]
+            format_events(events, catalogue).to_csv(f, header=n_written == 0, index=False)
+            n_written += len(events)
+            print(".", end="", flush=True)
+    print(f"\n{df_label} | {n_written} synthetic events written")
+    return n_written
+
+
+def get_bench_meta_path(df_label: str = default_file_label):
+    return f"datasets/{df_label}.bench.json"
+
+
+def generate_datasets(
+    scales: list = default_scales,
+    df_labels: list = df_labels,
+    seed: int = default_seed,
+    bench_path: str = default_bench_path,
+    **kwargs
+) -> dict:
+    """
+    Function generating the synthetic months of every scale, months already generated with the same
+    number of rows and seed are kept, returns the number of rows of every month per scale
+    """
+    n_rows = dict()
+    for scale in scales:
+        with working_directory(os.path.join(bench_path, scale)):
+            catalogue = None
+            n_rows[scale] = dict()
+            for df_label in df_labels:
+                meta_path = get_bench_meta_path(df_label=df_label)
+                meta = json.load(open(meta_path)) if os.path.exists(meta_path) else dict()
+                if meta.get('scale') != parse_rows(scale) or meta.get('seed') != seed \
+                        or not os.path.exists(get_file_path(df_label=df_label)):
+                    catalogue = catalogue or get_catalogue(n_rows=parse_rows(scale), seed=seed)
+                    meta = {'scale': parse_rows(scale), 'seed': seed}
+                    meta['n_rows'] = generate_events(
+                        df_label=df_label, n_rows=parse_rows(scale), seed=seed, catalogue=catalogue
+                    )
+                    with open(meta_path, 'w') as f:
+                        json.dump(meta, f)
+                n_rows[scale][df_label] = meta['n_rows']
+    return n_rows
+
+
+def get_cli(module: str) -> tuple:
+    """
+    Function reading the commands (keys of FMAP) and the options of the command line of a module
+    without importing it
+    """
+    with open(os.path.join(repo_path, f"{module}.py")) as f:
+        tree = ast.parse(f.read())
+    commands, options = list(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Dict) \
+                and any(isinstance(target, ast.Name) and target.id == 'FMAP' for target in node.targets):
+            commands = [key.value for key in node.value.keys if isinstance(key, ast.Constant)]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'add_argument':
+            options.update(
+                arg.value for arg in node.args if isinstance(arg, ast.Constant) and str(arg.value).startswith('-')
+            )
+    return commands, options
+
+
+def run_command(module: str, args: list, stdin: str = '', log_path: str = os.devnull) -> dict:
+    """
+    Function running a command of a module in a separate process, measures its wall time
+    and peak resident memory (the largest of its processes)
+    """
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(repo_path, f"{module}.py"), *args],
+            stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, MPLBACKEND='Agg')
+        )
+        try:
+            process.stdin.write(stdin.encode())
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_s = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on Linux
+    return {'wall_s': wall_s, 'peak_rss_mb': rusage.ru_maxrss / 2 ** 10, 'returncode': process.returncode}
+
+
+def get_bench_commands(df_labels: list = df_labels, only: list = None, skip_preprocess: bool = False) -> list:
+    """
+    Function listing (module, command, labels) to be benchmarked: preprocessing of every month first,
+    then every FMAP command of rq1-rq7 (commands of a single month run on the first one)
+    only keeps the given modules ('rq1') or commands ('rq1.get_complete_funnels_rate'), preprocessing is
+    left out only by skip_preprocess
+    """
+    bench_commands = list()
+    for module in bench_modules:
+        commands, options = get_cli(module)
+        labels = list(df_labels) if '--df-labels' in options else list(df_labels[:1])
+        bench_commands += [
+            (module, command, labels) for command in commands
+            if only is None or module in only or f"{module}.{command}" in only
+        ]
+    preprocess = list() if skip_preprocess else [('shared', 'preprocess', [df_label]) for df_label in df_labels]
+    return preprocess + bench_commands
+
+
+def clean_bench_datasets():
+    """
+    Function removing everything derived from the synthetic months (caches, partitions, indexes, results)
+    so that every run starts from the *.csv files only
+    """
+    for entry in os.scandir('datasets'):
+        if not (re.fullmatch(r'[^.]+\.csv', entry.name) or entry.name.endswith('.bench.json')):
+            shutil.rmtree(entry.path) if entry.is_dir() else os.remove(entry.path)
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_history_path(bench_path: str = default_bench_path):
+    return os.path.join(bench_path, 'history.json')
+
+
+def load_history(bench_path: str = default_bench_path) -> list:
+    history_path = get_history_path(bench_path=bench_path)
+    if not os.path.exists(history_path):
+        return list()
+    with open(history_path) as f:
+        return json.load(f)
+
+
+def run_benchmarks(
+    scales: list = default_scales,
+    df_labels: list = df_labels,
+    size_mb: float = deafult_size_mb,
+    workers: int = default_workers,
+    seed: int = default_seed,
+    repeat: int = 1,
+    only: list = None,
+    skip_preprocess: bool = False,
+    bench_path: str = default_bench_path,
+    threshold: float = default_threshold,
+    **kwargs
+) -> list:
+    """
+    Function benchmarking every command at every scale: wall time (best of repeat), peak RSS and rows/s
+    are appended to the history (<bench_path>/history.json) and compared with the previous run
+    Results cached by run_analyses are dropped before every command
+    """
+    n_rows = generate_datasets(scales=scales, df_labels=df_labels, seed=seed, bench_path=bench_path)
+    bench_commands = get_bench_commands(df_labels=df_labels, only=only, skip_preprocess=skip_preprocess)
+    runs = list()
+    for scale in scales:
+        scale_path = os.path.abspath(os.path.join(bench_path, scale))
+        run = {
+            'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'commit': get_git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'scale': scale,
+            'df_labels': list(df_labels),
+            'size_mb': size_mb,
+            'workers': workers,
+            'results': list()
+        }
+        with working_directory(scale_path):
+            clean_bench_datasets()
+            os.makedirs('logs', exist_ok=True)
+            for module, command, labels in bench_commands:
+                _, options = get_cli(module)
+                args = [command, '-l', *labels, '-mb', str(size_mb)]
+                args += ['--workers', str(workers)] if '--workers' in options else []
+                rows = sum(n_rows[scale][label] for label in labels)
+                measures = list()
+                for _ in range(repeat):
+                    shutil.rmtree(default_cache_path, ignore_errors=True)
+                    measures.append(run_command(
+                        module, args, stdin=bench_inputs.get(f"{module}.{command}", ''),
+                        log_path=os.path.join('logs', f"{module}.{command}.log")
+                    ))
+                result = {
+                    # commands run once per month are told apart by the month
+                    'command': f"{module}.{command}" + (f"[{labels[0]}]" if module == 'shared' else ''),
+                    'rows': rows,
+                    'wall_s': round(min(measure['wall_s'] for measure in measures), 3),
+                    'peak_rss_mb': round(max(measure['peak_rss_mb'] for measure in measures), 1),
+                    'returncode': next((m['returncode'] for m in measures if m['returncode']), 0)
+                }
+                result['rows_per_s'] = round(rows / result['wall_s']) if result['wall_s'] > 0 else None
+                run['results'].append(result)
+                print(
+                    f"{scale} | {result['command']}: {result['wall_s']} s, {result['peak_rss_mb']} MB, "
+                    f"{result['rows_per_s']} rows/s"
+                    f"{'' if not result['returncode'] else ' | failed, see ' + os.path.join(scale_path, 'logs')}"
+                )
+        history = load_history(bench_path=bench_path)
+        history.append(run)
+        with open(get_history_path(bench_path=bench_path), 'w') as f:
+            json.dump(history, f, indent=1)
+        runs.append(run)
+        compare_runs(scales=[scale], bench_path=bench_path, threshold=threshold)
+    return runs
+
+
+def get_baseline_run(history: list, run: dict, baseline: str = None):
+    """
+    Function finding the run to compare a run with: the latest earlier run of the same scale and settings,
+    or the latest earlier run of the same scale made at a given commit (baseline)
+    """
+    settings = ('scale', 'df_labels', 'size_mb', 'workers')
+    for candidate in reversed(history[:history.index(run)]):
+        if baseline is not None:
+            if candidate['scale'] == run['scale'] and str(candidate.get('commit')).startswith(baseline):
+                return candidate
+        elif all(candidate.get(key) == run.get(key) for key in settings):
+            return candidate
+    return None
+
+
+def compare_runs(
+    scales: list = default_scales,
+    bench_path: str = default_bench_path,
+    baseline: str = None,
+    threshold: float = default_threshold,
+    **kwargs
+) -> dict:
+    """
+    Function comparing the latest run of every scale with its baseline (see get_baseline_run),
+    changes of wall time or peak RSS above threshold are flagged as regressions
+    """
+    history, comparisons = load_history(bench_path=bench_path), dict()
+    for scale in scales:
+        runs = [run for run in history if run['scale'] == scale]
+        if not runs:
+            print(f"{scale} | no runs in {get_history_path(bench_path=bench_path)}")
+            continue
+        run = runs[-1]
+        base = get_baseline_run(history, run, baseline=baseline)
+        results = pd.DataFrame(run['results']).set_index('command')[['wall_s', 'peak_rss_mb', 'rows_per_s']]
+        if base is None:
+            print(f"\n{scale} | {run['timestamp']} ({run['commit']}), nothing to compare with")
+            print(results.to_string())
+            comparisons[scale] = results
+            continue
+        base_results = pd.DataFrame(base['results']).set_index('command')[['wall_s', 'peak_rss_mb']]
+        comparison = results.join(base_results, rsuffix='_base', how='left')
+        comparison['wall_change'] = comparison['wall_s'] / comparison['wall_s_base'] - 1
+        comparison['rss_change'] = comparison['peak_rss_mb'] / comparison['peak_rss_mb_base'] - 1
+        comparison['regression'] = (comparison['wall_change'] > threshold) | (comparison['rss_change'] > threshold)
+        print(
+            f"\n{scale} | {run['timestamp']} ({run['commit']}) vs {base['timestamp']} ({base['commit']})"
+        )
+        print(comparison.to_string(formatters={
+            'wall_change': '{:+.1%}'.format, 'rss_change': '{:+.1%}'.format,
+            'regression': lambda regression: 'REGRESSION' if regression else ''
+        }))
+        comparisons[scale] = comparison
+    return comparisons
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the RQ commands on synthetic datasets')
+    FMAP = {
+        'generate_datasets': generate_datasets,
+        'run_benchmarks': run_benchmarks,
+        'compare_runs': compare_runs
+    }
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
+    parser.add_argument('-s', '--scales', type=str, nargs='+', default=default_scales)
+    parser.add_argument('-l', '--df-labels', type=str, nargs='+', default=df_labels)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--seed', type=int, default=default_seed)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--only', type=str, nargs='+', default=None)
+    parser.add_argument('--skip-preprocess', action='store_true')
+    parser.add_argument('--bench-path', type=str, default=default_bench_path)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--threshold', type=float, default=default_threshold)
+    args = parser.parse_args()
+    for command in args.commands:
+        FMAP.get(command, lambda **_: print("Function has not been found"))(
+            scales=args.scales,
+            df_labels=args.df_labels,
+            size_mb=args.size_mb,
+            workers=args.workers,
+            seed=args.seed,
+            repeat=args.repeat,
+            only=args.only,
+            skip_preprocess=args.skip_preprocess,
+            bench_path=args.bench_path,
+            baseline=args.baseline,
+            threshold=args.threshold
+        )
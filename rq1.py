@@ -2,323 +2,610 @@ from shared import *
 import argparse
 
 
+class UniqueEventsTypes(Analysis):
+    # Take only needed columns such as 'event_type'
+    dtype = {'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.events_types = StreamingAggregator(['event_type'])
+
+    def update(self, chunk):
+        self.events_types.update(chunk)
+
+    def finalize(self):
+        events_types = sorted(self.events_types.finalize().index.to_list())
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}got the following options as an event_type: "
+            f"{events_types}"
+        )
+        return events_types
+
+
 def get_unique_events_types(
         df_label: str = default_file_label,
         aws: bool = default_aws,
         size_mb: float = deafult_size_mb,
         nrows: int = default_nrows,
+        workers: int = default_workers,
 ):
-    # Take only needed columns such as 'event_type'
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['event_type'],
-        dtype={'event_type': str}
-    )
-    events_types = list()
-    for chunk in reader:
-        # print(".", end="")
-        events_types += list(chunk['event_type'].unique())
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}got the following options as an event_type: "
-        f"{sorted(list(set(events_types)))}"
-    )
+    return run_analyses(
+        [UniqueEventsTypes(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
 
 
-def get_complete_funnels_rate(
-        df_label: str = default_file_label,
-        aws: bool = default_aws,
-        size_mb: float = deafult_size_mb,
-        nrows: int = default_nrows
-):
+class CompleteFunnelsRate(Analysis):
     # Take only needed columns such as 'user_session', 'product_id', 'event_time'
     # product_id: np.uint16 ~ [0, 4294967295] | could take less space if would have been normalized
     # dataset have been already sorted by event_time, we can skip uploading that column
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['user_session', 'product_id', 'event_type'],
-        dtype={'user_session': str, 'product_id': np.uint32, 'event_type': str}
-    )
-    events_handler = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
+    dtype = {'user_session': session_codes_dtype, 'product_id': np.uint32, 'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.events_handler = StreamingAggregator(['user_session', 'product_id', 'event_type'])
+
+    def update(self, chunk):
         # group by and count events of both types 'view' and 'purchase'
-        events_operations = chunk[chunk['event_type'].isin(['view', 'purchase'])].groupby(
-            ['user_session', 'product_id', 'event_type']
-        ).event_type.count().to_frame().rename(
-            columns={'event_type': 'n_events'}
+        self.events_handler.update(chunk[chunk['event_type'].isin(['view', 'purchase'])])
+
+    def finalize(self):
+        events_handler = self.events_handler.finalize().reset_index()
+        # sum up and divide
+        complete_funnel = sum(events_handler['event_type'] == 'purchase')
+        product_user_pairs = sum(events_handler['event_type'] == 'view')
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}Complete funnels: "
+            f"{complete_funnel} out of {product_user_pairs}"
         )
-        if events_handler.empty:
-            events_handler = events_operations
-        else:
-            events_handler = events_handler.add(events_operations, fill_value=0).astype(np.uint32)
-    events_handler = events_handler.reset_index()
-    # sum up and divide
-    complete_funnel = sum(events_handler['event_type'] == 'purchase')
-    product_user_pairs = sum(events_handler['event_type'] == 'view')
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}Complete funnels: "
-        f"{complete_funnel} out of {product_user_pairs}"
-    )
-    rate = int(round(complete_funnel / product_user_pairs, 2) * 100) if product_user_pairs > 0 else 0
-    print(f"{df_label + ' | ' if df_label else ''}Rate of complete funnels: {rate}%")
+        rate = int(round(complete_funnel / product_user_pairs, 2) * 100) if product_user_pairs > 0 else 0
+        print(f"{self.df_label + ' | ' if self.df_label else ''}Rate of complete funnels: {rate}%")
+        return rate
 
 
-def most_repeated_operation(
+def get_complete_funnels_rate(
         df_label: str = default_file_label,
         aws: bool = default_aws,
         size_mb: float = deafult_size_mb,
-        nrows: int = default_nrows
+        nrows: int = default_nrows,
+        workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['user_session', 'event_type'],
-        dtype={'user_session': str, 'event_type': str}
-    )
-    sessions_handler = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
+    return run_analyses(
+        [CompleteFunnelsRate(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+class MostRepeatedOperation(Analysis):
+    dtype = {'user_session': session_codes_dtype, 'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.sessions_handler = StreamingAggregator(['user_session', 'event_type'])
+
+    def update(self, chunk):
         # group by session and event type, count events for each event type
-        session_operations = chunk.groupby(
-            ['user_session', 'event_type']
-        ).event_type.count().to_frame().rename(
-            columns={'event_type': 'n_events'}
-        )
+        self.sessions_handler.update(chunk)
+
+    def finalize(self):
         # important to fill with 0 absent events
-        session_operations = session_operations.reindex(
-            pd.MultiIndex.from_product(
-                [session_operations.index.levels[0], ['view', 'cart', 'purchase']],
-                names=['user_session', 'event_type']
-            ),
+        sessions_handler = self.sessions_handler.finalize().n_events.unstack(
             fill_value=0
+        ).reindex(columns=['view', 'cart', 'purchase'], fill_value=0).stack().rename('n_events').reset_index()
+        # Average number of times users perform each operation (within a session)
+        session_operations_avg = sessions_handler.groupby(
+            ['event_type']
+        ).n_events.mean().to_frame().reset_index().sort_values(by=['n_events'], ascending=False)
+        sns.set_style("white")
+        _, _ = plt.subplots(figsize=(15, 5))
+        plot = sns.barplot(data=session_operations_avg, x="event_type", y="n_events")
+        for p in plot.patches:
+            plot.annotate(
+                format(p.get_height(), ',.3f'),
+                (p.get_x() + p.get_width() / 2., p.get_height()),
+                ha='center',
+                va='center',
+                xytext=(0, 10),
+                textcoords='offset points'
+            )
+        plt.title(f"\n{self.df_label + ' | ' if self.df_label else ''}Number of events by type")
+        plt.xlabel('')
+        plt.ylabel('Number of events')
+        plt.ylim(0, session_operations_avg['n_events'].max() * 1.1)
+        # plt.savefig(get_most_repeated_operation_img_path(df_label=df_label))
+        plt.show()
+        return session_operations_avg
+
+
+def most_repeated_operation(
+        df_label: str = default_file_label,
+        aws: bool = default_aws,
+        size_mb: float = deafult_size_mb,
+        nrows: int = default_nrows,
+        workers: int = default_workers
+):
+    return run_analyses(
+        [MostRepeatedOperation(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+class AvgNOfViewsForViewCartFunnels(Analysis):
+    dtype = {'user_session': session_codes_dtype, 'product_id': np.uint32, 'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.events_handler = StreamingAggregator(['user_session', 'product_id', 'event_type'])
+
+    def update(self, chunk):
+        # group by user, product and event type, count events
+        self.events_handler.update(chunk[chunk['event_type'].isin(['view', 'cart'])])
+
+    def finalize(self):
+        # unstack event_type
+        events_handler = self.events_handler.finalize().unstack(level=-1)
+        events_handler.columns = events_handler.columns.droplevel()
+        # drop user-product pairs where product has not been added to a cart
+        events_handler = events_handler.dropna(subset=['cart'])
+        # fill missing view with 0
+        events_handler = events_handler.fillna(0).astype(np.uint32)
+        # calculate number of views per cart event for user-product pair and find mean
+        avg_n_times_viewed_before_cart = (events_handler.view / events_handler.cart).mean()
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}"
+            f"A user views a product before adding it to the cart in average "
+            f"{round(avg_n_times_viewed_before_cart, 3)} times"
         )
-        if sessions_handler.empty:
-            sessions_handler = session_operations
-        else:
-            sessions_handler = sessions_handler.add(session_operations, fill_value=0).astype(np.uint32)
-    sessions_handler = sessions_handler.reset_index()
-    # Average number of times users perform each operation (within a session)
-    session_operations_avg = sessions_handler.groupby(
-        ['event_type']
-    ).n_events.mean().to_frame().reset_index().sort_values(by=['n_events'], ascending=False)
-    sns.set_style("white")
-    _, _ = plt.subplots(figsize=(15, 5))
-    plot = sns.barplot(data=session_operations_avg, x="event_type", y="n_events")
-    for p in plot.patches:
-        plot.annotate(
-            format(p.get_height(), ',.3f'),
-            (p.get_x() + p.get_width() / 2., p.get_height()),
-            ha='center',
-            va='center',
-            xytext=(0, 10),
-            textcoords='offset points'
-        )
-    plt.title(f"\n{df_label + ' | ' if df_label else ''}Number of events by type")
-    plt.xlabel('')
-    plt.ylabel('Number of events')
-    plt.ylim(0, session_operations_avg['n_events'].max() * 1.1)
-    # plt.savefig(get_most_repeated_operation_img_path(df_label=df_label))
-    plt.show()
+        return avg_n_times_viewed_before_cart
 
 
 def get_avg_n_of_views_for_view_cart_funnels(
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['user_session', 'product_id', 'event_type'],
-        dtype={'user_session': str, 'product_id': np.uint32, 'event_type': str}
-    )
-    events_handler = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        # group by user, product and event type, count events
-        events_operations = chunk[chunk['event_type'].isin(['view', 'cart'])].groupby(
-            ['user_session', 'product_id', 'event_type']
-        ).event_type.count().to_frame().rename(
-            columns={'event_type': 'n_events'}
+    return run_analyses(
+        [AvgNOfViewsForViewCartFunnels(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+class ProbabilityThatIfInCartProductIsBought(Analysis):
+    dtype = {'user_session': session_codes_dtype, 'product_id': np.uint32, 'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.events_handler = StreamingAggregator(['user_session', 'product_id', 'event_type'])
+
+    def update(self, chunk):
+        self.events_handler.update(chunk[chunk['event_type'].isin(['purchase', 'cart'])])
+
+    def finalize(self):
+        # unstack event_type column
+        events_handler = self.events_handler.finalize().unstack(level=-1)
+        events_handler.columns = events_handler.columns.droplevel()
+        # drop user-product pairs where product has not been added to a cart
+        events_handler = events_handler.dropna(subset=['cart'])
+        # fill missing purchases with 0
+        events_handler = events_handler.fillna(0).astype(np.uint32)
+        # probability in frequency interpretation is the proportion of times that event occured
+        # we're insterested only in occurance of 'cart' and 'purchase' given 'cart' events
+        prob_if_in_cart_bought = events_handler.purchase.sum() / events_handler.cart.sum()
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}"
+            f"The probability that products added once to the cart are effectively bought "
+            f"{round(prob_if_in_cart_bought * 100)}%"
         )
-        if events_handler.empty:
-            events_handler = events_operations
-        else:
-            events_handler = events_handler.add(events_operations, fill_value=0).astype(np.uint32)
-    # unstack event_type
-    events_handler = events_handler.unstack(level=-1)
-    events_handler.columns = events_handler.columns.droplevel()
-    # drop user-product pairs where product has not been added to a cart
-    events_handler = events_handler.dropna(subset=['cart'])
-    # fill missing view with 0
-    events_handler = events_handler.fillna(0).astype(np.uint32)
-    # calculate number of views per cart event for user-product pair and find mean
-    avg_n_times_viewed_before_cart = (events_handler.view / events_handler.cart).mean()
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}"
-        f"A user views a product before adding it to the cart in average "
-        f"{round(avg_n_times_viewed_before_cart, 3)} times"
-    )
+        return prob_if_in_cart_bought
 
 
 def get_probability_that_if_in_cart_product_is_bought(
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['user_session', 'product_id', 'event_type'],
-        dtype={'user_session': str, 'product_id': np.uint32, 'event_type': str}
-    )
-    events_handler = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        events_operations = chunk[chunk['event_type'].isin(['purchase', 'cart'])].groupby(
-            ['user_session', 'product_id', 'event_type']
-        ).event_type.count().to_frame().rename(
-            columns={'event_type': 'n_events'}
+    return run_analyses(
+        [ProbabilityThatIfInCartProductIsBought(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+def get_pair_keys(chunk: pd.DataFrame, cols: list = ('user_session', 'product_id')) -> np.ndarray:
+    """
+    Function packing a pair of uint32 columns (session codes, user or product ids) into uint64 keys
+    """
+    keys = chunk[cols[0]].values.astype(np.uint64)
+    if len(cols) > 1:
+        keys = (keys << np.uint64(32)) | chunk[cols[1]].values.astype(np.uint64)
+    return keys
+
+
+def get_event_seconds(chunk: pd.DataFrame) -> np.ndarray:
+    return chunk['event_time'].values.astype('datetime64[s]').astype(np.int64)
+
+
+# Events of a user-product pair more than that apart (seconds) can be taken as different visits, so that pairs
+# inactive for longer are dropped from the state of the timing analyses: None (the default) never splits pairs,
+# which gives the same results as a computation over the whole file
+pair_timeout_seconds = None
+no_time = np.iinfo(np.int64).min
+
+
+def lookup_open(open_keys: np.ndarray, keys: np.ndarray, *values) -> tuple:
+    """
+    Function looking up keys in sorted keys of a state: returns a found mask and values of the (first) entry
+    of every key (garbage where it is not found)
+    """
+    if not len(open_keys):
+        return (np.zeros(len(keys), dtype=bool),) + tuple(np.zeros(len(keys), dtype=v.dtype) for v in values)
+    positions = np.minimum(np.searchsorted(open_keys, keys), len(open_keys) - 1)
+    return (open_keys[positions] == keys,) + tuple(v[positions] for v in values)
+
+
+class OpenPairs:
+    """
+    Rows of the user-product pairs left open by previous chunks, kept in runs sorted by pair key:
+    every chunk adds a run replacing the rows of the pairs it touched (a pair without rows is closed) and a run
+    is merged with the previous one once it is as large, so a chunk costs about its own size instead of the
+    size of the whole state, and rows of replaced or closed pairs are dropped by merges
+    """
+
+    def __init__(self, *dtypes):
+        self.dtypes = dtypes
+        # runs from the oldest (and largest) one: sorted keys, whether rows are open (a closed pair has a single
+        # row hiding the rows of older runs) and values of rows (in order of arrival within a pair)
+        self.runs = list()
+
+    def __len__(self):
+        return sum(len(run[0]) for run in self.runs)
+
+    def get(self, keys: np.ndarray) -> tuple:
+        """
+        Open rows of the pairs of sorted unique keys: keys of rows (sorted, in order of arrival within a pair)
+        and their values
+        """
+        parts = [[np.zeros(0, dtype=np.uint64)] + [np.zeros(0, dtype=dtype) for dtype in self.dtypes]]
+        unseen = np.ones(len(keys), dtype=bool)
+        for run_keys, run_open, *run_values in reversed(self.runs):
+            starts, ends = np.searchsorted(run_keys, keys), np.searchsorted(run_keys, keys, side='right')
+            # the newest run holding a pair has its rows
+            found = unseen & (ends > starts)
+            unseen &= ~found
+            counts = (ends - starts)[found]
+            rows = np.repeat(starts[found] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            rows = rows[run_open[rows]]
+            parts.append([run_keys[rows]] + [values[rows] for values in run_values])
+        columns = [np.concatenate(column) for column in zip(*parts)]
+        order = np.argsort(columns[0], kind='stable')
+        return tuple(column[order] for column in columns)
+
+    def put(self, keys: np.ndarray, row_keys: np.ndarray, *values, expire: tuple = None):
+        """
+        Replace the rows of the pairs of sorted unique keys with rows sorted by key (pairs without rows are closed),
+        expire=(i, threshold) closes pairs whose i-th value is below threshold when runs are merged
+        """
+        closed = keys[~np.isin(keys, row_keys)]
+        columns = [np.concatenate([row_keys, closed]), np.arange(len(row_keys) + len(closed)) < len(row_keys)] + [
+            np.concatenate([column, np.zeros(len(closed), dtype=column.dtype)]) for column in values
+        ]
+        # merge runs once they are as large as the previous one: every row is merged about log(state/chunk) times
+        while self.runs and len(columns[0]) >= len(self.runs[-1][0]):
+            older = self.runs.pop()
+            replaced = np.isin(older[0], columns[0])
+            columns = [np.concatenate([old[~replaced], new]) for old, new in zip(older, columns)]
+            if expire is not None:
+                columns[1] &= columns[expire[0] + 2] >= expire[1]
+        if not self.runs:
+            # closed pairs only hide rows of older runs
+            columns = [column[columns[1]] for column in columns]
+        order = np.argsort(columns[0], kind='stable')
+        self.runs.append(tuple(column[order] for column in columns))
+
+
+class AvgTimeFromCartToPurchase(Analysis):
+    dtype = {'user_session': session_codes_dtype, 'product_id': np.uint32, 'event_type': str, 'event_time': str}
+    # unmatched events are carried over to the following chunks
+    mergeable = False
+    parse_event_time = True
+
+    def __init__(
+        self,
+        df_label: str = default_file_label,
+        quantiles: tuple = (0.5, 0.95),
+        pair_timeout: int = pair_timeout_seconds
+    ):
+        super().__init__(df_label=df_label)
+        # running sum and count of delta, and optionally a sketch to estimate quantiles
+        self.n_deltas, self.sum_deltas = 0, 0
+        self.quantiles = quantiles
+        self.sketch = QuantileSketch() if quantiles else None
+        self.pair_timeout = pair_timeout
+        # carts and purchases of user-product pairs still waiting for a counterpart (in order of arrival within
+        # a pair): whether they are purchases, their time and the time of the last event of their pair
+        self.open_pairs = OpenPairs(bool, np.int64, np.int64)
+
+    def update(self, chunk):
+        # filter only 'purchase' and 'cart' events (in case we'd have 'remove' type we could consider it)
+        chunk = chunk[chunk['event_type'].isin(['purchase', 'cart'])]
+        if chunk.empty:
+            return
+        keys, times = get_pair_keys(chunk), get_event_seconds(chunk)
+        purchases = chunk['event_type'].values == 'purchase'
+        order = np.argsort(keys, kind='stable')
+        keys, times, purchases = keys[order], times[order], purchases[order]
+        first = np.r_[True, keys[1:] != keys[:-1]]
+        pair_starts = np.flatnonzero(first)
+        pair_keys = keys[pair_starts]
+        open_keys, open_purchases, open_times, open_last = self.open_pairs.get(pair_keys)
+        in_state, last = lookup_open(open_keys, keys, open_last)
+        new_visit = first & ~in_state
+        if self.pair_timeout is not None:
+            # a visit of a pair starts after an inactivity longer than pair_timeout
+            previous = np.where(first, last, np.r_[0, times[:-1]])
+            new_visit |= ~new_visit & (times - previous > self.pair_timeout)
+        visits = np.cumsum(first | new_visit)
+        # put in front the events of the same visits still waiting for a counterpart (older visits never match)
+        continued = np.isin(open_keys, keys[first & ~new_visit])
+        open_visits = visits[pair_starts][np.searchsorted(pair_keys, open_keys[continued])]
+        keys = np.r_[open_keys[continued], keys]
+        purchases = np.r_[open_purchases[continued], purchases]
+        times = np.r_[open_times[continued], times]
+        visits = np.r_[open_visits, visits]
+        # the n-th cart of a visit goes with its n-th purchase (ranks within visit and event type, in arrival order)
+        order = np.lexsort((np.arange(len(keys)), purchases, visits))
+        group_starts = np.flatnonzero(np.r_[
+            True, (visits[order][1:] != visits[order][:-1]) | (purchases[order][1:] != purchases[order][:-1])
+        ])
+        ranks = np.empty(len(keys), dtype=np.int64)
+        ranks[order] = np.arange(len(keys)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(keys)]))
+        # a cart is followed by the purchase of the same visit and rank when there is one
+        order = np.lexsort((purchases, ranks, visits))
+        pairs = (visits[order[:-1]] == visits[order[1:]]) & (ranks[order[:-1]] == ranks[order[1:]])
+        carts, bought = order[:-1][pairs], order[1:][pairs]
+        matched = np.zeros(len(keys), dtype=bool)
+        matched[carts] = matched[bought] = True
+        # convert time difference into seconds (as .dt.seconds of the difference)
+        delta = np.mod(times[bought] - times[carts], 24 * 3600)
+        # record all delta
+        self.n_deltas += len(delta)
+        self.sum_deltas += int(delta.sum())
+        if self.sketch is not None:
+            self.sketch.update(delta)
+        # events of the last visit of their pair without a counterpart yet wait for the following chunks
+        pair_ends = np.r_[pair_starts[1:], len(first)] - 1 + len(open_visits)
+        pairs_index = np.searchsorted(pair_keys, keys)
+        still_open = ~matched & (visits == visits[pair_ends][pairs_index])
+        order = np.argsort(keys[still_open], kind='stable')
+        self.open_pairs.put(
+            pair_keys,
+            keys[still_open][order],
+            purchases[still_open][order],
+            times[still_open][order],
+            times[pair_ends][pairs_index][still_open][order],
+            # pairs inactive for longer than pair_timeout can not be matched anymore
+            expire=None if self.pair_timeout is None else (2, times.max() - self.pair_timeout)
         )
-        if events_handler.empty:
-            events_handler = events_operations
-        else:
-            events_handler = events_handler.add(events_operations, fill_value=0).astype(np.uint32)
-    # unstack event_type column
-    events_handler = events_handler.unstack(level=-1)
-    events_handler.columns = events_handler.columns.droplevel()
-    # drop user-product pairs where product has not been added to a cart
-    events_handler = events_handler.dropna(subset=['cart'])
-    # fill missing purchases with 0
-    events_handler = events_handler.fillna(0).astype(np.uint32)
-    # probability in frequency interpretation is the proportion of times that event occured
-    # we're insterested only in occurance of 'cart' and 'purchase' given 'cart' events
-    prob_if_in_cart_bought = events_handler.purchase.sum() / events_handler.cart.sum()
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}"
-        f"The probability that products added once to the cart are effectively bought "
-        f"{round(prob_if_in_cart_bought * 100)}%"
-    )
+
+    def finalize(self):
+        # calculate mean of all delta
+        avg_time_from_cart_to_purchase = self.sum_deltas / self.n_deltas if self.n_deltas else np.nan
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}"
+            f"The average time an item stays in the cart before being purchased "
+            f"{pd.to_timedelta(avg_time_from_cart_to_purchase, unit='s')}"
+        )
+        for q in self.quantiles or list():
+            print(
+                f"{self.df_label + ' | ' if self.df_label else ''}"
+                f"{int(q * 100)}th percentile of the time an item stays in the cart "
+                f"{pd.to_timedelta(round(self.sketch.quantile(q)), unit='s')}"
+            )
+        return avg_time_from_cart_to_purchase
 
 
 def get_avg_time_from_cart_to_purchase(
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    quantiles: tuple = (0.5, 0.95),
+    pair_timeout: int = pair_timeout_seconds
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['event_time', 'event_type', 'product_id', 'user_session'],
-        dtype={'user_session': str, 'product_id': np.uint32, 'event_type': str, 'event_time': str}
-    )
-    time_from_cart_to_purchase_list = list()
-    for chunk in reader:
-        print(".", end="")
-        # filter only 'purchase' and 'view' events (in case we'd have 'remove' type we could consider it)
-        chunk = chunk[chunk['event_type'].isin(['purchase', 'cart'])]
-        # drop timezone
-        chunk['event_time'] = pd.to_datetime(chunk['event_time']).dt.tz_convert(None)
-        # add fake key in case of duplicates (several purchases/cart events per session)
-        chunk['key'] = chunk.groupby(["user_session", "product_id", "event_type"]).cumcount()
-        #  create pivot table
-        chunk = chunk.pivot_table(
-            index=["user_session", "product_id", "key"],
-            columns=["event_type"],
-            values=["event_time"],
-            aggfunc='max'
+    return run_analyses(
+        [AvgTimeFromCartToPurchase(df_label=df_label, quantiles=quantiles, pair_timeout=pair_timeout)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+class AvgTimeFromFirstViewToAnotherEvent(Analysis):
+    dtype = {'user_session': session_codes_dtype, 'product_id': np.uint32, 'event_type': str, 'event_time': str}
+    # pairs with views not followed yet by another event are carried over to the following chunks
+    mergeable = False
+    parse_event_time = True
+
+    def __init__(self, df_label: str = default_file_label, pair_timeout: int = pair_timeout_seconds):
+        super().__init__(df_label=df_label)
+        self.n_deltas, self.sum_deltas = 0, 0
+        self.pair_timeout = pair_timeout
+        # user-product pairs whose last events are views: time of the first of those views
+        # and time of the last event of the pair
+        self.open_pairs = OpenPairs(np.int64, np.int64)
+
+    def update(self, chunk):
+        chunk = chunk[chunk['event_type'].isin(['view', 'cart', 'purchase'])]
+        if chunk.empty:
+            return
+        # events which are not 'view' are goals (a purchase or an addition to cart)
+        keys, times = get_pair_keys(chunk), get_event_seconds(chunk)
+        goals = chunk['event_type'].values != 'view'
+        # Important: sort data as the order matters (views first at the same time)
+        order = np.lexsort((goals, times, keys))
+        keys, times, goals = keys[order], times[order], goals[order]
+        first = np.r_[True, keys[1:] != keys[:-1]]
+        pair_keys = keys[first]
+        # pairs left open by previous chunks act as a view in front of their rows
+        open_keys, open_first, open_last = self.open_pairs.get(pair_keys)
+        is_open, open_first, open_last = lookup_open(open_keys, keys, open_first, open_last)
+        previous_goals = np.where(first, False, np.r_[False, goals[:-1]])
+        new_visit = first & ~is_open
+        if self.pair_timeout is not None:
+            # a visit of a pair starts after an inactivity longer than pair_timeout
+            previous = np.where(first, open_last, np.r_[0, times[:-1]])
+            new_visit |= ~new_visit & (times - previous > self.pair_timeout)
+        # keep only rows where the visit or event type changes, it allows us to keep the first view
+        # and the first goal following it
+        kept = np.flatnonzero(new_visit | (goals != previous_goals))
+        kept_first = np.r_[True, keys[kept][1:] != keys[kept][:-1]][:len(kept)]
+        # a goal follows the previous kept row of its visit (a view) or the open view of its pair
+        first_views = np.where(kept_first, open_first[kept], np.r_[0, times[kept][:-1]])
+        # calculate time difference (as .dt.seconds of the difference)
+        delta = np.mod(times[kept] - first_views, 24 * 3600)
+        # take results for view -> goal within the same visit and add them up
+        delta = delta[goals[kept] & ~new_visit[kept] & (delta > 0)]
+        self.n_deltas += len(delta)
+        self.sum_deltas += int(delta.sum())
+        # pairs ending with views are still open: a later purchase/addition to cart completes them,
+        # pairs ending with goals are closed, pairs without kept rows (only views of an open pair) are unchanged
+        kept_last = kept[np.r_[kept_first[1:], True][:len(kept)]]
+        pairs_index = np.cumsum(first) - 1
+        pair_open, pair_first = is_open[first], open_first[first]
+        pair_open[pairs_index[kept_last]] = ~goals[kept_last]
+        pair_first[pairs_index[kept_last]] = times[kept_last]
+        self.open_pairs.put(
+            pair_keys,
+            pair_keys[pair_open],
+            pair_first[pair_open],
+            times[np.r_[first[1:], True]][pair_open],
+            # pairs inactive for longer than pair_timeout can not be completed anymore
+            expire=None if self.pair_timeout is None else (1, times.max() - self.pair_timeout)
         )
-        chunk.columns = chunk.columns.droplevel()
-        # convert time difference into seconds
-        chunk['delta'] = (chunk.purchase - chunk.cart).dt.seconds
-        # keep only rows where we actually can calculate the difference
-        chunk = chunk.dropna()
-        # record all delta
-        chunk['delta'] = chunk['delta'].astype(int).apply(lambda x: [x])
-        chunk = chunk.drop(columns=['cart', 'purchase']).groupby(
-            ['user_session', 'product_id']
-        ).delta.sum().to_list()  # sum appends to array
-        chunk = itertools.chain.from_iterable(chunk)
-        time_from_cart_to_purchase_list.extend(chunk)
-    # calculate mean of all delta
-    avg_time_from_cart_to_purchase = np.array(time_from_cart_to_purchase_list).mean()
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}"
-        f"The average time an item stays in the cart before being purchased "
-        f"{pd.to_timedelta(avg_time_from_cart_to_purchase, unit='s')}"
-    )
+
+    def finalize(self):
+        # calculate mean of all delta
+        avg_time_from_cart_to_another_event = self.sum_deltas / self.n_deltas if self.n_deltas else np.nan
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}"
+            f"The average time between the first view time and a purchase/addition to cart "
+            f"{pd.to_timedelta(avg_time_from_cart_to_another_event, unit='s')}"
+        )
+        return avg_time_from_cart_to_another_event
 
 
 def get_avg_time_from_first_view_to_another_event(
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    pair_timeout: int = pair_timeout_seconds
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['event_time', 'event_type', 'product_id', 'user_session'],
-        dtype={'user_session': str, 'product_id': np.uint32, 'event_type': str, 'event_time': str}
-    )
-    time_from_view_to_another_event_list = list()
-    for chunk in reader:
-        print(".", end="")
-        # drop timezone
-        chunk['event_time']=pd.to_datetime(chunk['event_time']).dt.tz_convert(None)
-        # replace events which are not 'view' = 0 with new category 'goal' = 1
-        chunk.loc[:, 'event_type'] = chunk['event_type'].map({'purchase': 1, 'cart': 1, 'view': 0})
-        # sort data as the order matters
-        chunk = chunk.sort_values(
-            by=['user_session', 'product_id', 'event_time', 'event_type']
-        ).set_index(['user_session', 'product_id'])
-        # take only records where there are '1' events
-        chunk = chunk.loc[chunk[chunk.event_type > 0].index, :].drop_duplicates()
-        # take only records where there are also '0 events
-        chunk = chunk.loc[chunk[chunk.event_type == 0].index, :].drop_duplicates().reset_index()
-        # remap user_session categories to make them numerical
-        mapper = {v: i for i, v in enumerate(chunk.user_session.unique())}
-        chunk = chunk.replace({"user_session": mapper})
-        # Important: sort data as the order matters
-        chunk = chunk.sort_values(by=['user_session', 'product_id', 'event_time', 'event_type'])
-        # keep only rows where either user_session or product_id or event_type changes
-        # it allows us to keep the first view
-        # and the first change followed by that view
-        chunk = chunk.loc[
-            (chunk[['event_type', 'product_id', 'user_session']].diff().fillna(-1) != 0).any(axis=1), :
-        ].set_index(['user_session', 'product_id'])
-        # calculate time difference
-        chunk['delta'] = chunk.event_time.diff().dt.seconds
-        # take results for '0' -> '1' and save in the array
-        time_from_view_to_another_event_list.extend(
-            chunk.loc[(chunk.event_type == 1) & (chunk.delta > 0), :].delta.to_list()
-        )
-    # calculate mean of all delta
-    avg_time_from_cart_to_another_event = np.array(time_from_view_to_another_event_list).mean()
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}"
-        f"The average time between the first view time and a purchase/addition to cart "
-        f"{pd.to_timedelta(avg_time_from_cart_to_another_event, unit='s')}"
-    )
+    return run_analyses(
+        [AvgTimeFromFirstViewToAnotherEvent(df_label=df_label, pair_timeout=pair_timeout)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+# Columns identifying the groups of events a funnel is followed within
+funnel_keys = {
+    'session': ['user_session'],
+    'session_product': ['user_session', 'product_id'],
+    'user': ['user_id'],
+    'user_product': ['user_id', 'product_id']
+}
+funnel_dtype = {'user_session': session_codes_dtype, 'user_id': np.uint32, 'product_id': np.uint32}
+
+
+def parse_window(value) -> int:
+    """
+    Function parsing a time window given as seconds (e.g. 3600) or as a pandas timedelta (e.g. '1h', '30min')
+    """
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(pd.Timedelta(value).total_seconds())
+
+
+class Funnel(Analysis):
+    """
+    Ordered funnel of any event types (e.g. view -> cart -> purchase) within sessions, users
+    or user-product pairs (see funnel_keys), optionally with a time window from the first to the last step
+    """
+    # chains of events go over chunk boundaries
+    mergeable = False
+
+    def __init__(
+        self,
+        df_label: str = default_file_label,
+        steps: tuple = ('view', 'cart', 'purchase'),
+        window: int = None,
+        key: str = 'session'
+    ):
+        super().__init__(df_label=df_label)
+        if key not in funnel_keys:
+            raise ValueError(f"Key '{key}' is not supported, use one of {list(funnel_keys)}")
+        self.steps = tuple(steps)
+        self.window = window
+        self.key = key
+        # event_time is read only when there is a time window
+        self.dtype = {col: funnel_dtype[col] for col in funnel_keys[key]}
+        self.dtype.update({'event_type': str, **({'event_time': str} if window is not None else {})})
+        self.parse_event_time = window is not None
+        self.event_types = set(self.steps)
+        self.funnel = FunnelCounter(self.steps, window=window)
+
+    def update(self, chunk):
+        cols = funnel_keys[self.key]
+        # a single uint64 key per group, pairs are packed as two uint32
+        keys = get_pair_keys(chunk, cols)
+        times = get_event_seconds(chunk) if self.window is not None else None
+        self.funnel.update(keys, chunk['event_type'].values, times)
+
+    def finalize(self):
+        funnel = self.funnel.finalize()
+        label = self.df_label + ' | ' if self.df_label else ''
+        window = f" within {pd.to_timedelta(self.window, unit='s')}" if self.window is not None else ''
+        print(f"\n{label}Funnel {' -> '.join(self.steps)} by {self.key.replace('_', '-')}{window}")
+        for i, row in funnel.iterrows():
+            print(
+                f"{label}{i + 1}. {row['step']}: {row['n_groups']}"
+                + (f" ({round(row['step_conversion'] * 100, 2)}% of the previous step, "
+                   f"{round(row['total_conversion'] * 100, 2)}% of the first)" if i else '')
+            )
+        return funnel
+
+
+def get_funnel(
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    steps: tuple = ('view', 'cart', 'purchase'),
+    window: int = None,
+    key: str = 'session'
+):
+    return run_analyses(
+        [Funnel(df_label=df_label, steps=steps, window=window, key=key)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+# Analyses which can share a single scan of a file
+analyses_map = {
+    'get_unique_events_types': UniqueEventsTypes,
+    'get_complete_funnels_rate': CompleteFunnelsRate,
+    'most_repeated_operation': MostRepeatedOperation,
+    'get_avg_n_of_views_for_view_cart_funnels': AvgNOfViewsForViewCartFunnels,
+    'get_probability_that_if_in_cart_product_is_bought': ProbabilityThatIfInCartProductIsBought,
+    'get_avg_time_from_cart_to_purchase': AvgTimeFromCartToPurchase,
+    'get_avg_time_from_first_view_to_another_event': AvgTimeFromFirstViewToAnotherEvent,
+    'get_funnel': Funnel
+}
 
 
 if __name__ == '__main__':
@@ -330,17 +617,37 @@ if __name__ == '__main__':
         'get_avg_n_of_views_for_view_cart_funnels': get_avg_n_of_views_for_view_cart_funnels,
         'get_probability_that_if_in_cart_product_is_bought': get_probability_that_if_in_cart_product_is_bought,
         'get_avg_time_from_cart_to_purchase': get_avg_time_from_cart_to_purchase,
-        'get_avg_time_from_first_view_to_another_event': get_avg_time_from_first_view_to_another_event
+        'get_avg_time_from_first_view_to_another_event': get_avg_time_from_first_view_to_another_event,
+        'get_funnel': get_funnel
     }
-    parser.add_argument('command', choices=FMAP.keys())
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
     parser.add_argument('-l', '--df-label', type=str, default=default_file_label)
     parser.add_argument('--aws', type=float, default=default_aws)
-    parser.add_argument('-mb', '--size-mb', type=float, default=deafult_size_mb)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
     parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--steps', type=str, nargs='+', default=['view', 'cart', 'purchase'])
+    parser.add_argument('--window', type=parse_window, default=None)
+    parser.add_argument('--funnel-key', type=str, choices=funnel_keys.keys(), default='session')
+    parser.add_argument('--pair-timeout', type=parse_window, default=pair_timeout_seconds)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
     args = parser.parse_args()
-    FMAP.get(args.command, lambda _: print("Function has not been found"))(
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    run_commands(
+        args.commands,
+        FMAP,
+        analyses_map,
         df_label=args.df_label,
         aws=args.aws,
         size_mb=args.size_mb,
-        nrows=args.nrows
+        nrows=args.nrows,
+        workers=args.workers,
+        steps=tuple(args.steps),
+        window=args.window,
+        key=args.funnel_key,
+        pair_timeout=args.pair_timeout
     )
@@ -26,63 +26,112 @@ def show_values_on_bars(axs, h_v="v", space=0.4):
         _show_on_single_plot(axs)
 
 
+class MostTrendingProducts(Analysis):
+    dtype = {'category_id': np.int64, 'event_type': str}
+
+    def __init__(self, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.most_trending_products = StreamingAggregator(['category'], {'n_purchases': (None, 'count')})
+
+    def update(self, chunk):
+        purchases = chunk[chunk['event_type'].values == 'purchase']
+        # take only the category, missing category_code is filled by the category index
+        categories = self.category_index.get_codes(purchases['category_id'].values, depth=0)
+        # count number of purchases per known category
+        self.most_trending_products.update(pd.DataFrame({'category': categories[categories >= 0]}))
+
+    def finalize(self):
+        most_trending_products = self.most_trending_products.finalize().reset_index()
+        most_trending_products['category'] = self.category_index.get_names(most_trending_products['category'])
+        most_trending_products.rename(columns={'category': 'category_code'}, inplace=True)
+        # sort in descending order
+        most_trending_products.sort_values(by=['n_purchases'], ascending=False, inplace=True)
+        # plot results
+        sns.set_style("whitegrid")
+        fig, ax = plt.subplots(figsize=(15, 10))
+        _ = sns.barplot(data=most_trending_products, x="n_purchases", y="category_code", palette='tab10')
+        plt.xlabel('Number of purchases')
+        plt.ylabel('Category')
+        plt.title(f"{self.df_label + ': ' if self.df_label else ''}Number of sold products per category")
+        plt.xlim(0, most_trending_products['n_purchases'].max() * 1.05)
+        show_values_on_bars(ax, "h", 0.3)
+        plt.show()
+        return most_trending_products
+
+
 def get_most_trending_products(
         df_label: str = default_file_label,
         aws: bool = default_aws,
         size_mb: float = deafult_size_mb,
-        nrows: int = default_nrows
+        nrows: int = default_nrows,
+        workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['category_code', 'event_type'],
-        dtype={'category_code': str, 'event_type': str}
-    )
-    most_trending_products = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        # take only the category
-        chunk.loc[:, 'category_code'] = chunk.category_code.str.split('.').str[0].str.strip()
-        # consider only purchases for known categories
-        # we could also preprocess the data to match
-        # missing category_code with known category_code for the same category_id
-        events_operations = chunk[
-            chunk['event_type'].str.contains(pat='purchase') & ~(chunk['category_code'] == '')
-            ].groupby(
-            ['category_code']
-        ).event_type.count().to_frame().rename(  # count number of purchases per category
-            columns={'event_type': 'n_purchases'}
-        )
-        if most_trending_products.empty:
-            most_trending_products = events_operations
-        else:
-            # summing up results for number of purchases per category
-            most_trending_products = most_trending_products.add(events_operations, fill_value=0).astype(np.uint32)
-    most_trending_products.reset_index(inplace=True)
-    # sort in descending order
-    most_trending_products.sort_values(by=['n_purchases'], ascending=False, inplace=True)
-    # plot results
-    sns.set_style("whitegrid")
-    fig, ax = plt.subplots(figsize=(15, 10))
-    _ = sns.barplot(data=most_trending_products, x="n_purchases", y="category_code", palette='tab10')
-    plt.xlabel('Number of purchases')
-    plt.ylabel('Category')
-    plt.title(f"{df_label + ': ' if df_label else ''}Number of sold products per category")
-    plt.xlim(0, most_trending_products['n_purchases'].max() * 1.05)
-    show_values_on_bars(ax, "h", 0.3)
-    plt.show()
+    return run_analyses(
+        [MostTrendingProducts(df_label=df_label, aws=aws)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
+
+
+class PurchasesPerCategoryCode(Analysis):
+    """
+    Number of purchases per (full) category_code, the same as 'RQ2.sh' used to count
+    """
+    dtype = {'event_type': str, 'category_code': str}
+    event_types = {'purchase'}
+
+    def __init__(self, df_label: str = default_file_label):
+        super().__init__(df_label=df_label)
+        self.purchases_per_category = StreamingAggregator(['category'], {'n_purchases': (None, 'count')})
+
+    def update(self, chunk):
+        purchases = chunk[(chunk['event_type'].values == 'purchase') & (chunk['category_code'].values != '')]
+        self.purchases_per_category.update(pd.DataFrame({'category': purchases['category_code'].values}))
+
+    def finalize(self):
+        purchases_per_category = self.purchases_per_category.finalize().reset_index()
+        purchases_per_category.sort_values(by='category', inplace=True)
+        purchases_per_category.to_csv(get_rq2_path(df_label=self.df_label), index=False)
+        return purchases_per_category
+
+
+def get_rq2_path(df_label: str = default_file_label):
+    """
+    Function to retrieve by a label the path of the purchases per category file ('RQ2.sh' output)
+    """
+    return f"datasets/{df_label}.csv.rq2.csv"
+
+
+def prepare_most_trending_products_with_bash(
+        df_label: str = default_file_label,
+        aws: bool = default_aws,
+        size_mb: float = deafult_size_mb,
+        nrows: int = default_nrows,
+        workers: int = default_workers,
+        **kwargs
+):
+    """
+    Function writing the number of purchases per category to *.rq2.csv with a single pass
+    over the file (or over its first nrows rows), it is called by 'RQ2.sh'
+    """
+    return run_analyses(
+        [PurchasesPerCategoryCode(df_label=df_label)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
 
 
 def get_most_trending_products_with_bash(df_label: str = default_file_label, **kwargs):
     """
     Files in purchases folder are created by 'RQ2.sh' script
-    script can be found
+    script can be found, missing or outdated files are prepared right away
+    (as well as files of the first nrows rows, when nrows is given)
     """
-    most_trending_products_df = pd.read_csv(
-        f"datasets/{df_label}.csv.rq2.csv"
-    )
+    rq2_path, file_path = get_rq2_path(df_label=df_label), get_file_path(df_label=df_label)
+    if kwargs.get('nrows') is not None or not os.path.exists(rq2_path) or (
+        os.path.exists(file_path) and os.path.getmtime(rq2_path) < os.path.getmtime(file_path)
+    ):
+        prepare_most_trending_products_with_bash(df_label=df_label, **kwargs)
+    most_trending_products_df = pd.read_csv(rq2_path)
     # split categories from sub categories (leave only categories)
     most_trending_products_df.loc[:, 'category'] = \
         most_trending_products_df['category'].str.split('.').str[0]
@@ -103,100 +152,91 @@ def get_most_trending_products_with_bash(df_label: str = default_file_label, **k
     plt.show()
 
 
+class MostVisitedSubCategories(Analysis):
+    dtype = {'category_id': np.int64, 'event_type': str}
+
+    def __init__(
+        self, df_label: str = default_file_label, top_n: int = 10, n_sub_categories: int = None, aws: bool = default_aws
+    ):
+        super().__init__(df_label=df_label, aws=aws)
+        self.top_n = top_n
+        self.n_sub_categories = n_sub_categories
+        # take n_sub_categories sub categories (at least one), the whole category_code otherwise
+        self.depth = max(1, n_sub_categories) if n_sub_categories is not None and n_sub_categories > 0 else None
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.most_visited_sub_categories = StreamingAggregator(['category'], {'n_visits': (None, 'count')})
+
+    def update(self, chunk):
+        views = chunk[chunk['event_type'].values == 'view']
+        sub_categories = self.category_index.get_codes(views['category_id'].values, depth=self.depth)
+        self.most_visited_sub_categories.update(pd.DataFrame({'category': sub_categories[sub_categories >= 0]}))
+
+    def finalize(self):
+        top_n = self.top_n
+        most_visited_sub_categories = self.most_visited_sub_categories.finalize().reset_index()
+        most_visited_sub_categories['category'] = self.category_index.get_names(
+            most_visited_sub_categories['category'], depth=self.depth
+        )
+        most_visited_sub_categories.rename(columns={'category': 'category_code'}, inplace=True)
+        # sort in descending order
+        most_visited_sub_categories.sort_values(by=['n_visits'], ascending=False, inplace=True)
+        if top_n is not None and top_n > 0:
+            most_visited_sub_categories = most_visited_sub_categories.iloc[:top_n, :]
+        # plot results
+        sns.set_style("whitegrid")
+        fig, ax = plt.subplots(figsize=(15, 10 if top_n is not None else 25))
+        _ = sns.barplot(data=most_visited_sub_categories, x="n_visits", y="category_code", palette='tab10')
+        plt.xlabel('Number of visits')
+        plt.ylabel('Category')
+        plt.title(
+            f"{self.df_label + ': ' if self.df_label else ''}Number of visits per sub category "
+            f"{'| top #' + str(top_n) + ' sub categories' if top_n is not None else ''}"
+        )
+        plt.xlim(0, most_visited_sub_categories['n_visits'].max() * 1.05)
+        show_values_on_bars(ax, "h", 0.3)
+        plt.show()
+        return most_visited_sub_categories
+
+
 def get_most_visited_sub_categories(
         df_label: str = default_file_label,
         aws: bool = default_aws,
         size_mb: float = deafult_size_mb,
         nrows: int = default_nrows,
+        workers: int = default_workers,
         top_n: int = 10,
         n_sub_categories: int = None
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['category_code', 'event_type'],
-        dtype={'category_code': str, 'event_type': str}
-    )
-    most_visited_sub_categories = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        events_operations = chunk[
-            chunk['event_type'].isin(['view']) & ~(chunk['category_code'] == '')
-            ].dropna()
-        # take n_sub_categories sub categories, + 1 as the index is excluded
-        if n_sub_categories is not None and n_sub_categories > 0:
-            events_operations.loc[:, 'category_code'] = \
-                events_operations['category_code'].str.split('.').str[
-                :max(2, n_sub_categories + 1)
-                ].str.join('.')
-        events_operations = events_operations.groupby(
-            ['category_code']
-        ).event_type.count().to_frame().rename(
-            columns={'event_type': 'n_visits'}
-        )
-        if most_visited_sub_categories.empty:
-            most_visited_sub_categories = events_operations
-        else:
-            most_visited_sub_categories = \
-                most_visited_sub_categories.add(events_operations, fill_value=0).astype(np.uint32)
-    most_visited_sub_categories.reset_index(inplace=True)
-    # sort in descending order
-    most_visited_sub_categories.sort_values(by=['n_visits'], ascending=False, inplace=True)
-    if top_n is not None and top_n > 0:
-        most_visited_sub_categories = most_visited_sub_categories.iloc[:top_n, :]
-    # plot results
-    sns.set_style("whitegrid")
-    fig, ax = plt.subplots(figsize=(15, 10 if top_n is not None else 25))
-    _ = sns.barplot(data=most_visited_sub_categories, x="n_visits", y="category_code", palette='tab10')
-    plt.xlabel('Number of visits')
-    plt.ylabel('Category')
-    plt.title(
-        f"{df_label + ': ' if df_label else ''}Number of visits per sub category "
-        f"{'| top #' + str(top_n) + ' sub categories' if top_n is not None else ''}"
-    )
-    plt.xlim(0, most_visited_sub_categories['n_visits'].max() * 1.05)
-    show_values_on_bars(ax, "h", 0.3)
-    plt.show()
+    return run_analyses(
+        [MostVisitedSubCategories(df_label=df_label, top_n=top_n, n_sub_categories=n_sub_categories, aws=aws)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
 
 
-def most_sold_products_per_category(
-    category: str,
-    top_n: int = 10,
-    df_label: str = default_file_label,
-    aws: bool = default_aws,
-    size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
-):
-    try:
-        reader = read_csv(
-            df_label=df_label,
-            aws=aws,
-            size_mb=size_mb,
-            nrows=nrows,
-            usecols=['category_code', 'event_type', 'product_id'],
-            dtype={'category_code': str, 'event_type': str, 'product_id': np.uint32}
-        )
-        most_sold_products = pd.DataFrame()
-        for chunk in reader:
-            print(".", end="")
-            # take only the category
-            chunk.loc[:, 'category_code'] = chunk.category_code.str.split('.').str[0]
-            chunk = chunk[
-                chunk['event_type'].isin(['purchase'])
-                & (chunk['category_code'] == category)
-            ].groupby(
-                ['category_code', 'product_id']
-            ).event_type.count().to_frame().rename(
-                columns={'event_type': 'n_purchases'}
-            )
-            if most_sold_products.empty:
-                most_sold_products = chunk
-            else:
-                most_sold_products = \
-                    most_sold_products.add(chunk, fill_value=0).astype(np.uint32)
-        most_sold_products.reset_index(inplace=True)
+class MostSoldProductsPerCategory(Analysis):
+    dtype = {'category_id': np.int64, 'event_type': str, 'product_id': np.uint32}
+    event_types = {'purchase'}
+
+    def __init__(self, category: str, top_n: int = 10, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.category = category
+        self.top_n = top_n
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.category_code = self.category_index.get_code(category, depth=0)
+        self.most_sold_products = StreamingAggregator(['product_id'], {'n_purchases': (None, 'count')})
+
+    def update(self, chunk):
+        if self.category_code < 0:
+            return
+        # compare only integer codes of the category
+        categories = self.category_index.get_codes(chunk['category_id'].values, depth=0)
+        self.most_sold_products.update(chunk[
+            (chunk['event_type'].values == 'purchase') & (categories == self.category_code)
+        ])
+
+    def finalize(self):
+        top_n, category, df_label = self.top_n, self.category, self.df_label
+        most_sold_products = self.most_sold_products.finalize().reset_index()
         most_sold_products = most_sold_products.sort_values(by='n_purchases', ascending=False).head(top_n)
         top_n_sold_products = list(most_sold_products.product_id.values)
         print(
@@ -208,6 +248,23 @@ def most_sold_products_per_category(
             print(*top_n_sold_products, sep=', ')
         else:
             print("none")
+        return top_n_sold_products
+
+
+def most_sold_products_per_category(
+    category: str,
+    top_n: int = 10,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers
+):
+    try:
+        return run_analyses(
+            [MostSoldProductsPerCategory(category=category, top_n=top_n, df_label=df_label, aws=aws)],
+            df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers, category=category
+        )[0]
     except FileNotFoundError:
         print(f"File with a label '{df_label}' does not exist")
 
@@ -215,50 +272,53 @@ def most_sold_products_per_category(
 categories_dict = dict()
 
 
+class Categories(Analysis):
+    dtype = {'category_id': np.int64}
+
+    def __init__(self, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.all_categories = StreamingAggregator(['category'])
+
+    def update(self, chunk):
+        # take only known categories
+        categories = self.category_index.get_codes(chunk['category_id'].values, depth=0)
+        self.all_categories.update(pd.DataFrame({'category': categories[categories >= 0]}))
+
+    def finalize(self):
+        all_categories = list(self.category_index.get_names(self.all_categories.finalize().index.values))
+        print(
+            f"\n{self.df_label + ' | ' if self.df_label else ''}"
+            f"Categories: "
+        )
+        for category in all_categories:
+            print(category)
+        categories_dict[self.df_label] = all_categories
+        return all_categories
+
+
 def get_categories(
         df_label: str = default_file_label,
         aws: bool = default_aws,
         size_mb: float = deafult_size_mb,
-        nrows: int = default_nrows
+        nrows: int = default_nrows,
+        workers: int = default_workers
 ):
     """
     Function producing a dict with file label as a key and categories as values
     Performance can be improved with bash script
     """
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['category_code'],
-        dtype={'category_code': str},
-    )
-    all_categories = pd.DataFrame()
-    for chunk in reader:
-        print('.', end='')
-        chunk = chunk.replace('', np.nan).dropna()
-        # take only the category
-        chunk.loc[:, 'category_code'] = chunk.category_code.str.split('.').str[0]
-        chunk.drop_duplicates(inplace=True)
-        if all_categories.empty:
-            all_categories = chunk
-        else:
-            all_categories = pd.concat([all_categories, chunk])
-    all_categories = list(all_categories.category_code.unique())
-    print(
-        f"\n{df_label + ' | ' if df_label else ''}"
-        f"Categories: "
-    )
-    for category in all_categories:
-        print(category)
-    categories_dict[df_label] = all_categories
-    return all_categories
+    return run_analyses(
+        [Categories(df_label=df_label, aws=aws)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
+    )[0]
 
 
 def get_most_sold_products_per_category(
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
     nrows: int = default_nrows,
+    workers: int = default_workers,
     **kwargs
 ):
     for _ in range(3):
@@ -270,31 +330,52 @@ def get_most_sold_products_per_category(
             df_label = args[1].strip() if len(args) > 1 else default_file_label
             if not categories_dict or category in categories_dict.get(df_label, list()):
                 most_sold_products_per_category(
-                    category=category, df_label=df_label, top_n=10,  size_mb=size_mb, nrows=nrows, aws=aws
+                    category=category, df_label=df_label, top_n=10, size_mb=size_mb, nrows=nrows, aws=aws,
+                    workers=workers
                 )  # perform for the whole DS
                 break
             else:
                 print(f"Could not find a matching '{category}' category for '{df_label}', please try again")
 
 
+# Analyses which can share a single scan of a file
+analyses_map = {
+    'get_most_trending_products': MostTrendingProducts,
+    'get_most_visited_sub_categories': MostVisitedSubCategories,
+    'get_categories': Categories
+}
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Data analysis for RQ1')
     FMAP = {
         'get_most_trending_products': get_most_trending_products,
         'get_most_trending_products_with_bash': get_most_trending_products_with_bash,
+        'prepare_most_trending_products_with_bash': prepare_most_trending_products_with_bash,
         'get_most_visited_sub_categories': get_most_visited_sub_categories,
         'get_categories': get_categories,
         'get_most_sold_products_per_category': get_most_sold_products_per_category
     }
-    parser.add_argument('command', choices=FMAP.keys())
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
     parser.add_argument('-l', '--df-label', type=str, default=default_file_label)
     parser.add_argument('--aws', type=float, default=default_aws)
-    parser.add_argument('-mb', '--size-mb', type=float, default=deafult_size_mb)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
     parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
     args = parser.parse_args()
-    FMAP.get(args.command, lambda _: print("Function has not been found"))(
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    run_commands(
+        args.commands,
+        FMAP,
+        analyses_map,
         df_label=args.df_label,
         aws=args.aws,
         size_mb=args.size_mb,
-        nrows=args.nrows
+        nrows=args.nrows,
+        workers=args.workers
     )
@@ -3,50 +3,172 @@ from rq2 import show_values_on_bars, categories_dict
 import argparse
 
 
+class BrandProductPrices(Analysis):
+    """
+    Prices of the products of every brand of a category: max, sum and number of prices of every
+    (brand, product_id, purchase or not), kept in arrays sorted by a packed key so that updates and merges
+    are vectorized, chunks are aggregated on their own and folded in once they add up to the size of the state
+    """
+    dtype = {'category_id': np.int64, 'event_type': str, 'brand': str, 'product_id': np.uint32, 'price': np.float32}
+    # packed key: brand code (high bits) | product_id (32 bits) | purchase flag (lowest bit)
+    brand_shift = np.uint64(33)
+    product_shift = np.uint64(1)  # product_id sits above the flag
+    flag_mask = np.uint64(1)  # selects the flag
+
+    def __init__(self, category: str, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.category = category
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.category_code = self.category_index.get_code(category, depth=0)
+        self.brand_codes, self.brands = dict(), list()
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.max_prices = np.zeros(0, dtype=np.float32)
+        self.sum_prices = np.zeros(0, dtype=np.float64)
+        self.n_prices = np.zeros(0, dtype=np.int64)
+        # aggregates of chunks not folded in yet
+        self.pending, self.n_pending = list(), 0
+
+    def _encode_brands(self, brands) -> np.ndarray:
+        """
+        Map brands to codes, extending the dictionary of brands
+        """
+        codes, uniques = pd.factorize(brands)
+        mapper = np.empty(len(uniques), dtype=np.uint64)
+        for i, brand in enumerate(uniques):
+            code = self.brand_codes.get(brand)
+            if code is None:
+                code = self.brand_codes[brand] = len(self.brands)
+                self.brands.append(brand)
+            mapper[i] = code
+        return mapper[codes]
+
+    @staticmethod
+    def _reduce(keys, max_prices, sum_prices, n_prices) -> tuple:
+        """
+        Aggregate values of equal keys, returns sorted unique keys and their aggregates
+        """
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+        if not len(starts):
+            return keys, max_prices, sum_prices, n_prices
+        return (
+            keys[starts],
+            np.maximum.reduceat(max_prices[order], starts),
+            np.add.reduceat(sum_prices[order], starts),
+            np.add.reduceat(n_prices[order], starts)
+        )
+
+    def _add(self, *aggregates):
+        self.pending.append(aggregates)
+        self.n_pending += len(aggregates[0])
+        # fold in when pending aggregates are as many as the state: amortized cost proportional to chunks
+        if self.n_pending >= max(len(self.keys), 2 ** 16):
+            self._compact()
+
+    def _compact(self):
+        if not self.pending:
+            return
+        self.keys, self.max_prices, self.sum_prices, self.n_prices = self._reduce(*[
+            np.concatenate([state] + [aggregates[i] for aggregates in self.pending])
+            for i, state in enumerate([self.keys, self.max_prices, self.sum_prices, self.n_prices])
+        ])
+        self.pending, self.n_pending = list(), 0
+
+    def update(self, chunk):
+        if self.category_code < 0:
+            return
+        # filter the selected category, only products of known brands
+        categories = self.category_index.get_codes(chunk['category_id'].values, depth=0)
+        chunk = chunk[(categories == self.category_code) & (chunk['brand'].values != '')]
+        if chunk.empty:
+            return
+        keys = (self._encode_brands(chunk['brand'].values) << self.brand_shift) \
+            | (chunk['product_id'].values.astype(np.uint64) << self.product_shift) \
+            | (chunk['event_type'].values == 'purchase').astype(np.uint64)
+        prices = chunk['price'].values.astype(np.float32)
+        cents = np.round(prices.astype(np.float64), 2)
+        self._add(*self._reduce(keys, prices, cents, np.ones(len(prices), dtype=np.int64)))
+
+    def merge(self, other: 'BrandProductPrices') -> 'BrandProductPrices':
+        other._compact()
+        if len(other.keys):
+            # translate brand codes of the other state
+            mapper = self._encode_brands(np.array(other.brands, dtype=object))
+            brands = mapper[(other.keys >> self.brand_shift).astype(np.int64)]
+            keys = (brands << self.brand_shift) | (other.keys & ((np.uint64(1) << self.brand_shift) - np.uint64(1)))
+            self._add(*self._reduce(keys, other.max_prices, other.sum_prices, other.n_prices))
+        return self
+
+    def finalize(self):
+        self._compact()
+        return self
+
+    def get_product_prices(self, purchases: bool = False, price: str = 'max') -> pd.Series:
+        """
+        Max (or mean) price of every product of every brand, taken over all the events of the products
+        or only over their purchases
+        """
+        keys, max_prices, sum_prices, n_prices = self.keys, self.max_prices, self.sum_prices, self.n_prices
+        if purchases:
+            purchased = (keys & self.flag_mask).astype(bool)
+            keys, max_prices, sum_prices, n_prices = keys[purchased], max_prices[purchased], \
+                sum_prices[purchased], n_prices[purchased]
+        # fold both flags of every (brand, product)
+        keys, max_prices, sum_prices, n_prices = self._reduce(
+            keys >> self.product_shift, max_prices, sum_prices, n_prices
+        )
+        brands = np.array(self.brands, dtype=object)[(keys >> (self.brand_shift - self.product_shift)).astype(np.int64)]
+        product_ids = (keys & np.uint64(2 ** 32 - 1)).astype(np.uint32)
+        return pd.Series(
+            # prices come with cents, float32 keeps them exactly (up to ~100k) once rounded back to cents
+            np.round(max_prices.astype(np.float64), 2) if price == 'max' else sum_prices / n_prices,
+            index=pd.MultiIndex.from_arrays([brands, product_ids], names=['brand', 'product_id']),
+            name='price'
+        )
+
+    def get_brand_prices(self, top_n: int = None, purchases: bool = False, price: str = 'max') -> pd.Series:
+        """
+        Average price of the products of every brand (see get_product_prices), brands with the highest first
+        """
+        product_prices = self.get_product_prices(purchases=purchases, price=price)
+        brand_prices = product_prices.astype(np.float64).groupby(level='brand').mean().rename('avg_price')
+        brand_prices = brand_prices.sort_values(ascending=False, kind='stable')
+        return brand_prices if top_n is None else brand_prices.head(top_n)
+
+
+def get_brand_product_prices(
+    category: str,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers
+) -> BrandProductPrices:
+    """
+    Function returning prices of the products of every brand of a category, built with a single pass
+    and kept in the result cache, so that every question about prices of brands of the category shares it
+    """
+    return run_analyses(
+        [BrandProductPrices(category=category, df_label=df_label, aws=aws)],
+        df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers, category=category
+    )[0]
+
+
 def brands_avg_prices_per_category(
     category: str,
     top_n: int = 10,
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['category_code', 'event_type', 'brand', 'product_id', 'price'],
-        dtype={'category_code': str, 'event_type': str, 'brand': str, 'price': np.float16}
+    prices = get_brand_product_prices(
+        category=category, df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
     )
-    brand_product_price = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        # consider only purchases
-        chunk = chunk.loc[chunk['event_type'].isin(['purchase'])]
-        # take category
-        chunk.loc[:, 'category_code'] = chunk.category_code.str.split('.').str[0]
-        # filter by category, drop filtering columns, not needed any longer
-        chunk = chunk[
-            (chunk['category_code'] == category) & (chunk['brand'] != '')
-        ].drop_duplicates().drop(columns=['category_code', 'event_type'])
-        # take max price for each product_id
-        chunk = chunk.groupby(
-            ['brand', 'product_id']
-        ).price.max().to_frame()
-        if brand_product_price.empty:
-            brand_product_price = chunk
-        else:
-            # combine data, take max if contradict
-            brand_product_price = brand_product_price.combine(
-                chunk,
-                lambda s1, s2: np.maximum(s1.fillna(0), s2.fillna(0)),
-                overwrite=False
-            )
-    # calculate avg price per brand, take top_n brands
-    top_brands = brand_product_price.groupby(['brand']).price.mean().to_frame().sort_values(
-        by=['price'], ascending=False
-    ).head(top_n).reset_index().rename(columns={'price': 'avg_price'})
+    # average of max prices of products sold by a brand, take top_n brands
+    top_brands = prices.get_brand_prices(top_n=top_n, purchases=True).reset_index()
     # plot results
     sns.set_style("whitegrid")
     fig, ax = plt.subplots(figsize=(15, 10 if top_n is not None else 25))
@@ -60,12 +182,14 @@ def brands_avg_prices_per_category(
     plt.xlim(0, top_brands['avg_price'].max() * 1.05)
     show_values_on_bars(ax, "h", 0.3)
     plt.show()
+    return top_brands
 
 
 def get_brands_avg_prices_per_category(
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
     nrows: int = default_nrows,
+    workers: int = default_workers,
     **kwargs
 ):
     for _ in range(3):
@@ -77,7 +201,8 @@ def get_brands_avg_prices_per_category(
             df_label = args[1].strip() if len(args) > 1 else default_file_label
             if not categories_dict or category in categories_dict.get(df_label, list()):
                 brands_avg_prices_per_category(
-                    category=category, df_label=df_label, top_n=10, size_mb=size_mb, nrows=nrows, aws=aws
+                    category=category, df_label=df_label, top_n=10, size_mb=size_mb, nrows=nrows, aws=aws,
+                    workers=workers
                 )  # perform for the whole DS
                 break
             else:
@@ -90,42 +215,14 @@ def brand_with_highest_prices_per_category(
     df_label: str = default_file_label,
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
-    nrows: int = default_nrows
+    nrows: int = default_nrows,
+    workers: int = default_workers
 ):
-    reader = read_csv(
-        df_label=df_label,
-        aws=aws,
-        size_mb=size_mb,
-        nrows=nrows,
-        usecols=['category_code', 'brand', 'product_id', 'price'],
-        dtype={'category_code': str, 'brand': str, 'price': np.float16}
+    prices = get_brand_product_prices(
+        category=category, df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers
     )
-    brand_product_price = pd.DataFrame()
-    for chunk in reader:
-        print(".", end="")
-        # take only the category
-        chunk.loc[:, 'category_code'] = chunk.category_code.str.split('.').str[0]
-        # filter the selected category
-        chunk = chunk[
-            (chunk['category_code'] == category) & (chunk['brand'] != '')
-        ].drop_duplicates().drop(columns=['category_code'])
-        # take max price for each product_id
-        chunk = chunk.groupby(
-            ['brand', 'product_id']
-        ).price.max().to_frame()
-        if brand_product_price.empty:
-            brand_product_price = chunk
-        else:
-            # combine data, take max if contradict
-            brand_product_price = brand_product_price.combine(
-                chunk,
-                lambda s1, s2: np.maximum(s1.fillna(0), s2.fillna(0)),
-                overwrite=False
-            )
-    # calculate avg price per brand, take top_n brands
-    top_brands = brand_product_price.groupby(['brand']).price.mean().to_frame().sort_values(
-        by=['price'], ascending=False
-    ).head(top_n).index.to_list()
+    # average of max prices of products of a brand, take top_n brands
+    top_brands = prices.get_brand_prices(top_n=top_n).index.to_list()
     top_brands = top_brands if top_brands else ['none']
     # display results
     print(
@@ -135,12 +232,14 @@ def brand_with_highest_prices_per_category(
     print("s '" if top_brands and len(top_brands) > 1 else " '", end="")
     print(*top_brands, sep="', '", end="")
     print(f"' got the highest prices on average")
+    return top_brands
 
 
 def get_brand_with_highest_prices_per_category(
     aws: bool = default_aws,
     size_mb: float = deafult_size_mb,
     nrows: int = default_nrows,
+    workers: int = default_workers,
     **kwargs
 ):
     for _ in range(3):
@@ -152,7 +251,8 @@ def get_brand_with_highest_prices_per_category(
             df_label = args[1].strip() if len(args) > 1 else default_file_label
             if not categories_dict or category in categories_dict.get(df_label, list()):
                 brand_with_highest_prices_per_category(
-                    category=category, df_label=df_label, top_n=10, size_mb=size_mb, nrows=nrows, aws=aws
+                    category=category, df_label=df_label, top_n=10, size_mb=size_mb, nrows=nrows, aws=aws,
+                    workers=workers
                 )  # perform for the whole DS
                 break
             else:
@@ -165,15 +265,26 @@ if __name__ == '__main__':
         'get_brands_avg_prices_per_category': get_brands_avg_prices_per_category,
         'get_brand_with_highest_prices_per_category': get_brand_with_highest_prices_per_category
     }
-    parser.add_argument('command', choices=FMAP.keys())
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
     parser.add_argument('-l', '--df-label', type=str, default=default_file_label)
     parser.add_argument('--aws', type=float, default=default_aws)
-    parser.add_argument('-mb', '--size-mb', type=float, default=deafult_size_mb)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
     parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
     args = parser.parse_args()
-    FMAP.get(args.command, lambda _: print("Function has not been found"))(
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    run_commands(
+        args.commands,
+        FMAP,
+        dict(),
         df_label=args.df_label,
         aws=args.aws,
         size_mb=args.size_mb,
-        nrows=args.nrows
+        nrows=args.nrows,
+        workers=args.workers
     )
@@ -0,0 +1,133 @@
+from shared import *
+import argparse
+
+
+class BrandMonthlyRevenue(Analysis):
+    """
+    Revenue (sum of prices of purchases) of every brand in every month, built with one pass over the months
+    """
+    dtype = {'event_type': str, 'brand': str, 'price': np.float64, 'month': str}
+    event_types = {'purchase'}
+
+    def __init__(self, df_label: list = df_labels):
+        super().__init__(df_label=df_label)
+        self.brand_month_revenue = StreamingAggregator(
+            ['brand', 'month'], {'revenue': ('price', 'sum'), 'n_purchases': (None, 'count')}
+        )
+
+    def update(self, chunk):
+        # consider only purchases of known brands
+        self.brand_month_revenue.update(chunk[
+            (chunk['event_type'].values == 'purchase') & (chunk['brand'].values != '')
+        ])
+
+    def finalize(self):
+        # brand x month table, months in chronological order, 0 for months without sales
+        revenue = self.brand_month_revenue.finalize()['revenue'].unstack('month', fill_value=0.)
+        revenue = revenue.reindex(columns=get_month_labels(labels=list(self.df_label)), fill_value=0.)
+        revenue.columns.name = 'month'
+        return revenue
+
+
+def get_brand_revenue_table(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    **kwargs
+) -> pd.DataFrame:
+    """
+    Function returning revenue of every brand (rows) per month (columns),
+    it is kept in the result cache so it is built once per set of months
+    """
+    df_labels = get_month_labels(labels=list(df_labels))
+    return run_analyses(
+        [BrandMonthlyRevenue(df_label=df_labels)],
+        df_label=df_labels, aws=aws, size_mb=size_mb, nrows=nrows
+    )[0]
+
+
+def get_brand_profit(brand: str, revenue: pd.DataFrame = None, df_labels: list = df_labels, **kwargs) -> pd.Series:
+    """
+    Function returning the profit of a brand for each month, a single hash lookup in the revenue table
+    """
+    revenue = get_brand_revenue_table(df_labels=df_labels, **kwargs) if revenue is None else revenue
+    if brand not in revenue.index:
+        print(f"No sales of '{brand}' in {', '.join(revenue.columns)}")
+        return pd.Series(0., index=revenue.columns, name=brand)
+    profit = revenue.loc[brand]
+    for month, month_profit in profit.items():
+        if month_profit > 0:
+            print(f"{month} | The brand '{brand}' gained {round(month_profit, 3)}")
+        else:
+            print(f"{month} | No sales of '{brand}'")
+    return profit
+
+
+def get_brand_monthly_profit(df_labels: list = df_labels, **kwargs):
+    revenue = get_brand_revenue_table(df_labels=df_labels, **kwargs)
+    for _ in range(3):
+        brand = input("Please enter a brand: ").strip()
+        if brand in revenue.index:
+            get_brand_profit(brand, revenue=revenue)
+            break
+        else:
+            print(f"Could not find a matching '{brand}' brand, please try again")
+
+
+def get_top_losses(top_k: int = 3, df_labels: list = df_labels, **kwargs) -> pd.DataFrame:
+    """
+    Function ranking the biggest losses in earnings of brands between one month and the next,
+    only brands with sales in both months are considered
+    """
+    revenue = get_brand_revenue_table(df_labels=df_labels, **kwargs)
+    values = revenue.values
+    # loss of every brand for every pair of consecutive months
+    with np.errstate(divide='ignore', invalid='ignore'):
+        losses = 1 - values[:, 1:] / values[:, :-1]
+    losses[~((values[:, 1:] > 0) & (values[:, :-1] > 0))] = -np.inf
+    losses = losses.ravel()
+    top_k = min(top_k, int(np.isfinite(losses).sum()))
+    # select top_k biggest losses without sorting all of them
+    top = np.argpartition(-losses, top_k - 1)[:top_k] if top_k > 0 else np.array([], dtype=int)
+    top = top[np.argsort(-losses[top], kind='stable')]
+    n_pairs = values.shape[1] - 1
+    top_losses = pd.DataFrame({
+        'brand': revenue.index.values[top // max(1, n_pairs)],
+        'from_month': revenue.columns.values[top % max(1, n_pairs)],
+        'to_month': revenue.columns.values[top % max(1, n_pairs) + 1],
+        'loss_pct': np.round(losses[top] * 100, 2)
+    })
+    for _, row in top_losses.iterrows():
+        print(f"{row['brand']} lost {row['loss_pct']}% between {row['from_month']} and {row['to_month']}")
+    return top_losses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data analysis for RQ4')
+    FMAP = {
+        'get_brand_revenue_table': lambda **kwargs: print(get_brand_revenue_table(**kwargs)),
+        'get_brand_monthly_profit': get_brand_monthly_profit,
+        'get_top_losses': get_top_losses
+    }
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
+    parser.add_argument('-l', '--df-labels', type=str, nargs='+', default=df_labels)
+    parser.add_argument('--aws', type=float, default=default_aws)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
+    args = parser.parse_args()
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    for command in args.commands:
+        FMAP.get(command, lambda **_: print("Function has not been found"))(
+            df_labels=args.df_labels,
+            aws=args.aws,
+            size_mb=args.size_mb,
+            nrows=args.nrows,
+            top_k=args.top_k
+        )
@@ -0,0 +1,176 @@
+from shared import *
+from rq2 import show_values_on_bars
+import argparse
+
+# How to extract every time unit from the hour of an event
+time_units = {
+    'hour': lambda event_hour: event_hour.dt.hour,
+    'day': lambda event_hour: event_hour.dt.day,
+    'week': lambda event_hour: event_hour.dt.isocalendar().week.astype(int),
+    'dayofweek': lambda event_hour: event_hour.dt.dayofweek,
+}
+
+
+def get_rollup_cube_path(df_label=default_file_label):
+    """
+    Function to retrieve by a label the path of the rollup cube of a file
+    """
+    return f"datasets/{df_label}.rq5-cube.csv"
+
+
+class RollupCube(Analysis):
+    """
+    Number of events per hour, event type and category, small enough to answer
+    any hour/day/week question without rescanning the file
+    """
+    dtype = {'event_time': str, 'event_type': str, 'category_id': np.int64}
+    parse_event_time = True
+
+    def __init__(self, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.category_index = get_category_index(df_label=df_label, aws=aws)
+        self.cube = StreamingAggregator(['event_hour', 'event_type', 'category'], {'n_events': (None, 'count')})
+
+    def update(self, chunk):
+        self.cube.update(pd.DataFrame({
+            'event_hour': chunk['event_time'].values.astype('datetime64[h]'),
+            'event_type': chunk['event_type'].values,
+            # take only the category
+            'category': self.category_index.get_codes(chunk['category_id'].values, depth=0)
+        }))
+
+    def finalize(self):
+        cube = self.cube.finalize().reset_index()
+        cube['category'] = self.category_index.get_names(cube['category'])
+        cube['event_hour'] = pd.to_datetime(cube['event_hour'])
+        cube = cube.sort_values(by=['event_hour', 'event_type', 'category'])
+        cube.to_csv(get_rollup_cube_path(df_label=self.df_label), index=False)
+        return cube
+
+
+def build_rollup_cube(
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    workers: int = default_workers,
+    **kwargs
+):
+    return run_analyses(
+        [RollupCube(df_label=df_label, aws=aws)], df_label=df_label, aws=aws, size_mb=size_mb, workers=workers
+    )[0]
+
+
+def load_rollup_cube(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    workers: int = default_workers
+):
+    """
+    Function loading rollup cubes of several files, cubes are built only for files
+    which do not have one or have been changed since
+    """
+    cubes = list()
+    for df_label in df_labels:
+        cube_path = get_rollup_cube_path(df_label=df_label)
+        file_path = get_file_path(df_label=df_label)
+        if os.path.exists(cube_path) and (
+            not os.path.exists(file_path) or os.path.getmtime(cube_path) >= os.path.getmtime(file_path)
+        ):
+            cube = pd.read_csv(cube_path, na_filter=False, parse_dates=['event_hour'])
+        else:
+            print(f"{df_label} | building the rollup cube", end="")
+            cube = build_rollup_cube(df_label=df_label, aws=aws, size_mb=size_mb, workers=workers)
+            print()
+        cubes.append(cube)
+    return pd.concat(cubes, ignore_index=True)
+
+
+def get_events_per_time_unit(
+    time_unit: str = 'hour',
+    df_labels: list = df_labels,
+    event_type: str = None,
+    category: str = None,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    workers: int = default_workers,
+    **kwargs
+):
+    cube = load_rollup_cube(df_labels=df_labels, aws=aws, size_mb=size_mb, workers=workers)
+    if event_type:
+        cube = cube[cube['event_type'] == event_type]
+    if category:
+        cube = cube[cube['category'] == category]
+    # count events per time unit
+    events_per_time_unit = cube.groupby(
+        time_units[time_unit](cube['event_hour']).rename(time_unit)
+    ).n_events.sum()
+    events = f"'{event_type}' events" if event_type else 'events'
+    if not events_per_time_unit.empty:
+        print(
+            f"{', '.join(df_labels)} | the {time_unit} with the highest number of {events}"
+            f"{' for ' + repr(category) if category else ''} is {events_per_time_unit.idxmax()} "
+            f"({events_per_time_unit.max()} {events})"
+        )
+    # plot results
+    sns.set_style("whitegrid")
+    fig, ax = plt.subplots(figsize=(15, 5))
+    _ = sns.barplot(x=events_per_time_unit.index, y=events_per_time_unit.values, color='tab:blue')
+    plt.xlabel(time_unit)
+    plt.ylabel(f"Number of {events}")
+    plt.title(f"{', '.join(df_labels)}: Number of {events} per {time_unit}")
+    show_values_on_bars(ax, "v")
+    plt.show()
+    return events_per_time_unit
+
+
+def get_events_per_hour(**kwargs):
+    return get_events_per_time_unit(time_unit='hour', **kwargs)
+
+
+def get_events_per_day(**kwargs):
+    return get_events_per_time_unit(time_unit='day', **kwargs)
+
+
+def get_events_per_week(**kwargs):
+    return get_events_per_time_unit(time_unit='week', **kwargs)
+
+
+def get_events_per_day_of_week(**kwargs):
+    return get_events_per_time_unit(time_unit='dayofweek', **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data analysis for RQ5')
+    FMAP = {
+        'build_rollup_cube': lambda df_labels, **kwargs: [
+            build_rollup_cube(df_label=df_label, **kwargs) for df_label in df_labels
+        ],
+        'get_events_per_hour': get_events_per_hour,
+        'get_events_per_day': get_events_per_day,
+        'get_events_per_week': get_events_per_week,
+        'get_events_per_day_of_week': get_events_per_day_of_week
+    }
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
+    parser.add_argument('-l', '--df-labels', type=str, nargs='+', default=df_labels)
+    parser.add_argument('--aws', type=float, default=default_aws)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--workers', type=int, default=default_workers)
+    parser.add_argument('--event-type', type=str, default=None)
+    parser.add_argument('--category', type=str, default=None)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
+    args = parser.parse_args()
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    for command in args.commands:
+        FMAP.get(command, lambda **_: print("Function has not been found"))(
+            df_labels=args.df_labels,
+            aws=args.aws,
+            size_mb=args.size_mb,
+            workers=args.workers,
+            event_type=args.event_type,
+            category=args.category
+        )
@@ -0,0 +1,110 @@
+from shared import *
+import argparse
+
+
+class PurchaseConversionRates(Analysis):
+    """
+    Purchase rate (purchases / distinct users) and conversion rate (purchase rate / views),
+    overall and per category, with distinct users counted by DistinctCounter in one pass over the months
+    """
+    dtype = {'event_type': str, 'category_id': np.int64, 'user_id': np.uint32, 'month': str}
+
+    def __init__(self, df_label: list = df_labels, mode: str = 'exact', error: float = 0.01, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.mode = mode
+        self.error = error
+        self.category_indexes = {label: get_category_index(df_label=label, aws=aws) for label in df_label}
+        self.events = StreamingAggregator(['category', 'event_type'])
+        # distinct users of every category and of all categories (None)
+        self.users = {None: DistinctCounter(mode=mode, error=error)}
+
+    def update(self, chunk):
+        # chunks of read_months come from a single month
+        category_index = self.category_indexes[chunk['month'].iat[0]]
+        categories = category_index.get_codes(chunk['category_id'].values, depth=0)
+        # consider only known categories
+        known = categories >= 0
+        categories, user_ids = categories[known], chunk['user_id'].values[known]
+        names = category_index.get_names(categories)
+        self.events.update(pd.DataFrame({'category': names, 'event_type': chunk['event_type'].values[known]}))
+        self.users[None].update(user_ids)
+        # split users by category with a single sort
+        order = np.argsort(categories, kind='stable')
+        bounds = np.flatnonzero(np.diff(categories[order])) + 1
+        for rows in np.split(order, bounds):
+            if len(rows):
+                name = names[rows[0]]
+                self.users.setdefault(name, DistinctCounter(mode=self.mode, error=self.error)).update(user_ids[rows])
+
+    def finalize(self):
+        events = self.events.finalize()['n_events'].unstack('event_type', fill_value=0)
+        rates = pd.DataFrame({
+            'n_purchases': events.get('purchase', pd.Series(0, index=events.index)),
+            'n_views': events.get('view', pd.Series(0, index=events.index)),
+            'n_users': pd.Series({name: users.count for name, users in self.users.items() if name is not None}),
+        }).fillna(0)
+        rates['purchase_rate'] = rates['n_purchases'] / rates['n_users']
+        rates['conversion_rate'] = rates['purchase_rate'] / rates['n_views']
+        rates.sort_values(by='conversion_rate', ascending=False, inplace=True)
+        n_users = self.users[None].count
+        purchase_rate = rates['n_purchases'].sum() / n_users if n_users else np.nan
+        conversion_rate = purchase_rate / rates['n_views'].sum() if rates['n_views'].sum() else np.nan
+        df_labels = ', '.join(self.df_label)
+        print(f"\n{df_labels} | Purchase rate: {round(purchase_rate, 4)} ({n_users} users)")
+        print(f"{df_labels} | Conversion rate: {conversion_rate}")
+        # plot results
+        top_rates = rates['conversion_rate'].head(10)
+        sns.set_style("whitegrid")
+        fig, ax = plt.subplots(figsize=(15, 5))
+        _ = sns.barplot(x=top_rates.index, y=top_rates.values, palette='inferno_r')
+        plt.xlabel('Category')
+        plt.ylabel('Conversion rate')
+        plt.title(f"{df_labels}: Conversion rate per category")
+        plt.show()
+        return rates
+
+
+def get_purchase_conversion_rates(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    mode: str = 'exact',
+    error: float = 0.01,
+    **kwargs
+):
+    df_labels = get_month_labels(labels=list(df_labels))
+    return run_analyses(
+        [PurchaseConversionRates(df_label=df_labels, mode=mode, error=error, aws=aws)],
+        df_label=df_labels, aws=aws, size_mb=size_mb, nrows=nrows
+    )[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data analysis for RQ6')
+    FMAP = {
+        'get_purchase_conversion_rates': get_purchase_conversion_rates
+    }
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
+    parser.add_argument('-l', '--df-labels', type=str, nargs='+', default=df_labels)
+    parser.add_argument('--aws', type=float, default=default_aws)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--mode', type=str, choices=DistinctCounter.modes, default='exact')
+    parser.add_argument('--error', type=float, default=0.01)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
+    args = parser.parse_args()
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    for command in args.commands:
+        FMAP.get(command, lambda **_: print("Function has not been found"))(
+            df_labels=args.df_labels,
+            aws=args.aws,
+            size_mb=args.size_mb,
+            nrows=args.nrows,
+            mode=args.mode,
+            error=args.error
+        )
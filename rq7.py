@@ -0,0 +1,177 @@
+from shared import *
+import argparse
+
+
+class UserSpend(Analysis):
+    """
+    Total spend of every buyer, kept as a compact pair of arrays (sorted user_id, spend),
+    spend of chunks is summed per user on its own and folded in once it adds up to the size of the state
+    """
+    dtype = {'event_type': str, 'user_id': np.uint32, 'price': np.float64}
+    event_types = {'purchase'}
+
+    def __init__(self, df_label: list = df_labels):
+        super().__init__(df_label=df_label)
+        self.user_ids = np.zeros(0, dtype=np.uint32)
+        self.spend = np.zeros(0, dtype=np.float64)
+        # spend per user of chunks not folded in yet
+        self.pending, self.n_pending = list(), 0
+
+    def _add(self, user_ids: np.ndarray, spend: np.ndarray):
+        self.pending.append((user_ids, spend))
+        self.n_pending += len(user_ids)
+        # fold in when pending users are as many as the state: amortized cost proportional to chunks
+        if self.n_pending >= max(len(self.user_ids), 2 ** 16):
+            self._compact()
+
+    def _compact(self):
+        if not self.pending:
+            return
+        user_ids, users = np.unique(
+            np.concatenate([self.user_ids] + [user_ids for user_ids, _ in self.pending]), return_inverse=True
+        )
+        self.spend = np.bincount(users, weights=np.concatenate([self.spend] + [spend for _, spend in self.pending]))
+        self.user_ids = user_ids
+        self.pending, self.n_pending = list(), 0
+
+    def update(self, chunk):
+        purchases = chunk[chunk['event_type'].values == 'purchase']
+        if purchases.empty:
+            return
+        # sum spend per user within the chunk first
+        user_ids, rows_users = np.unique(purchases['user_id'].values, return_inverse=True)
+        self._add(user_ids, np.bincount(rows_users, weights=purchases['price'].values))
+
+    def merge(self, other: 'UserSpend') -> 'UserSpend':
+        other._compact()
+        self._add(other.user_ids, other.spend)
+        return self
+
+
+class ParetoCurve(UserSpend):
+    """
+    Share of revenue coming from the top spenders (Pareto/Lorenz curve) at n_points evenly spaced
+    shares of buyers and at the requested shares
+    """
+
+    def __init__(self, df_label: list = df_labels, n_points: int = 100, shares: tuple = (0.2,)):
+        super().__init__(df_label=df_label)
+        self.n_points = n_points
+        self.shares = tuple(shares)
+
+    def finalize(self):
+        self._compact()
+        n_buyers, total_revenue = len(self.spend), self.spend.sum()
+        df_labels = ', '.join(self.df_label)
+        # number of top buyers for every point of the curve and every requested share
+        buyers_shares = np.unique(np.r_[np.linspace(0, 1, self.n_points + 1), self.shares])
+        n_top = (buyers_shares * n_buyers).astype(np.int64)
+        # partial selection: every top-k set is in front of the array without sorting all the buyers
+        kth = np.unique(np.clip(n_top - 1, 0, None))
+        spend = -np.partition(-self.spend, kth) if n_buyers else self.spend
+        revenue = np.r_[0., np.cumsum(spend)][n_top]
+        curve = pd.DataFrame({
+            'buyers_share': buyers_shares,
+            'n_buyers': n_top,
+            'revenue_share': revenue / total_revenue if total_revenue else np.nan
+        })
+        print(f"\n{df_labels} | Total revenue: {round(total_revenue, 2)} from {n_buyers} buyers")
+        for share in self.shares:
+            revenue_share = curve.loc[curve['buyers_share'] == share, 'revenue_share'].iat[0]
+            print(
+                f"{df_labels} | The top {round(share * 100, 2)}% of buyers spent "
+                f"{round(revenue_share * 100, 2)}% of the total revenue"
+            )
+        # plot results
+        sns.set_style("whitegrid")
+        fig, ax = plt.subplots(figsize=(10, 10))
+        plt.plot(curve['buyers_share'], curve['revenue_share'], color='tab:blue', label='Top buyers')
+        plt.plot([0, 1], [0, 1], color='tab:gray', linestyle='--', label='Equal spend')
+        plt.xlabel('Share of buyers (top spenders first)')
+        plt.ylabel('Share of revenue')
+        plt.title(f"{df_labels}: Pareto curve of spend per buyer")
+        plt.legend()
+        plt.show()
+        return curve
+
+
+class TopSpenders(UserSpend):
+    """
+    Buyers who spent the most, selected with a partial sort
+    """
+
+    def __init__(self, df_label: list = df_labels, top_n: int = 10):
+        super().__init__(df_label=df_label)
+        self.top_n = top_n
+
+    def finalize(self):
+        self._compact()
+        top_n = min(self.top_n, len(self.spend))
+        top = np.argpartition(-self.spend, top_n - 1)[:top_n] if top_n > 0 else np.array([], dtype=int)
+        top = top[np.argsort(-self.spend[top], kind='stable')]
+        top_spenders = pd.Series(self.spend[top], index=pd.Index(self.user_ids[top], name='user_id'), name='spend')
+        print(f"\n{', '.join(self.df_label)} | The top {top_n} spenders:")
+        print(top_spenders.to_string())
+        return top_spenders
+
+
+def get_pareto_curve(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    n_points: int = 100,
+    shares: tuple = (0.2,),
+    **kwargs
+):
+    df_labels = get_month_labels(labels=list(df_labels))
+    return run_analyses(
+        [ParetoCurve(df_label=df_labels, n_points=n_points, shares=shares)],
+        df_label=df_labels, aws=aws, size_mb=size_mb, nrows=nrows
+    )[0]
+
+
+def get_top_spenders(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    top_n: int = 10,
+    **kwargs
+):
+    df_labels = get_month_labels(labels=list(df_labels))
+    return run_analyses(
+        [TopSpenders(df_label=df_labels, top_n=top_n)],
+        df_label=df_labels, aws=aws, size_mb=size_mb, nrows=nrows
+    )[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data analysis for RQ7')
+    FMAP = {
+        'get_pareto_curve': get_pareto_curve,
+        'get_top_spenders': get_top_spenders
+    }
+    parser.add_argument('commands', nargs='+', choices=FMAP.keys())
+    parser.add_argument('-l', '--df-labels', type=str, nargs='+', default=df_labels)
+    parser.add_argument('--aws', type=float, default=default_aws)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--nrows', type=int, default=default_nrows)
+    parser.add_argument('--shares', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
+    args = parser.parse_args()
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    for command in args.commands:
+        FMAP.get(command, lambda **_: print("Function has not been found"))(
+            df_labels=args.df_labels,
+            aws=args.aws,
+            size_mb=args.size_mb,
+            nrows=args.nrows,
+            shares=tuple(args.shares),
+            top_n=args.top_n
+        )
@@ -1,9 +1,28 @@
 import os
+import io
+import sys
+import errno
+import json
+import time
+import shutil
+import pickle
+import contextlib
+import http.client
+import urllib.parse
+import concurrent.futures
+import hashlib
+import inspect
 import argparse
 import numpy as np
 import pandas as pd
 import math
 import itertools
+import threading
+import queue
+import multiprocessing
+import cProfile
+import pstats
+import tracemalloc
 from matplotlib import pyplot as plt
 import seaborn as sns
 
@@ -22,45 +41,759 @@ df_labels = ['2019-Oct', '2019-Nov']
 
 # Set up defaults that are to be used by functions corresponding to different RQs
 default_nrows = None
-deafult_size_mb = 1_000  # divider for chunk size
+deafult_size_mb = 1_000  # memory budget in MB, chunks are sized to fit in it
 default_file_label = df_labels[0]
 default_aws = False
+# Files read with aws=True are downloaded once into a disk cache (see fetch_s3_object), default_s3_endpoint points
+# to an S3 compatible server instead of AWS S3 (e.g. http://localhost:9000)
+default_s3_endpoint = os.environ.get('AWS_ENDPOINT_URL')
+default_s3_cache_path = 'datasets/.s3'
+default_s3_cache_size_mb = 20_000
+default_s3_connections = 8  # parallel byte range requests
+default_s3_part_mb = 16
+default_columnar = True
+default_workers = 1
+default_prefetch = 1  # chunks parsed ahead on a background thread while the current one is processed
+default_cache_path = 'datasets/.results'  # persistent result cache
+default_cache_size_mb = 256  # 0 disables the result cache
+default_distinct_max_mb = 64  # exact distinct counters taking more fall back to HyperLogLog (None - never)
+# Telemetry of chunk loops (see ChunkTelemetry): None - a dot per chunk, 'jsonl' - a JSON line per chunk
+# (to default_telemetry_path or stderr), 'summary' - a table at the end of every scan
+default_telemetry = None
+default_telemetry_path = None
+default_profile = None  # profiling of analyses during scans: 'cprofile' or 'tracemalloc'
+telemetry_modes = ('jsonl', 'summary')
+profile_modes = ('cprofile', 'tracemalloc')
 
-dataset_info = {
-    '2019-Oct': {
-        'total_n_rows': 42_448_764,
-        'total_size_mb': 5407
-    },
-    '2019-Nov': {
-        'total_n_rows': 67_501_979,
-        'total_size_mb': 8590
-    },
-}
+# Share of the memory budget (size_mb) the chunks in flight (the processed one and the prefetched ones) may take,
+# the rest is left for copies and states
+chunk_memory_share = 0.25
+min_chunksize = 1_000
+bytes_per_row = dict()
+s3_block_size = 2 ** 20
+connection_pools = dict()
+s3_objects = dict()  # s3 URL -> local path, objects are looked up once per process
 
 
-def get_chunksize(df_label: str = default_file_label, size_mb: float = deafult_size_mb):
+def get_bytes_per_row(
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    usecols: list = None,
+    dtype: dict = None,
+    n_rows: int = 10_000,
+    columnar: bool = default_columnar
+):
     """
-    Function to calculate chunk size based on memory we're ready to allocate while processing the file
+    Function estimating memory taken by a row of a chunk with the given columns and dtypes
+    from a sample of the first rows of the source chunks are read from: the columnar cache when it is fresh
+    (and columnar is asked, as read_csv does), the file otherwise
+    """
+    meta = get_columnar_meta(df_label=df_label) if columnar and not aws else None
+    key = (df_label, aws, meta is not None, tuple(usecols or ()), repr(sorted((dtype or dict()).items())))
+    if key not in bytes_per_row:
+        file_path = get_file_path(df_label=df_label, aws=aws)
+        if meta is not None:
+            sample = next(read_columnar(
+                df_label=df_label, size_mb=None, nrows=n_rows, usecols=usecols, dtype=dtype, meta=meta
+            ))
+        elif aws or os.path.exists(file_path):
+            sample = pd.read_csv(
+                file_path, nrows=n_rows, usecols=usecols, dtype=get_csv_dtype(dtype), engine='c', na_filter=False
+            )
+        else:
+            raise FileNotFoundError(file_path)
+        bytes_per_row[key] = sample.memory_usage(deep=True).sum() / max(1, len(sample))
+    return bytes_per_row[key]
+
+
+def get_chunksize(
+    df_label: str = default_file_label,
+    size_mb: float = deafult_size_mb,
+    usecols: list = None,
+    dtype: dict = None,
+    aws: bool = default_aws,
+    columnar: bool = default_columnar
+):
     """
-    if size_mb is not None:
-        total_size_mb = dataset_info.get(df_label, dict()).get('total_size_mb', 7000)
-        n_chunks = max(1, np.ceil(total_size_mb / size_mb))
-        total_n_rows = dataset_info.get(df_label, dict()).get('total_n_rows', None)
-        if total_n_rows:
-            return int(np.ceil(total_n_rows / n_chunks))
+    Function to calculate chunk size based on memory we're ready to allocate while processing the file,
+    memory per row of the requested columns is estimated from a sample of the file (or of its columnar cache)
+    Prefetched chunks (see prefetch_chunks) share the memory of a chunk with the processed one
+    """
+    if size_mb is None:
+        return None
+    row_bytes = get_bytes_per_row(df_label=df_label, aws=aws, usecols=usecols, dtype=dtype, columnar=columnar)
+    chunk_mb = size_mb * chunk_memory_share / (1 + default_prefetch)
+    return max(min_chunksize, int(chunk_mb * 2 ** 20 / max(1., row_bytes)))
+
+
+def get_rss_mb():
+    """
+    Function returning resident memory of the process in MB (None if it can not be measured)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss_mb():
+    """
+    Function returning peak resident memory of the process in MB (None if it can not be measured)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
     return None
 
 
+def get_chunk_row_bytes(chunk: pd.DataFrame, n_rows: int = 10_000) -> float:
+    """
+    Function measuring memory taken by a row of a chunk, strings are measured on its first n_rows rows
+    """
+    sample = chunk.iloc[:n_rows]
+    return sample.memory_usage(deep=True).sum() / max(1, len(sample))
+
+
+def get_adaptive_chunksizes(chunksize: int, size_mb: float = deafult_size_mb):
+    """
+    Generator of sizes of consecutive chunks: the caller sends the bytes per row measured on the last chunk
+    (see get_chunk_row_bytes) when it asks for the next size
+    Memory of the states is the resident memory of the process minus the chunks in flight (the processed one and
+    the prefetched ones), the next size fits the chunks in flight in chunk_memory_share of the budget left after it
+    Growing states shrink chunks only as much as they take from the budget: chunks stay between a quarter and
+    4 times the initial size, once states alone exceed the budget smaller chunks would not bring memory back into it
+    """
+    min_rows, max_rows = max(min_chunksize, chunksize // 4), 4 * chunksize
+    n_chunks = 1 + default_prefetch
+    while True:
+        row_bytes = yield chunksize
+        rss_mb = get_rss_mb()
+        if row_bytes is None or rss_mb is None or size_mb is None:
+            continue
+        state_mb = max(0., rss_mb - n_chunks * chunksize * row_bytes / 2 ** 20)
+        chunk_mb = max(0., size_mb - state_mb) * chunk_memory_share / n_chunks
+        chunksize = min(max_rows, max(min_rows, int(chunk_mb * 2 ** 20 / max(1., row_bytes))))
+
+
+def parse_size_mb(value) -> float:
+    """
+    Function parsing a memory budget given as MB (e.g. 1000) or with units (e.g. '2GB', '500MB')
+    """
+    units = {'kb': 2 ** -10, 'mb': 1, 'gb': 2 ** 10, 'tb': 2 ** 20}
+    value = str(value).strip().lower()
+    for unit, multiplier in units.items():
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * multiplier
+    return float(value)
+
+
+def get_s3_url(df_label=default_file_label):
+    return f"s3://sapienza2020adm/ecommerce/{df_label}.csv"
+
+
+class ConnectionPool:
+    """
+    Pool of persistent HTTP(S) connections to a host shared by the threads downloading parts of objects
+    """
+
+    def __init__(self, url: str, max_connections: int = default_s3_connections, timeout: float = 60.):
+        parsed = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' \
+            else http.client.HTTPConnection
+        self.host, self.port = parsed.hostname, parsed.port
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager lending a connection, a connection failing while it is used is dropped
+        """
+        with self.slots:
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self.connections.put(connection)
+
+    def request(self, method: str, path: str, headers: dict = None, write=None, retries: int = 3):
+        """
+        Function sending a request and returning (status, headers, body), with write the body
+        is passed to it in blocks instead (write(offset, block) with offset from the beginning of the body)
+        A request failing on a network error is retried on a new connection
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as connection:
+                    connection.request(method, path, headers=headers or dict())
+                    response = connection.getresponse()
+                    if write is None or response.status >= 300:
+                        return response.status, dict(response.getheaders()), response.read()
+                    offset, length = 0, response.length
+                    while True:
+                        block = response.read(s3_block_size)
+                        if not block:
+                            break
+                        write(offset, block)
+                        offset += len(block)
+                    # a connection closed by the server in the middle of the body ends it early
+                    if length is not None and offset != length:
+                        raise http.client.IncompleteRead(b'', length - offset)
+                    return response.status, dict(response.getheaders()), offset
+            except (OSError, http.client.HTTPException):
+                if attempt == retries:
+                    raise
+                time.sleep(2 ** attempt / 4)
+
+
+def get_connection_pool(url: str) -> ConnectionPool:
+    parsed = urllib.parse.urlsplit(url)
+    key = (parsed.scheme, parsed.netloc)
+    if key not in connection_pools:
+        connection_pools[key] = ConnectionPool(url, max_connections=default_s3_connections)
+    return connection_pools[key]
+
+
+def get_s3_http_url(url: str, endpoint: str = None) -> str:
+    """
+    Function translating s3://bucket/key to the HTTP(S) URL of the object, path-style for an endpoint
+    of an S3 compatible server (default_s3_endpoint) and virtual-hosted for AWS S3
+    """
+    bucket, key = url[len('s3://'):].split('/', 1)
+    endpoint = endpoint or default_s3_endpoint
+    if endpoint:
+        return f"{endpoint.rstrip('/')}/{bucket}/{urllib.parse.quote(key)}"
+    return f"https://{bucket}.s3.amazonaws.com/{urllib.parse.quote(key)}"
+
+
+def get_s3_object_path(url: str, size: int, etag: str, cache_path: str = None) -> str:
+    """
+    Function returning the path of a downloaded object in the disk cache, named by its content (ETag and size)
+    """
+    digest = hashlib.sha1(f"{etag}:{size}".encode()).hexdigest()
+    return os.path.join(cache_path or default_s3_cache_path, digest + os.path.splitext(url)[1])
+
+
+def evict_s3_objects(needed_size: int, keep: str, cache_path: str = None, cache_size_mb: float = None):
+    """
+    Function removing the least recently used objects of the disk cache until needed_size bytes fit in it
+    """
+    cache_path = cache_path or default_s3_cache_path
+    cache_size_mb = default_s3_cache_size_mb if cache_size_mb is None else cache_size_mb
+    entries = sorted(
+        (entry for entry in os.scandir(cache_path) if entry.is_file() and entry.path != keep
+         and not entry.name.endswith('.tmp')),
+        key=lambda entry: entry.stat().st_mtime_ns
+    )
+    cache_size = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if cache_size + needed_size <= cache_size_mb * 2 ** 20:
+            break
+        cache_size -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def fetch_s3_object(
+    url: str,
+    cache_path: str = None,
+    cache_size_mb: float = None,
+    part_mb: float = None
+) -> str:
+    """
+    Function returning the local path of an S3 object: a cached copy of the same content (ETag and size)
+    is used as it is, otherwise the object is downloaded with parallel byte range requests
+    over pooled connections (default_s3_connections) into the disk cache, evicting least recently used objects
+    """
+    cache_path = cache_path or default_s3_cache_path
+    http_url = get_s3_http_url(url)
+    pool = get_connection_pool(http_url)
+    path = urllib.parse.urlsplit(http_url).path
+    status, headers, _ = pool.request('HEAD', path)
+    if status != 200:
+        raise FileNotFoundError(f"{url}: HEAD returned {status}")
+    headers = {name.lower(): value for name, value in headers.items()}
+    size = int(headers['content-length'])
+    etag = headers.get('etag') or headers.get('last-modified')
+    object_path = get_s3_object_path(url, size=size, etag=etag, cache_path=cache_path)
+    if os.path.exists(object_path) and os.path.getsize(object_path) == size:
+        # a hit makes the object the most recently used
+        os.utime(object_path)
+        return object_path
+    os.makedirs(cache_path, exist_ok=True)
+    evict_s3_objects(size, keep=object_path, cache_path=cache_path, cache_size_mb=cache_size_mb)
+    part_size = max(s3_block_size, int((part_mb or default_s3_part_mb) * 2 ** 20))
+    parts = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    print(f"{url} | downloading {round(size / 2 ** 20, 2)} MB in {len(parts)} parts", end="", flush=True)
+    tmp_path = f"{object_path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+
+    def fetch_part(part: tuple):
+        start, stop = part
+        # If-Match fails the request if the object changes during the download
+        status, _, n_bytes = pool.request(
+            'GET', path,
+            headers={'Range': f"bytes={start}-{stop - 1}", **({'If-Match': etag} if 'etag' in headers else {})},
+            write=lambda offset, block: os.pwrite(fd, block, start + offset)
+        )
+        if status not in (200, 206) or n_bytes != stop - start:
+            raise IOError(f"{url}: bytes {start}-{stop - 1} returned {status} with {n_bytes} bytes")
+        print(".", end="", flush=True)
+
+    try:
+        os.ftruncate(fd, size)
+        with concurrent.futures.ThreadPoolExecutor(default_s3_connections) as executor:
+            list(executor.map(fetch_part, parts))
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, object_path)
+    print()
+    return object_path
+
+
 def get_file_path(df_label=default_file_label, aws=False):
     """
     Function to retrieve by a label either *.csv path of a file stored locally
-    or request downloading from a file located on AWS S3
+    or of a local copy of a file located on AWS S3 (see fetch_s3_object)
     """
     if aws:
-        return f"s3://sapienza2020adm/ecommerce/{df_label}.csv"
+        url = get_s3_url(df_label=df_label)
+        if url not in s3_objects:
+            s3_objects[url] = fetch_s3_object(url)
+        return s3_objects[url]
     return f"datasets/{df_label}.csv"
 
 
+# event_time layouts ('0' stands for a digit): the ' UTC' suffix is optional
+event_time_layouts = (b'0000-00-00 00:00:00 UTC', b'0000-00-00 00:00:00')
+# epoch of values that are not timestamps, the same as NaT once converted to datetimes
+missing_epoch = np.iinfo(np.int64).min
+
+
+def get_layout_masks(layout: bytes) -> tuple:
+    """
+    Function returning masks checking 24 bytes (as three little endian uint64 words) against a layout:
+    word & high == expected holds for its fixed bytes and for the 0x30-0x3f range of its digits,
+    ((word & low) + six) & carry == 0 rules out ':' to '?' (0x3a-0x3f) in place of digits
+    """
+    layout = np.frombuffer(layout.ljust(24, b'\0'), dtype=np.uint8)
+    is_digit = layout == ord('0')
+    masks = (
+        np.where(is_digit, 0xf0, 0xff),
+        np.where(is_digit, 0x30, layout),
+        np.where(is_digit, 0x0f, 0),
+        np.where(is_digit, 0x06, 0),
+        np.where(is_digit, 0x10, 0),
+    )
+    return tuple(mask.astype(np.uint8).view('<u8') for mask in masks)
+
+
+def event_time_to_epoch(values) -> np.ndarray:
+    """
+    Fast parser of fixed layout 'YYYY-mm-dd HH:MM:SS UTC' timestamps into int64 epoch seconds:
+    digits are sliced out of the bytes of the whole column at once instead of parsing row by row
+    Values not in this layout or with fields out of range (e.g. empty or 'nan') become missing_epoch
+    """
+    values = np.asarray(values)
+    try:
+        chars = values.astype('S24').view(np.uint8).reshape(-1, 24)
+    except UnicodeEncodeError:
+        # non ASCII values can not be timestamps
+        chars = np.array([v if isinstance(v, str) and v.isascii() else '' for v in values], dtype='S24') \
+            .view(np.uint8).reshape(-1, 24)
+    # check the layout 8 bytes at a time, one contiguous column of words after the other
+    words = np.ascontiguousarray(np.ascontiguousarray(chars).view('<u8').T)
+    valid = np.zeros(len(chars), dtype=bool)
+    for layout in event_time_layouts:
+        matches = np.ones(len(chars), dtype=bool)
+        for word, high, expected, low, six, carry in zip(words, *get_layout_masks(layout)):
+            matches &= (word & high) == expected
+            matches &= ((word & low) + six) & carry == 0
+        valid |= matches
+    digits = chars[:, :19] - np.uint8(ord('0'))
+
+    def number(start, stop):
+        n = np.zeros(len(chars), dtype=np.int64)
+        for i in range(start, stop):
+            n = n * 10 + digits[:, i]
+        return n
+
+    year, month, day = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (hour < 24) & (minute < 60) & (second < 60)
+    # days since 1970-01-01 of a proleptic Gregorian date (eras of 400 years)
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return np.where(valid, days * 86400 + hour * 3600 + minute * 60 + second, missing_epoch)
+
+
+def epoch_to_datetime(seconds) -> np.ndarray:
+    """
+    Function converting int64 epoch seconds into (timezone naive, UTC) datetime64[ns], missing_epoch into NaT
+    """
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return np.where(seconds == missing_epoch, missing_epoch, seconds * 10 ** 9).view('datetime64[ns]')
+
+
+def epoch_to_event_time(seconds) -> np.ndarray:
+    """
+    Function formatting int64 epoch seconds as 'YYYY-mm-dd HH:MM:SS UTC' strings (the inverse of
+    event_time_to_epoch), every distinct second is formatted once, missing_epoch as an empty string
+    """
+    uniques, inverse = np.unique(np.asarray(seconds, dtype=np.int64), return_inverse=True)
+    chars = np.full((len(uniques), 23), ord(' '), dtype=np.uint8)
+    chars[:, :19] = np.datetime_as_string(uniques.view('datetime64[s]'), unit='s').astype('S19') \
+        .view(np.uint8).reshape(-1, 19)
+    chars[:, 10] = ord(' ')
+    chars[:, 19:] = np.frombuffer(b' UTC', dtype=np.uint8)
+    strings = chars.view('S23').ravel().astype(str).astype(object)
+    strings[uniques == missing_epoch] = ''
+    return strings[inverse]
+
+
+def parse_event_time_column(chunk: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function replacing event_time strings of a chunk with datetimes using the fast parser
+    """
+    if 'event_time' in chunk.columns and chunk['event_time'].dtype == object:
+        chunk['event_time'] = epoch_to_datetime(event_time_to_epoch(chunk['event_time'].values))
+    return chunk
+
+
+# Binary layout of the columnar cache: categorical columns are dictionary-encoded,
+# event_time is kept as int64 epoch seconds, the rest as plain numpy arrays
+# (price as float64, so that it comes back exactly as pd.read_csv parses it)
+columnar_schema = {
+    'event_time': 'datetime',
+    'event_type': 'category',
+    'product_id': np.uint32,
+    'category_id': np.int64,
+    'category_code': 'category',
+    'brand': 'category',
+    'price': np.float64,
+    'user_id': np.uint32,
+    'user_session': 'category',
+}
+columnar_version = 2  # caches written with another layout are rebuilt
+columnar_codes_dtype = np.uint32
+# user_session asked with this dtype comes as integer codes of the session dictionary of the file
+session_codes_dtype = np.uint32
+
+
+def is_codes_dtype(col_type) -> bool:
+    """
+    Function telling whether a categorical column is asked as integer codes instead of strings
+    """
+    return isinstance(col_type, type) and issubclass(col_type, np.integer)
+
+
+def get_csv_dtype(dtype: dict = None):
+    """
+    Function returning dtypes to be passed to pd.read_csv, columns asked as codes are read as strings first
+    """
+    if dtype is None:
+        return None
+    return {col: str if columnar_schema.get(col) == 'category' and is_codes_dtype(col_type) else col_type
+            for col, col_type in dtype.items()}
+
+
+def get_columnar_path(df_label=default_file_label):
+    """
+    Function to retrieve by a label the folder of the columnar cache of a file
+    """
+    return f"datasets/{df_label}.columnar"
+
+
+def get_source_fingerprint(df_label=default_file_label):
+    """
+    Function to describe the source *.csv file, used to detect a stale columnar cache
+    """
+    stat = os.stat(get_file_path(df_label=df_label))
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def get_columnar_meta(df_label=default_file_label, columnar_path: str = None):
+    """
+    Function returning meta information of the columnar cache or None if the cache is missing or stale
+    """
+    meta_path = os.path.join(columnar_path or get_columnar_path(df_label=df_label), 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != columnar_version:
+        return None
+    # if the source file is gone the cache is all we have
+    if os.path.exists(get_file_path(df_label=df_label)) and \
+            meta.get('source') != get_source_fingerprint(df_label=df_label):
+        return None
+    return meta
+
+
+def encode_columnar(chunk: pd.DataFrame, col: str, dictionaries: dict) -> np.ndarray:
+    """
+    Function encoding a column of a chunk into the binary layout of the columnar cache
+    """
+    col_type = columnar_schema[col]
+    if col_type == 'category':
+        # factorize the chunk and translate only its unique values to global codes
+        local_codes, uniques = pd.factorize(chunk[col])
+        dictionary = dictionaries.setdefault(col, dict())
+        mapper = np.array(
+            [dictionary.setdefault(value, len(dictionary)) for value in uniques],
+            dtype=columnar_codes_dtype
+        )
+        return mapper[local_codes]
+    if col_type == 'datetime':
+        return event_time_to_epoch(chunk[col].values)
+    return chunk[col].values.astype(col_type)
+
+
+def save_columnar_dictionaries(columnar_path: str, dictionaries: dict) -> dict:
+    """
+    Function saving dictionaries of categorical columns and rewriting their codes with the smallest
+    unsigned integer type fitting the dictionary, returns the types to be kept in meta.json
+    """
+    codes_dtypes = dict()
+    for col, dictionary in dictionaries.items():
+        np.save(os.path.join(columnar_path, f"{col}.categories.npy"), np.array(list(dictionary), dtype=str))
+        codes_dtype = np.min_scalar_type(max(0, len(dictionary) - 1))
+        if codes_dtype != columnar_codes_dtype:
+            codes_path = os.path.join(columnar_path, f"{col}.bin")
+            codes = np.memmap(codes_path, dtype=columnar_codes_dtype, mode='r')
+            with open(codes_path + '.tmp', 'wb') as f:
+                for start in range(0, len(codes), 2 ** 24):
+                    codes[start:start + 2 ** 24].astype(codes_dtype).tofile(f)
+            del codes
+            os.replace(codes_path + '.tmp', codes_path)
+        codes_dtypes[col] = codes_dtype.name
+    return codes_dtypes
+
+
+def convert_to_columnar(
+    df_label: str = default_file_label,
+    size_mb: float = deafult_size_mb,
+    **kwargs
+):
+    """
+    One-time conversion of a *.csv file into a column-per-file binary store,
+    later served by read_csv through memory mapping
+    """
+    columnar_path = get_columnar_path(df_label=df_label)
+    tmp_path = columnar_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    source = get_source_fingerprint(df_label=df_label)
+    reader = read_csv(
+        df_label=df_label,
+        size_mb=size_mb or deafult_size_mb,
+        dtype={
+            col: str if col_type in ('category', 'datetime') else col_type
+            for col, col_type in columnar_schema.items()
+        },
+        columnar=False
+    )
+    # global dictionaries value -> code for every categorical column
+    dictionaries = dict()
+    files = {col: open(os.path.join(tmp_path, f"{col}.bin"), 'wb') for col in columnar_schema}
+    n_rows = 0
+    try:
+        with ChunkTelemetry(f"{df_label} | convert_to_columnar") as telemetry:
+            for chunk in telemetry.chunks(prefetch_chunks(reader)):
+                for col in columnar_schema:
+                    encode_columnar(chunk, col, dictionaries).tofile(files[col])
+                n_rows += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+    codes_dtypes = save_columnar_dictionaries(tmp_path, dictionaries)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({
+            'columns': list(columnar_schema),
+            'n_rows': n_rows,
+            'source': source,
+            'codes_dtypes': codes_dtypes,
+            'version': columnar_version,
+        }, f)
+    shutil.rmtree(columnar_path, ignore_errors=True)
+    os.rename(tmp_path, columnar_path)
+    print(f"\n{df_label + ' | ' if df_label else ''}Columnar cache with {n_rows} rows saved to {columnar_path}")
+
+
+def read_columnar(
+    df_label: str = default_file_label,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    usecols: list = None,
+    dtype: dict = None,
+    meta: dict = None,
+    start_row: int = 0,
+    parse_event_time: bool = False,
+    columnar_path: str = None,
+    parse_dates: list = None
+):
+    """
+    Generator of chunks served from the columnar cache, columns are memory mapped
+    and decoded to match what pd.read_csv would have returned with the same dtypes
+    (event_time as strings unless it is parsed, numbers as int64/float64 unless other dtypes are asked)
+    Without size_mb there is a single chunk, empty if there are no rows
+    """
+    columnar_path = columnar_path or get_columnar_path(df_label=df_label)
+    meta = meta or get_columnar_meta(df_label=df_label, columnar_path=columnar_path)
+    dtype = dtype or dict()
+    # keep file order of columns as pd.read_csv does
+    columns = [col for col in meta['columns'] if usecols is None or col in usecols]
+    n_rows = meta['n_rows'] if nrows is None else min(start_row + nrows, meta['n_rows'])
+    chunksize = get_chunksize(df_label=df_label, size_mb=size_mb, usecols=usecols, dtype=dtype) \
+        or max(1, n_rows - start_row)
+    arrays, categories = dict(), dict()
+    for col in columns:
+        col_type = columnar_schema[col]
+        arrays[col] = np.memmap(
+            os.path.join(columnar_path, f"{col}.bin"),
+            dtype=meta.get('codes_dtypes', dict()).get(col, columnar_codes_dtype) if col_type == 'category' else
+            np.int64 if col_type == 'datetime' else col_type,
+            mode='r',
+            shape=(meta['n_rows'],)
+        )
+        # dictionaries are not needed when codes are asked
+        if col_type == 'category' and not is_codes_dtype(dtype.get(col)):
+            categories[col] = np.load(os.path.join(columnar_path, f"{col}.categories.npy")).astype(object)
+
+    def decode(start, stop):
+        chunk = dict()
+        for col in columns:
+            values = arrays[col][start:stop]
+            col_type = columnar_schema[col]
+            if col_type == 'category':
+                if dtype.get(col) == 'category':
+                    chunk[col] = pd.Categorical.from_codes(values, categories=categories[col])
+                elif is_codes_dtype(dtype.get(col)):
+                    chunk[col] = np.asarray(values).astype(dtype[col])
+                else:
+                    chunk[col] = categories[col].take(values)
+            elif col_type == 'datetime' and parse_event_time:
+                chunk[col] = epoch_to_datetime(values)
+            elif col_type == 'datetime' and (col in (parse_dates or ()) or str(dtype.get(col)).startswith('datetime')):
+                # timezone aware, the same as pd.to_datetime of the original strings
+                chunk[col] = pd.to_datetime(np.array(values), unit='s', utc=True)
+            elif col_type == 'datetime':
+                # the original strings, as pd.read_csv returns them
+                chunk[col] = epoch_to_event_time(values)
+            else:
+                # numbers come with the dtype pd.read_csv would infer unless another one is asked
+                default_type = np.int64 if np.issubdtype(col_type, np.integer) else np.float64
+                chunk[col] = np.asarray(values).astype(dtype.get(col, default_type))
+        return pd.DataFrame(chunk, index=pd.RangeIndex(start, stop))
+
+    if size_mb is None and start_row >= n_rows:
+        yield decode(start_row, start_row)
+        return
+    start = start_row
+    chunk_sizes = get_adaptive_chunksizes(chunksize, size_mb=size_mb)
+    chunk_rows = next(chunk_sizes)
+    while start < n_rows:
+        stop = min(start + chunk_rows, n_rows)
+        chunk = decode(start, stop)
+        yield chunk
+        start = stop
+        chunk_rows = chunk_sizes.send(get_chunk_row_bytes(chunk))
+
+
+def read_adaptive_chunks(reader, chunksize: int, size_mb: float = deafult_size_mb):
+    """
+    Generator of chunks of a pd.read_csv iterator with sizes adapted to the memory budget
+    """
+    chunk_sizes = get_adaptive_chunksizes(chunksize, size_mb=size_mb)
+    chunk_rows = next(chunk_sizes)
+    with reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(chunk_rows)
+            except StopIteration:
+                return
+            yield chunk
+            chunk_rows = chunk_sizes.send(get_chunk_row_bytes(chunk))
+
+
+def configure_prefetch(n_chunks: int = default_prefetch):
+    """
+    Function setting the number of chunks parsed ahead by the following scans (see prefetch_chunks)
+    """
+    global default_prefetch
+    default_prefetch = n_chunks
+
+
+def prefetch_chunks(reader, n_chunks: int = None):
+    """
+    Generator of chunks of a reader parsed ahead on a background thread: while a chunk is processed
+    up to n_chunks following ones are read (tokenizing of pandas and decoding of numpy release the GIL),
+    a semaphore keeps at most n_chunks + 1 chunks in memory
+    Drop-in replacement of a reader in a chunk loop, a DataFrame (no chunks) and n_chunks=0 are passed through
+    """
+    n_chunks = default_prefetch if n_chunks is None else n_chunks
+    if isinstance(reader, pd.DataFrame) or not n_chunks:
+        yield from [reader] if isinstance(reader, pd.DataFrame) else reader
+        return
+    chunks = queue.Queue()
+    slots = threading.Semaphore(n_chunks + 1)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            iterator = iter(reader)
+            while True:
+                # a slot is freed once the consumer is done with a chunk
+                slots.acquire()
+                if stop.is_set():
+                    break
+                chunk = next(iterator, None)
+                if chunk is None:
+                    break
+                chunks.put((chunk, None))
+        except BaseException as e:
+            chunks.put((None, e))
+        finally:
+            if hasattr(reader, 'close'):
+                reader.close()
+            chunks.put((None, None))
+
+    thread = threading.Thread(target=produce, name='prefetch_chunks', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk, error = chunks.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+            slots.release()
+    finally:
+        # wake the producer if it waits for a slot, it stops before reading another chunk
+        stop.set()
+        slots.release()
+        thread.join()
+
+
 def read_csv(
     df_label: str = default_file_label,
     aws: bool = default_aws,
@@ -69,20 +802,1718 @@ def read_csv(
     usecols: list = None,
     dtype: dict = None,
     parse_dates: list = False,
-    date_parser=None
+    date_parser=None,
+    columnar: bool = default_columnar,
+    parse_event_time: bool = False
 ):
     """
     Key function to retrieve data (in chunks by default)
+    Data is served from the columnar cache when it is available and fresh
+    With parse_event_time event_time comes as timezone naive (UTC) datetimes parsed by the fast parser
     """
-    return pd.read_csv(
+    # dates other than event_time are parsed by pd.read_csv
+    if columnar and not aws and set(parse_dates or ()) <= {'event_time'}:
+        meta = get_columnar_meta(df_label=df_label)
+        if meta is not None:
+            chunks = read_columnar(
+                df_label=df_label,
+                size_mb=size_mb,
+                nrows=nrows,
+                usecols=usecols,
+                dtype=dtype,
+                meta=meta,
+                parse_event_time=parse_event_time,
+                parse_dates=parse_dates
+            )
+            # without size_mb a single frame, as pd.read_csv returns
+            return chunks if size_mb is not None else next(chunks)
+    chunksize = get_chunksize(
+        df_label=df_label, size_mb=size_mb, usecols=usecols, dtype=dtype, aws=aws, columnar=False
+    )
+    reader = pd.read_csv(
         get_file_path(df_label=df_label, aws=aws),
         usecols=usecols,
-        dtype=dtype,
+        dtype=get_csv_dtype(dtype),
         engine='c',
         na_filter=False,
         memory_map=True,
-        chunksize=get_chunksize(df_label=df_label, size_mb=size_mb),
+        iterator=chunksize is not None,
         nrows=nrows,
         parse_dates=parse_dates,
         date_parser=date_parser
     )
+    if chunksize is not None:
+        reader = read_adaptive_chunks(reader, chunksize=chunksize, size_mb=size_mb)
+    if not parse_event_time and not is_codes_dtype((dtype or dict()).get('user_session')):
+        return reader
+    if isinstance(reader, pd.DataFrame):
+        return prepare_csv_chunk(reader, df_label=df_label, aws=aws, dtype=dtype, parse_event_time=parse_event_time)
+    return (
+        prepare_csv_chunk(chunk, df_label=df_label, aws=aws, dtype=dtype, parse_event_time=parse_event_time)
+        for chunk in reader
+    )
+
+
+def prepare_csv_chunk(
+    chunk: pd.DataFrame,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    dtype: dict = None,
+    parse_event_time: bool = False
+) -> pd.DataFrame:
+    """
+    Function bringing a chunk parsed by pd.read_csv to what the columnar cache serves:
+    user_session asked as codes is encoded with the session dictionary, event_time is parsed if asked
+    """
+    col_type = (dtype or dict()).get('user_session')
+    if 'user_session' in chunk.columns and is_codes_dtype(col_type):
+        chunk['user_session'] = encode_sessions(
+            chunk['user_session'].values, df_label=df_label, aws=aws, dtype=col_type
+        )
+    return parse_event_time_column(chunk) if parse_event_time else chunk
+
+
+def get_sessions_path(df_label=default_file_label):
+    """
+    Function to retrieve by a label the path of the session dictionary of a file
+    """
+    return f"datasets/{df_label}.sessions.npy"
+
+
+session_dictionaries = dict()
+
+
+def get_session_dictionary(
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb
+) -> pd.Index:
+    """
+    Function returning the session dictionary of a file: every user_session in order of first appearance,
+    the position of a session is its integer code (the same codes as in the columnar cache)
+    It is taken from the columnar cache when available, otherwise built with a single scan of the file
+    only if it is missing or older than the file
+    """
+    if df_label in session_dictionaries:
+        return session_dictionaries[df_label]
+    sessions_path = get_sessions_path(df_label=df_label)
+    file_path = get_file_path(df_label=df_label)
+    meta = None if aws else get_columnar_meta(df_label=df_label)
+    if meta is not None and 'user_session' in meta['columns']:
+        sessions = np.load(os.path.join(get_columnar_path(df_label=df_label), 'user_session.categories.npy'))
+    elif os.path.exists(sessions_path) and (
+        aws or not os.path.exists(file_path) or os.path.getmtime(sessions_path) >= os.path.getmtime(file_path)
+    ):
+        sessions = np.load(sessions_path)
+    else:
+        print(f"{df_label} | building the session dictionary", end="")
+        dictionaries = dict()
+        reader = read_csv(
+            df_label=df_label, aws=aws, size_mb=size_mb or deafult_size_mb,
+            usecols=['user_session'], dtype={'user_session': str}, columnar=False
+        )
+        with ChunkTelemetry(f"{df_label} | session dictionary") as telemetry:
+            for chunk in telemetry.chunks(prefetch_chunks(reader)):
+                encode_columnar(chunk, 'user_session', dictionaries)
+        print()
+        sessions = np.array(list(dictionaries.get('user_session', dict())), dtype=str)
+        np.save(sessions_path, sessions)
+    session_dictionaries[df_label] = pd.Index(sessions.astype(object))
+    return session_dictionaries[df_label]
+
+
+def encode_sessions(
+    sessions: np.ndarray,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    dtype=session_codes_dtype
+) -> np.ndarray:
+    """
+    Function translating user_session strings into integer codes of the session dictionary of a file
+    """
+    return get_session_dictionary(df_label=df_label, aws=aws).get_indexer(sessions).astype(dtype)
+
+
+def get_month_labels(start: str = None, end: str = None, labels: list = None) -> list:
+    """
+    Function selecting labels of months (e.g. '2019-Oct') between start and end (inclusive,
+    any format understood by pd.Period, e.g. '2019-Oct' or '2019-10') in chronological order
+    """
+    labels = df_labels if labels is None else labels
+    months = {label: pd.Period(label, 'M') for label in labels}
+    return sorted(
+        [
+            label for label, month in months.items()
+            if (start is None or month >= pd.Period(start, 'M')) and (end is None or month <= pd.Period(end, 'M'))
+        ],
+        key=months.get
+    )
+
+
+def read_months(
+    df_labels: list = df_labels,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    usecols: list = None,
+    dtype: dict = None,
+    columnar: bool = default_columnar,
+    parse_event_time: bool = False
+):
+    """
+    Generator of chunks of several months one after another (nrows is applied to every month),
+    chunks get a categorical 'month' column holding the label of their file
+    """
+    usecols = None if usecols is None else [col for col in usecols if col != 'month']
+    dtype = None if dtype is None else {col: col_type for col, col_type in dtype.items() if col != 'month'}
+    for i, df_label in enumerate(df_labels):
+        reader = read_csv(
+            df_label=df_label,
+            aws=aws,
+            size_mb=size_mb,
+            nrows=nrows,
+            usecols=usecols,
+            dtype=dtype,
+            columnar=columnar,
+            parse_event_time=parse_event_time
+        )
+        for chunk in [reader] if isinstance(reader, pd.DataFrame) else reader:
+            chunk['month'] = pd.Categorical.from_codes(np.full(len(chunk), i, dtype=np.int8), categories=df_labels)
+            yield chunk
+
+
+class StreamingAggregator:
+    """
+    Incremental group by: every group is a tuple of integer codes of its key columns (integer columns are their
+    own codes, other columns are encoded against global dictionaries) kept in numpy arrays sorted by codes
+    with the aggregates, chunks are reduced with a sort and folded in with the state once pending groups
+    are as many as the state (see rq3.BrandProductPrices), so each update costs O(chunk log chunk) amortized
+    """
+    functions = ('count', 'sum', 'max', 'min')
+    reducers = {'count': np.add, 'sum': np.add, 'max': np.maximum, 'min': np.minimum}
+
+    def __init__(self, keys: list, aggregations: dict = None):
+        self.keys = list(keys)
+        # output column -> (input column, function), by default just count rows per group
+        self.aggregations = aggregations or {'n_events': (None, 'count')}
+        for _, func in self.aggregations.values():
+            if func not in self.functions:
+                raise ValueError(f"Aggregation '{func}' is not supported, use one of {self.functions}")
+        # values of every key column not encoded as themselves, position in the index is the code
+        self.dictionaries = [pd.Index([], dtype=object) for _ in self.keys]
+        self.integer_keys = None
+        # codes of every key column and aggregates of every group, sorted by codes
+        self.codes = [np.zeros(0, dtype=np.int64) for _ in self.keys]
+        self.states = dict()
+        self.pending, self.n_pending = list(), 0
+
+    @staticmethod
+    def _state_dtype(func, dtype):
+        if func == 'count':
+            return np.int64
+        if func == 'sum':
+            return np.int64 if np.issubdtype(dtype, np.integer) else np.float64
+        return np.dtype(dtype)
+
+    def _encode(self, i: int, values) -> np.ndarray:
+        """
+        Map values of the i-th key column to global codes (-1 for missing values), extending the dictionary
+        """
+        if self.integer_keys[i]:
+            return np.asarray(values).astype(np.int64)
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object)
+        mapper = self.dictionaries[i].get_indexer(uniques)
+        new = mapper < 0
+        if new.any():
+            mapper[new] = len(self.dictionaries[i]) + np.arange(np.count_nonzero(new))
+            self.dictionaries[i] = self.dictionaries[i].append(pd.Index(uniques[new], dtype=object))
+        # code -1 of missing values is kept
+        return np.r_[mapper, -1][codes]
+
+    @staticmethod
+    def _sort_order(codes: list) -> np.ndarray:
+        """
+        Order sorting tuples of codes, codes are packed into one integer when they fit in 63 bits
+        """
+        # integer columns may be negative, they are packed as offsets from their minimum
+        offsets = [column.min() for column in codes]
+        widths = [int(column.max() - offset).bit_length() for column, offset in zip(codes, offsets)]
+        if sum(widths) > 63:
+            return np.lexsort(codes[::-1])
+        packed = np.zeros(len(codes[0]), dtype=np.int64)
+        for column, offset, width in zip(codes, offsets, widths):
+            packed = (packed << width) | (column - offset)
+        return np.argsort(packed, kind='stable')
+
+    def _reduce(self, codes: list, states: dict) -> tuple:
+        """
+        Aggregate values of equal tuples of codes, returns sorted unique tuples and their aggregates
+        """
+        if not len(codes[0]):
+            return codes, states
+        order = self._sort_order(codes)
+        codes = [column[order] for column in codes]
+        changes = np.zeros(len(order), dtype=bool)
+        changes[0] = True
+        for column in codes:
+            changes[1:] |= column[1:] != column[:-1]
+        starts = np.flatnonzero(changes)
+        return (
+            [column[starts] for column in codes],
+            {
+                output: self.reducers[func].reduceat(states[output][order], starts)
+                for output, (_, func) in self.aggregations.items()
+            }
+        )
+
+    def _add(self, codes: list, states: dict):
+        if not self.states:
+            self.states = {output: np.zeros(0, dtype=state.dtype) for output, state in states.items()}
+        self.pending.append((codes, states))
+        self.n_pending += len(codes[0])
+        # fold in when pending groups are as many as the state: amortized cost proportional to chunks
+        if self.n_pending >= max(len(self.codes[0]), 2 ** 16):
+            self._compact()
+
+    def _compact(self):
+        if not self.pending:
+            return
+        self.codes, self.states = self._reduce(
+            [
+                np.concatenate([column] + [codes[i] for codes, _ in self.pending])
+                for i, column in enumerate(self.codes)
+            ],
+            {
+                output: np.concatenate([state] + [states[output] for _, states in self.pending])
+                for output, state in self.states.items()
+            }
+        )
+        self.pending, self.n_pending = list(), 0
+
+    def update(self, chunk: pd.DataFrame):
+        if chunk.empty:
+            return
+        if self.integer_keys is None:
+            self.integer_keys = [pd.api.types.is_integer_dtype(chunk[key].dtype) for key in self.keys]
+        codes = [self._encode(i, chunk[key].values) for i, key in enumerate(self.keys)]
+        # missing values of encoded columns are dropped as groupby does
+        valid = np.logical_and.reduce([
+            column >= 0 for column, is_integer in zip(codes, self.integer_keys) if not is_integer
+        ] or [np.ones(len(chunk), dtype=bool)])
+        if not valid.all():
+            chunk = chunk[valid]
+            codes = [column[valid] for column in codes]
+            if chunk.empty:
+                return
+        states = dict()
+        for output, (column, func) in self.aggregations.items():
+            if func == 'count':
+                states[output] = np.ones(len(chunk), dtype=np.int64)
+            else:
+                values = chunk[column].values
+                states[output] = values.astype(self._state_dtype(func, values.dtype))
+        # aggregate within the chunk first, then fold into the global state
+        self._add(*self._reduce(codes, states))
+
+    def merge(self, other: 'StreamingAggregator') -> 'StreamingAggregator':
+        """
+        Fold in the aggregates computed by another aggregator (e.g. over another part of a file)
+        """
+        other._compact()
+        if not len(other.codes[0]):
+            return self
+        if self.integer_keys is None:
+            self.integer_keys = other.integer_keys
+        codes = [
+            column if self.integer_keys[i] else self._encode(i, other.dictionaries[i])[column]
+            for i, column in enumerate(other.codes)
+        ]
+        self._add(codes, other.states)
+        return self
+
+    def finalize(self) -> pd.DataFrame:
+        self._compact()
+        levels = [
+            pd.Index(column, name=key) if self.integer_keys and self.integer_keys[i]
+            else self.dictionaries[i].take(column).rename(key)
+            for i, (key, column) in enumerate(zip(self.keys, self.codes))
+        ]
+        index = levels[0] if len(levels) == 1 else pd.MultiIndex.from_arrays(levels, names=self.keys)
+        return pd.DataFrame(
+            {
+                output: self.states[output] if self.states else np.empty(0, dtype=np.int64)
+                for output in self.aggregations
+            },
+            index=index
+        )
+
+
+class QuantileSketch:
+    """
+    Streaming quantile sketch for non-negative values: values are counted in logarithmic buckets,
+    so quantiles come with a bounded relative error and memory does not grow with the number of values
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1.):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        # values below min_value are counted as zeros
+        self.min_value = min_value
+        self.n_zeros = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _bucket(self, values: np.ndarray) -> np.ndarray:
+        return np.ceil(np.log(values / self.min_value) / np.log(self.gamma)).astype(np.int64)
+
+    def _grow(self, size: int):
+        if size > len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        positive = values >= self.min_value
+        self.n_zeros += int((~positive).sum())
+        if positive.any():
+            buckets = self._bucket(values[positive])
+            self._grow(int(buckets.max()) + 1)
+            self.counts += np.bincount(buckets, minlength=len(self.counts))
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        self.n_zeros += other.n_zeros
+        self._grow(len(other.counts))
+        self.counts[:len(other.counts)] += other.counts
+        return self
+
+    @property
+    def count(self) -> int:
+        return self.n_zeros + int(self.counts.sum())
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.n_zeros:
+            return 0.
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank - self.n_zeros, side='right'))
+        # middle of the bucket in terms of relative error
+        return self.min_value * 2 * self.gamma ** bucket / (self.gamma + 1)
+
+
+class DistinctCounter:
+    """
+    Streaming number of distinct integer values (e.g. user_id): exact or approximate with HyperLogLog
+    of a given relative error
+    Exact counters keep sorted distinct values while they are sparse and a bitmap over the range of values
+    seen so far once it is smaller, above max_mb an exact counter falls back to HyperLogLog
+    """
+    modes = ('exact', 'hll')
+    # number of set bits of every byte
+    popcounts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+
+    def __init__(self, mode: str = 'exact', error: float = 0.01, max_mb: float = default_distinct_max_mb):
+        if mode not in self.modes:
+            raise ValueError(f"Mode '{mode}' is not supported, use one of {self.modes}")
+        self.mode = mode
+        self.max_mb = max_mb
+        # standard error of HyperLogLog is about 1.04 / sqrt(number of registers)
+        self.precision = int(np.clip(np.ceil(np.log2((1.04 / error) ** 2)), 4, 18))
+        if mode == 'exact':
+            # sorted distinct values, None once values are kept in the bitmap
+            self.values = np.zeros(0, dtype=np.int64)
+            self.pending, self.n_pending = list(), 0
+            # bit i of the bitmap stands for value offset + i
+            self.offset = 0
+            self.bits = np.zeros(0, dtype=np.uint8)
+        else:
+            self.registers = np.zeros(2 ** self.precision, dtype=np.uint8)
+
+    def _grow(self, low: int, high: int):
+        """
+        Extend the bitmap to cover values from low to high, with slack to keep growing amortized O(1)
+        """
+        if not len(self.bits):
+            self.offset = low - low % 8
+            self.bits = np.zeros((high - self.offset) // 8 + 1, dtype=np.uint8)
+            return
+        start, stop = self.offset // 8, self.offset // 8 + len(self.bits)
+        if low // 8 >= start and high // 8 < stop:
+            return
+        slack = len(self.bits)
+        new_start = start if low // 8 >= start else min(low // 8, start - slack)
+        new_stop = stop if high // 8 < stop else max(high // 8 + 1, stop + slack)
+        bits = np.zeros(new_stop - new_start, dtype=np.uint8)
+        bits[start - new_start:stop - new_start] = self.bits
+        self.offset, self.bits = new_start * 8, bits
+
+    def _set_bits(self, values: np.ndarray):
+        """
+        Set bits of sorted distinct values in the bitmap
+        """
+        self._grow(int(values[0]), int(values[-1]))
+        positions = values - self.offset
+        byte_positions = positions >> 3
+        bit_values = np.left_shift(1, positions & 7).astype(np.uint8)
+        # positions are sorted, so bits of the same byte are neighbours and can be or-ed together
+        starts = np.flatnonzero(np.r_[True, byte_positions[1:] != byte_positions[:-1]])
+        self.bits[byte_positions[starts]] |= np.bitwise_or.reduceat(bit_values, starts)
+
+    def _compact(self):
+        """
+        Fold pending values into the sorted distinct values, switch to the bitmap once it takes less memory
+        """
+        if self.pending:
+            self.values = np.unique(np.concatenate([self.values] + self.pending))
+            self.pending, self.n_pending = list(), 0
+        if len(self.values) and self.values.nbytes > (self.values[-1] - self.values[0]) // 8 + 1:
+            self._set_bits(self.values)
+            self.values = None
+
+    def _get_values(self) -> np.ndarray:
+        """
+        Sorted distinct values counted so far by an exact counter
+        """
+        if self.values is not None:
+            self._compact()
+        if self.values is not None:
+            return self.values
+        return self.offset + np.flatnonzero(np.unpackbits(self.bits, bitorder='little'))
+
+    def _get_size(self) -> int:
+        if self.values is None:
+            return self.bits.nbytes
+        return self.values.nbytes + 8 * self.n_pending
+
+    def _to_hll(self):
+        """
+        Fall back from exact counting to HyperLogLog
+        """
+        values = self._get_values()
+        self.mode = 'hll'
+        self.registers = np.zeros(2 ** self.precision, dtype=np.uint8)
+        del self.values, self.pending, self.n_pending, self.offset, self.bits
+        for start in range(0, len(values), 2 ** 22):
+            self.update(values[start:start + 2 ** 22])
+
+    @staticmethod
+    def _hash(values: np.ndarray) -> np.ndarray:
+        # splitmix64 finalizer, uint64 arithmetic wraps around
+        x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+    @staticmethod
+    def _leading_zeros(x: np.ndarray) -> np.ndarray:
+        n = np.zeros(len(x), dtype=np.int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            small = x < (np.uint64(1) << np.uint64(64 - shift))
+            n[small] += shift
+            x = np.where(small, x << np.uint64(shift), x)
+        return n + (x == 0)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        if not len(values):
+            return
+        if self.mode == 'exact':
+            values = np.unique(values)
+            if self.values is None:
+                self._set_bits(values)
+            else:
+                self.pending.append(values)
+                self.n_pending += len(values)
+                # fold in when pending values are as many as the state: amortized cost proportional to chunks
+                if self.n_pending >= max(len(self.values), 2 ** 16):
+                    self._compact()
+            if self.max_mb is not None and self._get_size() > self.max_mb * 2 ** 20:
+                self._to_hll()
+        else:
+            hashes = self._hash(values)
+            registers = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+            ranks = np.minimum(self._leading_zeros(hashes << np.uint64(self.precision)), 64 - self.precision) + 1
+            np.maximum.at(self.registers, registers, ranks.astype(np.uint8))
+
+    def merge(self, other: 'DistinctCounter') -> 'DistinctCounter':
+        if self.mode == 'exact' and other.mode == 'exact':
+            if self.values is None and other.values is None:
+                if len(other.bits):
+                    self._grow(other.offset, other.offset + 8 * len(other.bits) - 1)
+                    start = (other.offset - self.offset) // 8
+                    self.bits[start:start + len(other.bits)] |= other.bits
+            else:
+                self.update(other._get_values())
+            return self
+        if self.mode == 'exact':
+            self._to_hll()
+        if other.mode == 'exact':
+            self.update(other._get_values())
+        else:
+            np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    @property
+    def count(self) -> int:
+        if self.mode == 'exact':
+            if self.values is not None:
+                self._compact()
+            return len(self.values) if self.values is not None else int(self.popcounts[self.bits].sum())
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m ** 2 / np.sum(2. ** -self.registers.astype(np.float64))
+        n_zeros = int((self.registers == 0).sum())
+        # linear counting for small cardinalities
+        if estimate <= 2.5 * m and n_zeros:
+            estimate = m * np.log(m / n_zeros)
+        return int(round(estimate))
+
+
+class FunnelCounter:
+    """
+    Streaming ordered funnel: a group of events (e.g. a session) reaches step k once it has events
+    of steps 0..k in this order, with at most window seconds from the step 0 event to the step k one
+    Events of a group have to come in time order over updates (as rows of a file sorted by event_time),
+    for every group and step the latest start (time of the step 0 event) of a chain reaching the step is kept,
+    which is the one leaving most time for the following steps
+    """
+    no_start = np.iinfo(np.int64).min
+
+    def __init__(self, steps: tuple, window: float = None):
+        if not len(steps):
+            raise ValueError("A funnel needs at least one step")
+        self.steps = tuple(steps)
+        self.window = window
+        # sorted keys of groups and latest starts of chains reaching every step
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.starts = np.zeros((0, len(self.steps)), dtype=np.int64)
+
+    @classmethod
+    def _previous_max(cls, values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+        """
+        Maximum of values of the previous rows of the same group (rows of a group are contiguous)
+        """
+        valid = values != cls.no_start
+        if not valid.any():
+            return values.copy()
+        low = values[valid].min()
+        span = values[valid].max() - low + 2
+        # groups are shifted apart, so that a running maximum does not cross group boundaries
+        shifted = groups * span + np.where(valid, values - low + 1, 0)
+        previous = np.r_[np.int64(0), np.maximum.accumulate(shifted)[:-1]] - groups * span
+        return np.where(previous > 0, previous - 1 + low, cls.no_start)
+
+    def update(self, keys, event_types, times=None):
+        """
+        Add events given as group keys (uint64), event types and times (epoch seconds, needed with a window)
+        """
+        in_funnel = np.isin(event_types, self.steps)
+        keys = np.asarray(keys, dtype=np.uint64)[in_funnel]
+        if not len(keys):
+            return
+        event_types = np.asarray(event_types)[in_funnel]
+        times = np.zeros(len(keys), dtype=np.int64) if times is None \
+            else np.asarray(times, dtype=np.int64)[in_funnel]
+        # events of a group next to each other in time order (stable, equal times keep file order)
+        order = np.lexsort((times, keys))
+        keys, event_types, times = keys[order], event_types[order], times[order]
+        group_keys, first_rows, groups = np.unique(keys, return_index=True, return_inverse=True)
+        # starts left by previous updates
+        positions = np.searchsorted(self.keys, group_keys)
+        known = positions < len(self.keys)
+        known[known] = self.keys[positions[known]] == group_keys[known]
+        prior = np.full((len(group_keys), len(self.steps)), self.no_start, dtype=np.int64)
+        prior[known] = self.starts[positions[known]]
+        starts = prior.copy()
+        # one vectorized pass per step: a row continues the latest chain reaching the previous step
+        # before it, either in this update or in the previous ones
+        row_starts = np.where(event_types == self.steps[0], times, self.no_start)
+        starts[:, 0] = np.maximum(starts[:, 0], np.maximum.reduceat(row_starts, first_rows))
+        for step in range(1, len(self.steps)):
+            previous = np.maximum(self._previous_max(row_starts, groups), prior[groups, step - 1])
+            continues = (event_types == self.steps[step]) & (previous != self.no_start)
+            if self.window is not None:
+                continues &= times - previous <= self.window
+            row_starts = np.where(continues, previous, self.no_start)
+            starts[:, step] = np.maximum(starts[:, step], np.maximum.reduceat(row_starts, first_rows))
+        self.starts[positions[known]] = starts[known]
+        if not known.all():
+            # new groups are inserted keeping keys sorted
+            keys = np.concatenate([self.keys, group_keys[~known]])
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.starts = np.concatenate([self.starts, starts[~known]])[order]
+
+    def finalize(self) -> pd.DataFrame:
+        """
+        Number of groups reaching every step, with conversion from the previous and the first step
+        """
+        n_groups = (self.starts != self.no_start).sum(axis=0)
+        funnel = pd.DataFrame({'step': list(self.steps), 'n_groups': n_groups})
+        funnel['step_conversion'] = funnel['n_groups'] / funnel['n_groups'].shift(fill_value=n_groups[0])
+        funnel['total_conversion'] = funnel['n_groups'] / n_groups[0]
+        return funnel
+
+
+fingerprints = dict()
+
+
+def get_file_fingerprint(df_label: str = default_file_label, n_samples: int = 16, sample_size: int = 2 ** 16):
+    """
+    Function describing the content of a file by its size, mtime and a hash of evenly spaced samples
+    """
+    source = get_source_fingerprint(df_label=df_label)
+    file_path = get_file_path(df_label=df_label)
+    fingerprint_key = (file_path, source['size'], source['mtime_ns'])
+    if fingerprint_key not in fingerprints:
+        sample_hash = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for offset in np.linspace(0, max(0, source['size'] - sample_size), n_samples).astype(int):
+                f.seek(offset)
+                sample_hash.update(f.read(sample_size))
+        fingerprints[fingerprint_key] = dict(source, sample=sample_hash.hexdigest())
+    return fingerprints[fingerprint_key]
+
+
+source_hashes = dict()
+
+
+def get_source_hash(module_names: list) -> str:
+    """
+    Function hashing the source files of modules, None if one of them has no file (e.g. an interactive session)
+    """
+    source_hash = hashlib.sha1()
+    for name in module_names:
+        file_path = getattr(sys.modules.get(name), '__file__', None)
+        if file_path is None or not os.path.exists(file_path):
+            return None
+        stat = os.stat(file_path)
+        hash_key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if hash_key not in source_hashes:
+            with open(file_path, 'rb') as f:
+                source_hashes[hash_key] = hashlib.sha1(f.read()).hexdigest()
+        source_hash.update(source_hashes[hash_key].encode())
+    return source_hash.hexdigest()
+
+
+def get_result_path(key: str):
+    return os.path.join(default_cache_path, f"{key}.pkl")
+
+
+def get_result_key(analysis, nrows: int = default_nrows):
+    """
+    Function building the result cache key of an analysis: its class, the source code of its module
+    and of shared.py (so that changes of helpers invalidate results too), its parameters, the number of rows
+    and fingerprints of its file(s)
+    """
+    analysis_class = type(analysis)
+    labels = analysis.df_label if isinstance(analysis.df_label, (list, tuple)) else [analysis.df_label]
+    source = get_source_hash([__name__, analysis_class.__module__])
+    if source is None:
+        try:
+            source = inspect.getsource(analysis_class)
+        except (OSError, TypeError):
+            # e.g. a class defined in an interactive session
+            source = None
+    params = {
+        name: value for name, value in sorted(vars(analysis).items())
+        if isinstance(value, (str, int, float, bool, tuple, type(None)))
+    }
+    key = hashlib.sha1(json.dumps([
+        analysis_class.__module__,
+        analysis_class.__qualname__,
+        source,
+        params,
+        nrows,
+        [get_file_fingerprint(df_label=label) for label in labels]
+    ], default=str).encode()).hexdigest()
+    # the label prefix lets invalidate_cache drop all results of a file
+    return f"{'+'.join(labels)}.{key}"
+
+
+def load_result(key: str):
+    """
+    Function returning the cached state of an analysis or None, a hit makes the entry the most recently used
+    """
+    if key is None or not os.path.exists(get_result_path(key)):
+        return None
+    try:
+        with open(get_result_path(key), 'rb') as f:
+            analysis = pickle.load(f)
+    except Exception:
+        # e.g. the class can not be found anymore
+        os.remove(get_result_path(key))
+        return None
+    os.utime(get_result_path(key))
+    return analysis
+
+
+class SizeLimitedWriter(io.RawIOBase):
+    """
+    Write only file failing (OSError EFBIG) as soon as more than max_size bytes are written to it
+    """
+
+    def __init__(self, file, max_size: int):
+        super().__init__()
+        self.file = file
+        self.max_size = max_size
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.size += memoryview(data).nbytes
+        if self.size > self.max_size:
+            raise OSError(errno.EFBIG, f"more than {self.max_size} bytes")
+        return self.file.write(data)
+
+
+def save_result(key: str, analysis):
+    """
+    Function caching the state of an analysis (before finalize) and evicting the least recently used
+    entries once the cache exceeds default_cache_size_mb, a state larger than the whole cache is not cached:
+    it is skipped when its estimated size is already too large, otherwise pickling stops once it exceeds the cache
+    """
+    max_size = default_cache_size_mb * 2 ** 20
+    if get_state_size(analysis) > max_size:
+        return
+    os.makedirs(default_cache_path, exist_ok=True)
+    tmp_path = get_result_path(key) + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(analysis, SizeLimitedWriter(f, max_size), protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        os.remove(tmp_path)
+        if e.errno != errno.EFBIG:
+            raise
+        return
+    os.replace(tmp_path, get_result_path(key))
+    entries = sorted(
+        (entry for entry in os.scandir(default_cache_path) if entry.name.endswith('.pkl')),
+        key=lambda entry: entry.stat().st_mtime_ns
+    )
+    cache_size = sum(entry.stat().st_size for entry in entries)
+    for entry in entries[:-1]:
+        if cache_size <= default_cache_size_mb * 2 ** 20:
+            break
+        cache_size -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def invalidate_cache(df_label: str = None, **kwargs):
+    """
+    Function dropping cached results of a file ('all' or None - of all files)
+    """
+    if not os.path.exists(default_cache_path):
+        return
+    n_entries = 0
+    for entry in os.scandir(default_cache_path):
+        if df_label in (None, 'all') or df_label in entry.name.split('.')[0].split('+'):
+            os.remove(entry.path)
+            n_entries += 1
+    print(f"{df_label + ' | ' if df_label not in (None, 'all') else ''}{n_entries} cached results removed")
+
+
+def get_byte_ranges(df_label: str = default_file_label, n_ranges: int = 1):
+    """
+    Function splitting a *.csv file (without its header) into byte ranges aligned to newlines
+    """
+    file_path = get_file_path(df_label=df_label)
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        for i in range(1, n_ranges):
+            position = bounds[0] + (size - bounds[0]) * i // n_ranges
+            # move to the beginning of the next line
+            f.seek(max(bounds[-1], position - 1))
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class FileRange(io.RawIOBase):
+    """
+    Read only file of the header line and a byte range of a *.csv file, so that pd.read_csv streams the range
+    """
+
+    def __init__(self, file_path: str, start: int, stop: int):
+        super().__init__()
+        self.file = open(file_path, 'rb')
+        self.header = self.file.readline()
+        self.file.seek(start)
+        self.remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.header:
+            n = min(len(buffer), len(self.header))
+            buffer[:n] = self.header[:n]
+            self.header = self.header[n:]
+            return n
+        n = self.file.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def read_csv_range(
+    df_label: str = default_file_label,
+    byte_range: tuple = None,
+    usecols: list = None,
+    dtype: dict = None,
+    size_mb: float = deafult_size_mb,
+    parse_event_time: bool = False
+):
+    """
+    Generator of chunks of a byte range of a *.csv file produced by get_byte_ranges,
+    the range is streamed in chunks sized to the memory budget as read_csv does
+    """
+    chunksize = get_chunksize(df_label=df_label, size_mb=size_mb, usecols=usecols, dtype=dtype, columnar=False)
+    with io.BufferedReader(FileRange(get_file_path(df_label=df_label), *byte_range)) as f:
+        reader = pd.read_csv(
+            f,
+            usecols=usecols,
+            dtype=get_csv_dtype(dtype),
+            engine='c',
+            na_filter=False,
+            iterator=chunksize is not None
+        )
+        chunks = [reader] if chunksize is None else read_adaptive_chunks(reader, chunksize=chunksize, size_mb=size_mb)
+        for chunk in chunks:
+            yield prepare_csv_chunk(chunk, df_label=df_label, dtype=dtype, parse_event_time=parse_event_time)
+
+
+class Analysis:
+    """
+    Streaming analysis to be run by run_analyses: declares the columns (with dtypes) it needs,
+    updates its state with every chunk and reports the result at the end
+    """
+    dtype = dict()
+    # whether partial states computed over separate parts of a file can be merged
+    mergeable = True
+    # whether event_time is needed as datetimes rather than strings
+    parse_event_time = False
+    # event types the analysis looks at (None - all), used to skip rows of the category partition
+    event_types = None
+
+    def __init__(self, df_label: str = default_file_label, aws: bool = default_aws):
+        self.df_label = df_label
+        # where the file (and what is built from it, e.g. the category index) is read from
+        self.aws = aws
+
+    def update(self, chunk: pd.DataFrame):
+        raise NotImplementedError
+
+    def merge(self, other: 'Analysis') -> 'Analysis':
+        """
+        Fold in the state of the same analysis computed over another part of a file,
+        aggregators and sketches (also kept in dicts) are merged and lists are concatenated
+        """
+        mergeable_types = (StreamingAggregator, QuantileSketch, DistinctCounter)
+        for name, value in vars(self).items():
+            if isinstance(value, mergeable_types):
+                value.merge(getattr(other, name))
+            elif isinstance(value, dict) and all(isinstance(v, mergeable_types) for v in value.values()):
+                for key, other_value in getattr(other, name).items():
+                    value[key] = value[key].merge(other_value) if key in value else other_value
+            elif isinstance(value, list):
+                value.extend(getattr(other, name))
+        return self
+
+    def finalize(self):
+        raise NotImplementedError
+
+
+def update_analyses(analyses: list, chunk: pd.DataFrame):
+    for analysis in analyses:
+        # every analysis gets its own copy of the columns it asked for (in file order)
+        analysis.update(chunk[[col for col in chunk.columns if col in analysis.dtype]])
+
+
+def configure_telemetry(telemetry: str = None, telemetry_path: str = None, profile: str = None):
+    """
+    Function setting telemetry of chunk loops and profiling of analyses for the following scans (see ChunkTelemetry)
+    """
+    global default_telemetry, default_telemetry_path, default_profile
+    default_telemetry, default_telemetry_path, default_profile = telemetry, telemetry_path, profile
+
+
+def get_state_size(value, depth: int = 0) -> int:
+    """
+    Function estimating memory (bytes) held by the state of an analysis, large dicts and lists are estimated
+    from their first item so that it is cheap enough to be called for every chunk (short lists are summed up)
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return int(np.sum(value.memory_usage(deep=False)))
+    if depth > 3 or isinstance(value, (str, bytes, int, float, np.generic)) or value is None:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        if not value:
+            return sys.getsizeof(value)
+        key, item = next(iter(value.items()))
+        return sys.getsizeof(value) + len(value) * (
+            get_state_size(key, depth + 1) + get_state_size(item, depth + 1)
+        )
+    if isinstance(value, (list, tuple, set)):
+        if not value:
+            return sys.getsizeof(value)
+        if len(value) <= 64:
+            return sys.getsizeof(value) + sum(get_state_size(item, depth + 1) for item in value)
+        return sys.getsizeof(value) + len(value) * get_state_size(next(iter(value)), depth + 1)
+    if hasattr(value, '__dict__'):
+        return sum(get_state_size(item, depth + 1) for item in vars(value).values())
+    return sys.getsizeof(value)
+
+
+class ChunkTelemetry:
+    """
+    Instrumentation of a chunk loop: time spent getting every chunk from the reader (reading and parsing)
+    and processing it (split by analysis), rows/s, MB/s, size of states of analyses and resident memory
+    Measurements are written as JSON lines or summarized at the end of the loop (see default_telemetry),
+    updates of analyses can be profiled with cProfile or tracemalloc (see default_profile)
+    Without telemetry a dot is printed per chunk
+    """
+
+    def __init__(
+        self,
+        scan: str,
+        analyses: list = None,
+        telemetry: str = None,
+        telemetry_path: str = None,
+        profile: str = None
+    ):
+        self.scan = scan
+        self.analyses = analyses or list()
+        self.telemetry = telemetry or default_telemetry
+        self.telemetry_path = telemetry_path or default_telemetry_path
+        self.profile = profile or default_profile
+        names = [type(analysis).__name__ for analysis in self.analyses]
+        self.names = [name if names.count(name) == 1 else f"{name}#{i}" for i, name in enumerate(names)]
+        self.records = list()
+        self.compute_s = dict()
+        self.profiles = {name: cProfile.Profile() for name in self.names} if self.profile == 'cprofile' else dict()
+        self.peak_alloc = dict.fromkeys(self.names, 0)
+        self.retained = dict.fromkeys(self.names, 0)
+        self.tracing = self.profile == 'tracemalloc' and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def chunks(self, reader):
+        """
+        Generator of chunks of a reader: time until a chunk is served is taken as reading and parsing,
+        time until the next one is asked for as processing
+        (with prefetch_chunks only the parsing not hidden behind processing is left as waiting for a chunk)
+        """
+        chunks = iter([reader] if isinstance(reader, pd.DataFrame) else reader)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            parsed = time.perf_counter()
+            self.compute_s = dict()
+            yield chunk
+            self.record(chunk, parse_s=parsed - start, compute_s=time.perf_counter() - parsed)
+
+    def update_analyses(self, chunk: pd.DataFrame):
+        if not (self.telemetry or self.profile):
+            return update_analyses(self.analyses, chunk)
+        for name, analysis in zip(self.names, self.analyses):
+            columns = chunk[[col for col in chunk.columns if col in analysis.dtype]]
+            start = time.perf_counter()
+            if self.profile == 'cprofile':
+                self.profiles[name].enable()
+            elif self.profile == 'tracemalloc':
+                tracemalloc.reset_peak()
+                allocated = tracemalloc.get_traced_memory()[0]
+            analysis.update(columns)
+            if self.profile == 'cprofile':
+                self.profiles[name].disable()
+            elif self.profile == 'tracemalloc':
+                current, peak = tracemalloc.get_traced_memory()
+                self.peak_alloc[name] = max(self.peak_alloc[name], peak - allocated)
+                self.retained[name] += current - allocated
+            self.compute_s[name] = time.perf_counter() - start
+
+    def record(self, chunk: pd.DataFrame, parse_s: float, compute_s: float):
+        if not self.telemetry:
+            print(".", end="", flush=True)
+            return
+        chunk_mb = chunk.memory_usage(deep=True).sum() / 2 ** 20
+        elapsed = max(parse_s + compute_s, 1e-9)
+        record = {
+            'scan': self.scan,
+            'pid': os.getpid(),
+            'chunk': len(self.records),
+            'rows': len(chunk),
+            'parse_s': round(parse_s, 6),
+            'compute_s': round(compute_s, 6),
+            'compute_s_by_analysis': {name: round(value, 6) for name, value in self.compute_s.items()},
+            'rows_per_s': round(len(chunk) / elapsed),
+            'mb': round(chunk_mb, 3),
+            'mb_per_s': round(chunk_mb / elapsed, 3),
+            'state_mb': {
+                name: round(get_state_size(analysis) / 2 ** 20, 3) for name, analysis in zip(self.names, self.analyses)
+            },
+            'rss_mb': round(get_rss_mb() or 0, 3),
+            'peak_rss_mb': round(get_peak_rss_mb() or 0, 3)
+        }
+        self.records.append(record)
+        if self.telemetry == 'jsonl':
+            self.write(record)
+
+    def write(self, record: dict):
+        line = json.dumps(record) + '\n'
+        if self.telemetry_path is None:
+            sys.stderr.write(line)
+            return
+        # a single append per line, so that lines of workers of a pool do not interleave
+        with open(self.telemetry_path, 'a') as f:
+            f.write(line)
+
+    def get_summary(self) -> pd.DataFrame:
+        """
+        Time spent reading/parsing chunks, updating every analysis and in the rest of the loop,
+        with final size of states
+        """
+        records = self.records
+        by_analysis = [sum(r['compute_s_by_analysis'].get(name, 0.) for r in records) for name in self.names]
+        other = max(0., sum(r['compute_s'] for r in records) - sum(by_analysis))
+        summary = pd.DataFrame({
+            'seconds': [sum(r['parse_s'] for r in records)] + by_analysis + [other],
+            'state_mb': [np.nan] + [records[-1]['state_mb'][name] if records else np.nan for name in self.names]
+            + [np.nan]
+        }, index=['reading/parsing'] + self.names + ['other processing'])
+        summary['share'] = summary['seconds'] / max(summary['seconds'].sum(), 1e-9)
+        if self.profile == 'tracemalloc':
+            summary['peak_alloc_mb'] = [np.nan] + [self.peak_alloc[name] / 2 ** 20 for name in self.names] + [np.nan]
+            summary['retained_mb'] = [np.nan] + [self.retained[name] / 2 ** 20 for name in self.names] + [np.nan]
+        return summary
+
+    def close(self):
+        records = self.records
+        if records:
+            rows = sum(r['rows'] for r in records)
+            parse_s, compute_s = sum(r['parse_s'] for r in records), sum(r['compute_s'] for r in records)
+            elapsed = max(parse_s + compute_s, 1e-9)
+            total = {
+                'scan': self.scan,
+                'pid': os.getpid(),
+                'summary': True,
+                'chunks': len(records),
+                'rows': rows,
+                'parse_s': round(parse_s, 3),
+                'compute_s': round(compute_s, 3),
+                'rows_per_s': round(rows / elapsed),
+                'mb_per_s': round(sum(r['mb'] for r in records) / elapsed, 3),
+                'peak_rss_mb': max(r['peak_rss_mb'] for r in records),
+                'rss_growth_mb': round(records[-1]['rss_mb'] - records[0]['rss_mb'], 3),
+                'bound': 'io' if parse_s >= compute_s else 'compute'
+            }
+            if self.telemetry == 'jsonl':
+                self.write(total)
+            elif self.telemetry == 'summary':
+                summary = self.get_summary()
+                top = summary['seconds'].iloc[1:].idxmax()
+                # a single print, so that summaries of workers of a pool do not interleave
+                print(
+                    f"\n{self.scan} | {total['chunks']} chunks, {rows} rows in {round(elapsed, 2)} s: "
+                    f"{total['rows_per_s']} rows/s, {total['mb_per_s']} MB/s, peak RSS {total['peak_rss_mb']} MB "
+                    f"(+{total['rss_growth_mb']} MB during the scan)\n"
+                    f"{self.scan} | "
+                    + ("I/O-bound: reading and parsing chunks takes most of the time" if total['bound'] == 'io'
+                       else f"compute-bound: processing chunks takes most of the time (mostly {top})")
+                    + "\n" + summary.to_string(formatters={'share': '{:.1%}'.format}, float_format='{:.3f}'.format),
+                    flush=True
+                )
+        for name, profile in self.profiles.items():
+            print(f"\n{self.scan} | cProfile of {name}")
+            stats = pstats.Stats(profile, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(15)
+            if self.telemetry_path is not None:
+                stats.dump_stats(f"{os.path.splitext(self.telemetry_path)[0]}.{name}.{os.getpid()}.prof")
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.profiles = dict()
+
+
+def run_analyses_on_parts(
+    analyses: list,
+    df_label: str,
+    parts: list,
+    dtype: dict,
+    size_mb: float,
+    columnar: bool,
+    parse_event_time: bool = False
+):
+    """
+    Worker of run_analyses: runs analyses over consecutive parts of a file, either byte ranges
+    of the *.csv file or ranges of rows of the columnar cache
+    """
+    reader = read_parts(
+        df_label=df_label, parts=parts, dtype=dtype, size_mb=size_mb, columnar=columnar,
+        parse_event_time=parse_event_time
+    )
+    with ChunkTelemetry(f"{df_label} | worker {os.getpid()}", analyses) as telemetry:
+        for chunk in telemetry.chunks(prefetch_chunks(reader)):
+            telemetry.update_analyses(chunk)
+    return analyses
+
+
+def read_parts(
+    df_label: str,
+    parts: list,
+    dtype: dict,
+    size_mb: float,
+    columnar: bool,
+    parse_event_time: bool = False
+):
+    """
+    Generator of chunks of consecutive parts of a file (see run_analyses_on_parts)
+    """
+    for part in parts:
+        if columnar:
+            start_row, stop_row = part
+            yield from read_columnar(
+                df_label=df_label,
+                size_mb=size_mb,
+                nrows=stop_row - start_row,
+                usecols=list(dtype),
+                dtype=dtype,
+                start_row=start_row,
+                parse_event_time=parse_event_time
+            )
+        else:
+            yield from read_csv_range(
+                df_label=df_label,
+                byte_range=part,
+                usecols=list(dtype),
+                dtype=dtype,
+                size_mb=size_mb,
+                parse_event_time=parse_event_time
+            )
+
+
+def merge_analyses(pair: tuple):
+    left, right = pair
+    return [analysis.merge(other) for analysis, other in zip(left, right)]
+
+
+def scan_analyses(
+    analyses: list,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    category: str = None
+):
+    """
+    Function streaming a file once through several analyses (see run_analyses),
+    only the union of columns they need is read
+    With several workers the file is split into parts, every process of a pool streams
+    a contiguous block of parts and partial results are merged pairwise (tree reduction);
+    analyses carrying state over chunk boundaries are always run sequentially
+    Analyses looking at a single top level category pass it as category, then only its rows
+    are read from the category partition when it has been built
+    With a list of labels months are streamed one after another (see read_months)
+    """
+    dtype = dict()
+    for analysis in analyses:
+        dtype.update(analysis.dtype)
+    parse_event_time = any(analysis.parse_event_time for analysis in analyses)
+    months = isinstance(df_label, (list, tuple))
+    partition_meta = get_category_partition_meta(df_label=df_label) \
+        if category is not None and not months and not aws and nrows is None \
+        and set(dtype) <= set(category_partition_columns) else None
+    if months:
+        reader = read_months(
+            df_labels=list(df_label),
+            aws=aws,
+            size_mb=size_mb,
+            nrows=nrows,
+            usecols=list(dtype),
+            dtype=dtype,
+            parse_event_time=parse_event_time
+        )
+        with ChunkTelemetry(f"{', '.join(df_label)} | scan", analyses) as telemetry:
+            for chunk in telemetry.chunks(prefetch_chunks(reader)):
+                telemetry.update_analyses(chunk)
+    elif partition_meta is not None:
+        event_types = None if any(a.event_types is None for a in analyses) \
+            else set().union(*[a.event_types for a in analyses])
+        reader = read_category_partition(
+            df_label=df_label,
+            category=category,
+            event_types=event_types,
+            size_mb=size_mb,
+            usecols=list(dtype),
+            dtype=dtype,
+            meta=partition_meta
+        )
+        with ChunkTelemetry(f"{df_label} | {category} scan", analyses) as telemetry:
+            for chunk in telemetry.chunks(prefetch_chunks(reader)):
+                telemetry.update_analyses(chunk)
+    elif workers and workers > 1 and not aws and nrows is None and all(a.mergeable for a in analyses):
+        meta = get_columnar_meta(df_label=df_label)
+        if meta is not None:
+            chunksize = get_chunksize(df_label=df_label, size_mb=size_mb, usecols=list(dtype), dtype=dtype) \
+                or meta['n_rows']
+            n_parts = max(workers, int(np.ceil(meta['n_rows'] / max(1, chunksize))))
+            bounds = np.linspace(0, meta['n_rows'], n_parts + 1).astype(int)
+            parts = list(zip(bounds[:-1], bounds[1:]))
+        else:
+            if is_codes_dtype(dtype.get('user_session')):
+                # build (or load) the session dictionary once, the forked workers inherit it
+                get_session_dictionary(df_label=df_label, size_mb=size_mb)
+            size = os.path.getsize(get_file_path(df_label=df_label))
+            n_parts = max(workers, int(np.ceil(size / 2 ** 20 / size_mb)) if size_mb else workers)
+            parts = get_byte_ranges(df_label=df_label, n_ranges=n_parts)
+        blocks = [parts[i * len(parts) // workers:(i + 1) * len(parts) // workers] for i in range(workers)]
+        # every worker reads its chunks within its share of the memory budget
+        worker_size_mb = size_mb / workers if size_mb else size_mb
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(
+                run_analyses_on_parts,
+                [
+                    (analyses, df_label, block, dtype, worker_size_mb, meta is not None, parse_event_time)
+                    for block in blocks if block
+                ]
+            )
+            # merge neighbours so that the order of first appearance is kept
+            while len(results) > 1:
+                merged = pool.map(merge_analyses, list(zip(results[::2], results[1::2])))
+                results = merged + ([results[-1]] if len(results) % 2 else [])
+        analyses = results[0]
+    else:
+        reader = read_csv(
+            df_label=df_label,
+            aws=aws,
+            size_mb=size_mb,
+            nrows=nrows,
+            usecols=list(dtype),
+            dtype=dtype,
+            parse_event_time=parse_event_time
+        )
+        with ChunkTelemetry(f"{df_label} | scan", analyses) as telemetry:
+            for chunk in telemetry.chunks(prefetch_chunks(reader)):
+                telemetry.update_analyses(chunk)
+    return analyses
+
+
+def run_analyses(
+    analyses: list,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    category: str = None
+):
+    """
+    Key function to run analyses over a file and get their results
+    States of analyses are kept in the result cache, so only analyses which have not been run
+    over the same file content with the same parameters scan the file
+    """
+    labels = list(df_label) if isinstance(df_label, (list, tuple)) else [df_label]
+    cache = default_cache_size_mb > 0 and not aws and all(
+        os.path.exists(get_file_path(df_label=label)) for label in labels
+    )
+    keys = [get_result_key(analysis, nrows=nrows) if cache else None for analysis in analyses]
+    cached = [load_result(key) for key in keys]
+    pending = [i for i, analysis in enumerate(cached) if analysis is None]
+    analyses = [analysis if state is None else state for analysis, state in zip(analyses, cached)]
+    if pending:
+        scanned = scan_analyses(
+            [analyses[i] for i in pending],
+            df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers, category=category
+        )
+        for i, analysis in zip(pending, scanned):
+            analyses[i] = analysis
+            if keys[i] is not None:
+                save_result(keys[i], analysis)
+    return [analysis.finalize() for analysis in analyses]
+
+
+class CategoryPairs(Analysis):
+    """
+    Distinct (category_id, category_code) pairs of a file with their number of events
+    """
+    dtype = {'category_id': np.int64, 'category_code': str}
+
+    def __init__(self, df_label: str = default_file_label, aws: bool = default_aws):
+        super().__init__(df_label=df_label, aws=aws)
+        self.pairs = StreamingAggregator(['category_id', 'category_code'])
+
+    def update(self, chunk):
+        self.pairs.update(chunk)
+
+    def finalize(self):
+        return self.pairs.finalize().reset_index()
+
+
+class CategoryIndex:
+    """
+    Hierarchy of categories of a file: every category_id is mapped to integer codes of its category
+    at every depth (0 - top level category, 1 - first sub category etc.), so filtering and grouping
+    by category become integer array lookups instead of splitting strings
+    Missing category_code is filled with the one known for the same category_id
+    """
+
+    def __init__(self, table: pd.DataFrame):
+        # table of distinct category_id with (filled) category_code
+        self.table = table
+        self.category_ids = pd.Index(table['category_id'].values)
+        parts = [code.split('.') if code else list() for code in table['category_code'].values]
+        self.max_depth = max([len(code_parts) for code_parts in parts] + [1])
+        self.level_codes, self.level_names = list(), list()
+        for depth in range(self.max_depth):
+            # missing category gets -1
+            names = ['.'.join(code_parts[:depth + 1]) or None for code_parts in parts]
+            codes, uniques = pd.factorize(np.array(names, dtype=object))
+            # trailing -1 is picked by category_id not in the index (get_indexer returns -1)
+            # and trailing '' is picked by -1 code
+            self.level_codes.append(np.append(codes, -1))
+            self.level_names.append(np.append(np.asarray(uniques, dtype=object), ''))
+
+    @classmethod
+    def from_pairs(cls, pairs: pd.DataFrame) -> 'CategoryIndex':
+        # for every category_id take the most frequent non empty category_code
+        known = pairs[pairs['category_code'] != ''].sort_values(by='n_events', ascending=False)
+        known = known.drop_duplicates(subset=['category_id']).set_index('category_id')['category_code']
+        table = pd.DataFrame({'category_id': pairs['category_id'].unique()})
+        table['category_code'] = table['category_id'].map(known).fillna('')
+        return cls(table)
+
+    def _depth(self, depth):
+        # None stands for the full category_code
+        return self.max_depth - 1 if depth is None else min(depth, self.max_depth - 1)
+
+    def get_codes(self, category_ids, depth: int = 0) -> np.ndarray:
+        """
+        Integer codes of categories at a given depth for an array of category_id (-1 if unknown)
+        """
+        rows = self.category_ids.get_indexer(np.asarray(category_ids))
+        return self.level_codes[self._depth(depth)][rows]
+
+    def get_code(self, name: str, depth: int = 0) -> int:
+        """
+        Integer code of a category at a given depth (-1 if unknown)
+        """
+        names = self.level_names[self._depth(depth)][:-1]
+        matches = np.flatnonzero(names == name)
+        return int(matches[0]) if len(matches) else -1
+
+    def get_names(self, codes, depth: int = 0) -> np.ndarray:
+        """
+        Names of categories at a given depth for an array of integer codes ('' if unknown)
+        """
+        return self.level_names[self._depth(depth)][np.asarray(codes)]
+
+
+def get_category_index_path(df_label=default_file_label):
+    """
+    Function to retrieve by a label the path of the category index of a file
+    """
+    return f"datasets/{df_label}.categories.csv"
+
+
+category_indexes = dict()
+
+
+def get_category_index(
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    workers: int = default_workers
+) -> CategoryIndex:
+    """
+    Function returning the category index of a file, it is built (with a single scan of the file)
+    only if it is missing or older than the file
+    """
+    index_path = get_category_index_path(df_label=df_label)
+    file_path = get_file_path(df_label=df_label)
+    if df_label in category_indexes:
+        return category_indexes[df_label]
+    if os.path.exists(index_path) and (
+        aws or not os.path.exists(file_path) or os.path.getmtime(index_path) >= os.path.getmtime(file_path)
+    ):
+        category_index = CategoryIndex(
+            pd.read_csv(index_path, dtype={'category_id': np.int64, 'category_code': str}, na_filter=False)
+        )
+    else:
+        print(f"{df_label} | building the category index", end="")
+        pairs = run_analyses(
+            [CategoryPairs(df_label=df_label, aws=aws)],
+            df_label=df_label, aws=aws, size_mb=size_mb, workers=workers
+        )[0]
+        print()
+        category_index = CategoryIndex.from_pairs(pairs)
+        category_index.table.to_csv(index_path, index=False)
+    category_indexes[df_label] = category_index
+    return category_index
+
+
+# Columns kept by the category partition, in file order
+category_partition_columns = ['event_type', 'product_id', 'category_id', 'brand', 'price']
+
+
+def get_category_partition_path(df_label=default_file_label):
+    """
+    Function to retrieve by a label the folder of the category partition of a file
+    """
+    return f"datasets/{df_label}.by-category"
+
+
+def get_category_partition_meta(df_label=default_file_label):
+    return get_columnar_meta(df_label=df_label, columnar_path=get_category_partition_path(df_label=df_label))
+
+
+def build_category_partition(
+    df_label: str = default_file_label,
+    size_mb: float = deafult_size_mb,
+    **kwargs
+):
+    """
+    One-time partitioning of a file by top level category: rows of category_partition_columns are written
+    in the columnar layout ordered by category and event type (counting sort in two scans),
+    so a question about a single category reads only its row ranges
+    """
+    category_index = get_category_index(df_label=df_label, size_mb=size_mb)
+    partition_path = get_category_partition_path(df_label=df_label)
+    tmp_path = partition_path + '.tmp'
+    source = get_source_fingerprint(df_label=df_label)
+    dtype = {col: str if columnar_schema[col] == 'category' else columnar_schema[col]
+             for col in category_partition_columns}
+    # first scan: number of rows per category and event type
+    counts = StreamingAggregator(['category', 'event_type'])
+    reader = read_csv(df_label=df_label, size_mb=size_mb, usecols=['event_type', 'category_id'], dtype=dtype)
+    with ChunkTelemetry(f"{df_label} | category partition counts") as telemetry:
+        for chunk in telemetry.chunks(prefetch_chunks(reader)):
+            categories = category_index.get_codes(chunk['category_id'].values, depth=0)
+            counts.update(pd.DataFrame({'category': categories, 'event_type': chunk['event_type'].values}))
+    counts = counts.finalize()['n_events']
+    event_types = pd.Index(sorted(counts.index.get_level_values('event_type').unique()))
+    n_categories = len(category_index.level_names[0]) - 1
+    # row ranges of every group (category * number of event types + event type) follow each other
+    group_counts = np.zeros(n_categories * len(event_types), dtype=np.int64)
+    counts = counts[counts.index.get_level_values('category') >= 0]
+    group_counts[
+        counts.index.get_level_values('category').values * len(event_types)
+        + event_types.get_indexer(counts.index.get_level_values('event_type'))
+    ] = counts.values
+    offsets = np.concatenate([[0], np.cumsum(group_counts)])
+    n_rows = int(offsets[-1])
+    # second scan: every row is written at the next free position of its group
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    arrays = {
+        col: np.memmap(
+            os.path.join(tmp_path, f"{col}.bin"),
+            dtype=columnar_codes_dtype if columnar_schema[col] == 'category' else columnar_schema[col],
+            mode='w+',
+            shape=(n_rows,)
+        ) for col in category_partition_columns
+    }
+    cursors = offsets[:-1].copy()
+    dictionaries = dict()
+    reader = read_csv(df_label=df_label, size_mb=size_mb, usecols=category_partition_columns, dtype=dtype)
+    with ChunkTelemetry(f"{df_label} | category partition") as telemetry:
+        for chunk in telemetry.chunks(prefetch_chunks(reader)):
+            categories = category_index.get_codes(chunk['category_id'].values, depth=0)
+            chunk = chunk[categories >= 0]
+            groups = categories[categories >= 0] * len(event_types) + event_types.get_indexer(chunk['event_type'])
+            order = np.argsort(groups, kind='stable')
+            sorted_groups = groups[order]
+            # position of a row = next free position of its group + rank of the row within the group in the chunk
+            positions = cursors[sorted_groups] + np.arange(len(order)) \
+                - np.searchsorted(sorted_groups, sorted_groups, side='left')
+            cursors += np.bincount(groups, minlength=len(cursors))
+            for col in category_partition_columns:
+                arrays[col][positions] = encode_columnar(chunk, col, dictionaries)[order]
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    codes_dtypes = save_columnar_dictionaries(tmp_path, dictionaries)
+    ranges = dict()
+    for group in np.flatnonzero(group_counts):
+        category = category_index.level_names[0][group // len(event_types)]
+        ranges.setdefault(category, dict())[event_types[group % len(event_types)]] = \
+            [int(offsets[group]), int(offsets[group + 1])]
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({
+            'columns': category_partition_columns,
+            'n_rows': n_rows,
+            'source': source,
+            'codes_dtypes': codes_dtypes,
+            'version': columnar_version,
+            'ranges': ranges,
+        }, f)
+    shutil.rmtree(partition_path, ignore_errors=True)
+    os.rename(tmp_path, partition_path)
+    print(f"\n{df_label + ' | ' if df_label else ''}Category partition with {n_rows} rows saved to {partition_path}")
+
+
+def read_category_partition(
+    df_label: str = default_file_label,
+    category: str = None,
+    event_types: set = None,
+    size_mb: float = deafult_size_mb,
+    usecols: list = None,
+    dtype: dict = None,
+    meta: dict = None
+):
+    """
+    Generator of chunks of a single top level category (and optionally only some event types)
+    served from the category partition
+    """
+    meta = meta or get_category_partition_meta(df_label=df_label)
+    for event_type, (start, stop) in meta['ranges'].get(category, dict()).items():
+        if event_types is None or event_type in event_types:
+            yield from read_columnar(
+                df_label=df_label,
+                size_mb=size_mb,
+                nrows=stop - start,
+                usecols=usecols,
+                dtype=dtype,
+                meta=meta,
+                start_row=start,
+                columnar_path=get_category_partition_path(df_label=df_label)
+            )
+
+
+# Columns every RQ works with ('RQ4.sh'-'RQ7.sh' used to cut them into full size *.rqN.csv copies),
+# all of them are served from the single columnar cache
+projections = {
+    'rq4': ['event_type', 'product_id', 'category_code', 'brand', 'price'],
+    'rq5': ['event_time', 'event_type', 'product_id', 'category_id'],
+    'rq6': ['event_type', 'product_id', 'category_code', 'user_id'],
+    'rq7': ['event_type', 'price', 'user_id'],
+}
+
+
+def read_projection(
+    projection: str,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    parse_event_time: bool = False
+):
+    """
+    Function to retrieve (in chunks) only the columns of a RQ, e.g. pd.concat(read_projection('rq6', '2019-Nov'))
+    """
+    return read_csv(
+        df_label=df_label,
+        aws=aws,
+        size_mb=size_mb,
+        nrows=nrows,
+        usecols=projections[projection],
+        parse_event_time=parse_event_time
+    )
+
+
+def preprocess(
+    df_label: str = default_file_label,
+    size_mb: float = deafult_size_mb,
+    **kwargs
+):
+    """
+    One-time preprocessing of a file: the *.csv file is parsed once into the columnar cache (which serves
+    every projection), the category index and the category partition are then built from the cache;
+    every step is skipped when its output is newer than the file
+    """
+    if get_columnar_meta(df_label=df_label) is None:
+        convert_to_columnar(df_label=df_label, size_mb=size_mb)
+    else:
+        print(f"{df_label + ' | ' if df_label else ''}Columnar cache is up to date")
+    get_category_index(df_label=df_label, size_mb=size_mb)
+    if get_category_partition_meta(df_label=df_label) is None:
+        build_category_partition(df_label=df_label, size_mb=size_mb)
+    else:
+        print(f"{df_label + ' | ' if df_label else ''}Category partition is up to date")
+
+
+def run_commands(
+    commands: list,
+    fmap: dict,
+    analyses_map: dict,
+    df_label: str = default_file_label,
+    aws: bool = default_aws,
+    size_mb: float = deafult_size_mb,
+    nrows: int = default_nrows,
+    workers: int = default_workers,
+    **kwargs
+):
+    """
+    Function running several CLI commands: streaming analyses share a single scan of a file,
+    the rest of commands (e.g. interactive ones) are run one by one afterwards
+    Other parameters of commands (kwargs, e.g. steps of a funnel) go to the analyses and functions taking them
+    """
+    analyses = [
+        analyses_map[command](df_label=df_label, **get_accepted_kwargs(analyses_map[command], kwargs))
+        for command in commands if command in analyses_map
+    ]
+    if analyses:
+        run_analyses(analyses, df_label=df_label, aws=aws, size_mb=size_mb, nrows=nrows, workers=workers)
+    for command in commands:
+        if command not in analyses_map:
+            function = fmap.get(command, lambda **_: print("Function has not been found"))
+            function(
+                df_label=df_label,
+                aws=aws,
+                size_mb=size_mb,
+                nrows=nrows,
+                workers=workers,
+                **get_accepted_kwargs(function, kwargs)
+            )
+
+
+def get_accepted_kwargs(function, kwargs: dict) -> dict:
+    """
+    Function selecting the keyword arguments a function (or a class) accepts
+    """
+    parameters = inspect.signature(function).parameters
+    if any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return kwargs
+    return {name: value for name, value in kwargs.items() if name in parameters}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data preprocessing')
+    FMAP = {
+        'preprocess': preprocess,
+        'convert_to_columnar': convert_to_columnar,
+        'build_category_partition': build_category_partition,
+        'invalidate_cache': invalidate_cache
+    }
+    parser.add_argument('command', choices=FMAP.keys())
+    parser.add_argument('-l', '--df-label', type=str, default=default_file_label)
+    parser.add_argument('-mb', '--size-mb', '--mem-budget', type=parse_size_mb, default=deafult_size_mb)
+    parser.add_argument('--telemetry', type=str, choices=telemetry_modes, default=default_telemetry)
+    parser.add_argument('--telemetry-path', type=str, default=default_telemetry_path)
+    parser.add_argument('--profile', type=str, choices=profile_modes, default=default_profile)
+    parser.add_argument('--prefetch', type=int, default=default_prefetch)
+    args = parser.parse_args()
+    configure_telemetry(telemetry=args.telemetry, telemetry_path=args.telemetry_path, profile=args.profile)
+    configure_prefetch(n_chunks=args.prefetch)
+    FMAP.get(args.command, lambda _: print("Function has not been found"))(
+        df_label=args.df_label,
+        size_mb=args.size_mb
+    )
@@ -0,0 +1,70 @@
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+import bench
+import shared
+
+
+def get_sizes(monkeypatch, state_mb, chunksize=100_000, size_mb=1_000, row_bytes=500., n_chunks=20):
+    """
+    Function returning sizes of consecutive chunks while states of analyses take state_mb of resident memory
+    """
+    sizes, chunk_rows = [], None
+
+    def get_rss_mb():
+        # resident memory is the states plus the chunks in flight
+        return state_mb(len(sizes)) + (1 + shared.default_prefetch) * chunk_rows * row_bytes / 2 ** 20
+
+    monkeypatch.setattr(shared, 'get_rss_mb', get_rss_mb)
+    chunk_sizes = shared.get_adaptive_chunksizes(chunksize, size_mb=size_mb)
+    chunk_rows = next(chunk_sizes)
+    for _ in range(n_chunks):
+        sizes.append(chunk_rows)
+        chunk_rows = chunk_sizes.send(row_bytes)
+    return sizes
+
+
+def test_state_above_budget_does_not_collapse_chunks(monkeypatch):
+    # states alone take more than the budget, smaller chunks would not help
+    sizes = get_sizes(monkeypatch, state_mb=lambda i: 1_500)
+    assert min(sizes) == 100_000 // 4
+    assert sizes[-1] > shared.min_chunksize
+
+
+def test_chunks_fit_in_budget_left_by_states(monkeypatch):
+    sizes = get_sizes(monkeypatch, state_mb=lambda i: 200)
+    # a quarter of the 800 MB left, shared by the processed chunk and the prefetched ones
+    expected = int(800 * shared.chunk_memory_share / (1 + shared.default_prefetch) * 2 ** 20 / 500.)
+    assert sizes[1:] == [expected] * (len(sizes) - 1)
+
+
+def test_growing_state_shrinks_chunks_gradually(monkeypatch):
+    sizes = get_sizes(monkeypatch, state_mb=lambda i: 100 + 60 * i)
+    assert all(a >= b for a, b in itertools.pairwise(sizes[1:]))
+    assert sizes[-1] == 100_000 // 4
+
+
+def test_without_budget_sizes_are_constant(monkeypatch):
+    sizes = get_sizes(monkeypatch, state_mb=lambda i: 10_000, size_mb=None)
+    assert sizes == [100_000] * 20
+
+
+def test_chunks_are_sized_from_columnar_cache_when_both_sources_exist(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(shared, 'bytes_per_row', dict())
+    bench.generate_events(df_label='2019-Oct', n_rows=20_000)
+    shared.convert_to_columnar(df_label='2019-Oct')
+    assert os.path.exists(shared.get_file_path(df_label='2019-Oct'))
+    dtype = {'user_session': shared.session_codes_dtype, 'product_id': np.uint32, 'event_type': str}
+    csv_row_bytes = shared.get_bytes_per_row(df_label='2019-Oct', usecols=list(dtype), dtype=dtype, columnar=False)
+    row_bytes = shared.get_bytes_per_row(df_label='2019-Oct', usecols=list(dtype), dtype=dtype)
+    # session codes take 4 bytes instead of 36 characters of a session id
+    sample = shared.read_csv(df_label='2019-Oct', size_mb=None, nrows=10_000, usecols=list(dtype), dtype=dtype)
+    assert row_bytes == sample.memory_usage(deep=True).sum() / len(sample) < csv_row_bytes
+    # chunks served from the cache take the asked share of the budget
+    chunks = shared.read_csv(df_label='2019-Oct', size_mb=1, usecols=list(dtype), dtype=dtype)
+    chunk_mb = next(chunks).memory_usage(deep=True).sum() / 2 ** 20
+    assert chunk_mb == pytest.approx(shared.chunk_memory_share / (1 + shared.default_prefetch), rel=0.05)
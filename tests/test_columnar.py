@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bench
+import shared
+
+df_label = '2019-Oct'
+dtypes = [
+    None,
+    {'event_time': str, 'price': np.float64, 'product_id': np.int64},
+    {'category_id': np.int64, 'event_type': str, 'brand': str, 'product_id': np.uint32, 'price': np.float32},
+    {'user_session': shared.session_codes_dtype, 'product_id': np.uint32, 'event_type': str},
+    {'event_type': str, 'user_id': np.uint32, 'price': np.float64},
+]
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    """
+    Synthetic month with missing brands and category codes, converted to the columnar cache
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('columnar'))
+    try:
+        bench.generate_events(df_label=df_label, n_rows=20_000)
+        events = pd.read_csv(shared.get_file_path(df_label=df_label), dtype=str, na_filter=False)
+        events.loc[::7, 'brand'] = ''
+        events.loc[::11, 'category_code'] = ''
+        events['price'] = np.round(np.random.default_rng(0).random(len(events)) * 3000, 2).astype(str)
+        events.to_csv(shared.get_file_path(df_label=df_label), index=False)
+        shared.convert_to_columnar(df_label=df_label)
+        assert shared.get_columnar_meta(df_label=df_label) is not None
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def read_both(**kwargs):
+    return (
+        shared.read_csv(df_label=df_label, columnar=False, **kwargs),
+        shared.read_csv(df_label=df_label, columnar=True, **kwargs)
+    )
+
+
+@pytest.mark.parametrize('dtype', dtypes)
+def test_columnar_frames_match_csv(dataset, dtype):
+    usecols = list(dtype) if dtype else None
+    csv_frame, columnar_frame = read_both(size_mb=None, usecols=usecols, dtype=dtype)
+    pd.testing.assert_frame_equal(columnar_frame, csv_frame)
+
+
+@pytest.mark.parametrize('dtype', dtypes[:2])
+def test_columnar_frames_match_csv_with_parsed_event_time(dataset, dtype):
+    csv_frame, columnar_frame = read_both(size_mb=None, dtype=dtype, parse_event_time=True)
+    pd.testing.assert_frame_equal(columnar_frame, csv_frame)
+
+
+def test_columnar_frames_match_csv_with_parse_dates(dataset):
+    csv_frame, columnar_frame = read_both(
+        size_mb=None, nrows=100, parse_dates=['event_time'], date_parser=pd.to_datetime)
+    pd.testing.assert_frame_equal(columnar_frame, csv_frame)
+
+
+def test_columnar_chunks_match_csv(dataset):
+    csv_chunks, columnar_chunks = read_both(size_mb=1, nrows=15_000)
+    csv_frame = pd.concat(list(csv_chunks))
+    for chunk in columnar_chunks:
+        pd.testing.assert_frame_equal(chunk, csv_frame.loc[chunk.index])
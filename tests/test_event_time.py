@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import shared
+
+event_times = [
+    '2019-10-01 00:00:00 UTC',
+    '2019-02-28 23:59:59 UTC',
+    '2020-02-29 12:34:56',
+    '1969-12-31 23:59:59 UTC',
+    '2100-03-01 08:00:00 UTC',
+]
+malformed = [
+    '', 'nan', np.nan, None, 'é',
+    '2019-13-01 00:00:00 UTC',
+    '2019-10-00 00:00:00 UTC',
+    '2019-10-01 24:00:00 UTC',
+    '2019-10-01 00:60:00 UTC',
+    '2019-1:-01 00:00:00 UTC',
+    '2019-10-01 00:00:0? UTC',
+    '2019-10-01T00:00:00 UTC',
+    '2019-10-01 00:00:00 GMT',
+    '2019-10-01 00:00:00 UT',
+    '2019-10-01 00:00:00 UTCX',
+    '2019-10-01 00:00:00.',
+    '2019-10-01',
+]
+
+
+def test_event_times_match_pandas():
+    epochs = shared.event_time_to_epoch(np.array(event_times, dtype=object))
+    expected = pd.to_datetime(pd.Series(event_times).str.replace(' UTC', '')).values
+    assert (shared.epoch_to_datetime(epochs) == expected).all()
+
+
+@pytest.mark.parametrize('value', malformed)
+def test_malformed_event_times_are_missing(value):
+    epochs = shared.event_time_to_epoch(np.array([event_times[0], value], dtype=object))
+    assert epochs[1] == shared.missing_epoch
+    assert np.isnat(shared.epoch_to_datetime(epochs)[1])
+    assert list(shared.epoch_to_event_time(epochs)) == [event_times[0], '']
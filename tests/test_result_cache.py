@@ -0,0 +1,47 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import shared
+
+
+class State:
+    def __init__(self, values):
+        self.values = values
+
+
+class Unsized:
+    """
+    State whose size get_state_size can not see (a list estimated from its first item)
+    """
+
+    def __init__(self, n_bytes):
+        self.items = [b''] + [bytes(2 ** 20) for _ in range(n_bytes // 2 ** 20)]
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared, 'default_cache_path', str(tmp_path))
+    monkeypatch.setattr(shared, 'default_cache_size_mb', 1)
+    return tmp_path
+
+
+def test_small_states_are_cached(cache):
+    shared.save_result('label.small', State(np.arange(1000)))
+    assert (shared.load_result('label.small').values == np.arange(1000)).all()
+
+
+@pytest.mark.parametrize('state', [State(np.zeros(2 ** 18)), Unsized(16 * 2 ** 20)])
+def test_states_larger_than_cache_are_not_written(cache, monkeypatch, state):
+    n_bytes = []
+    write = shared.SizeLimitedWriter.write
+    monkeypatch.setattr(
+        shared.SizeLimitedWriter, 'write', lambda self, data: n_bytes.append(len(data)) or write(self, data)
+    )
+    shared.save_result('label.large', state)
+    assert shared.load_result('label.large') is None
+    assert not os.listdir(cache)
+    # pickling stops at the size of the cache
+    assert sum(n_bytes) <= 2 * 2 ** 20 < len(pickle.dumps(state))
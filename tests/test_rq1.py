@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rq1
+
+# events of a user-product pair more than a day apart, split over two chunks
+events = pd.DataFrame({
+    'user_session': np.array([0, 0, 1, 0, 1, 0], dtype=np.uint32),
+    'product_id': np.array([7, 7, 8, 7, 8, 7], dtype=np.uint32),
+    'event_type': ['view', 'cart', 'view', 'purchase', 'cart', 'view'],
+    'event_time': pd.to_datetime([
+        '2019-10-01 08:00:00', '2019-10-01 09:00:00', '2019-10-01 10:00:00',
+        '2019-10-03 09:30:00', '2019-10-03 10:20:00', '2019-10-03 11:00:00'
+    ])
+})
+
+
+def run(analysis, chunks: list):
+    for chunk in chunks:
+        analysis.update(chunk.copy())
+    return analysis.n_deltas, analysis.sum_deltas
+
+
+@pytest.mark.parametrize('analysis, expected, expected_with_timeout', [
+    # cart at 09:00 bought two days later at 09:30 (seconds of the difference as .dt.seconds)
+    (lambda **kwargs: rq1.AvgTimeFromCartToPurchase(quantiles=(), **kwargs), (1, 1800), (0, 0)),
+    # view at 08:00 followed by the cart at 09:00, view at 10:00 followed by the cart two days later at 10:20
+    (rq1.AvgTimeFromFirstViewToAnotherEvent, (2, 3600 + 1200), (1, 3600)),
+])
+def test_pairs_spanning_more_than_a_day_across_chunks(analysis, expected, expected_with_timeout):
+    assert run(analysis(), [events]) == expected
+    assert run(analysis(), [events.iloc[:3], events.iloc[3:]]) == expected
+    assert run(analysis(), [events.iloc[[i]] for i in range(len(events))]) == expected
+    # pairs inactive for longer than pair_timeout are dropped only when asked
+    assert run(analysis(pair_timeout=24 * 3600), [events.iloc[:3], events.iloc[3:]]) == expected_with_timeout